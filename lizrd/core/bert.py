@@ -3,7 +3,7 @@ from collections import OrderedDict
 import torch
 
 import lizrd.core.nn as nn
-from typing import Literal
+from typing import Literal, Optional
 
 from lizrd.core import misc
 from lizrd.support import ash
@@ -95,17 +95,147 @@ def LowRank(dinput, doutput, dlowrank):
     )
 
 
+AttentionBackend = Literal["einsum", "sdpa", "chunked"]
+
+
+class ChunkedAttentionFunction(torch.autograd.Function):
+    """
+    Softmax attention over (..., heads, length, dhead) inputs, computed in blocks of
+    chunk_size queries and chunk_size keys with an online softmax (as in FlashAttention).
+    Only the output and the log-sum-exp of every query are kept for backward, which recomputes
+    the blocks, so memory is O(length * dhead + chunk_size**2) instead of O(length**2).
+    """
+
+    @staticmethod
+    def forward(ctx, q, k, v, mask, chunk_size):
+        scale = q.shape[-1] ** -0.5
+        out = torch.empty_like(q)
+        lse = q.new_empty(q.shape[:-1])
+        for q_begin in range(0, q.shape[-2], chunk_size):
+            q_chunk = q[..., q_begin : q_begin + chunk_size, :]
+            running_max = q_chunk.new_full(q_chunk.shape[:-1], float("-inf"))
+            running_sum = q_chunk.new_zeros(q_chunk.shape[:-1])
+            acc = torch.zeros_like(q_chunk)
+            for k_begin in range(0, k.shape[-2], chunk_size):
+                scores = _chunk_scores(q, k, mask, q_begin, k_begin, chunk_size, scale)
+                new_max = torch.maximum(running_max, scores.amax(dim=-1))
+                # rows with every key masked so far have nothing to rescale
+                safe_max = torch.where(new_max == float("-inf"), 0.0, new_max)
+                p = torch.exp(scores - safe_max.unsqueeze(-1))
+                correction = torch.exp(running_max - safe_max)
+                running_sum = running_sum * correction + p.sum(dim=-1)
+                acc = acc * correction.unsqueeze(-1) + torch.matmul(
+                    p, v[..., k_begin : k_begin + chunk_size, :]
+                )
+                running_max = new_max
+            out[..., q_begin : q_begin + chunk_size, :] = acc / running_sum.unsqueeze(
+                -1
+            )
+            lse[..., q_begin : q_begin + chunk_size] = safe_max + torch.log(running_sum)
+        ctx.save_for_backward(q, k, v, out, lse)
+        ctx.mask = mask
+        ctx.chunk_size = chunk_size
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        q, k, v, out, lse = ctx.saved_tensors
+        mask, chunk_size = ctx.mask, ctx.chunk_size
+        scale = q.shape[-1] ** -0.5
+        grad_q, grad_k, grad_v = (
+            torch.zeros_like(q),
+            torch.zeros_like(k),
+            torch.zeros_like(v),
+        )
+        delta = (grad_out * out).sum(dim=-1)
+        for q_begin in range(0, q.shape[-2], chunk_size):
+            q_slice = slice(q_begin, q_begin + chunk_size)
+            grad_out_chunk = grad_out[..., q_slice, :]
+            for k_begin in range(0, k.shape[-2], chunk_size):
+                k_slice = slice(k_begin, k_begin + chunk_size)
+                scores = _chunk_scores(q, k, mask, q_begin, k_begin, chunk_size, scale)
+                p = torch.exp(scores - lse[..., q_slice].unsqueeze(-1))
+                grad_v[..., k_slice, :] += torch.matmul(
+                    p.transpose(-1, -2), grad_out_chunk
+                )
+                grad_p = torch.matmul(
+                    grad_out_chunk, v[..., k_slice, :].transpose(-1, -2)
+                )
+                grad_scores = p * (grad_p - delta[..., q_slice].unsqueeze(-1)) * scale
+                grad_q[..., q_slice, :] += torch.matmul(grad_scores, k[..., k_slice, :])
+                grad_k[..., k_slice, :] += torch.matmul(
+                    grad_scores.transpose(-1, -2), q[..., q_slice, :]
+                )
+        return grad_q, grad_k, grad_v, None, None
+
+
+def _chunk_scores(q, k, mask, q_begin, k_begin, chunk_size, scale):
+    q_slice = slice(q_begin, q_begin + chunk_size)
+    k_slice = slice(k_begin, k_begin + chunk_size)
+    scores = torch.matmul(q[..., q_slice, :], k[..., k_slice, :].transpose(-1, -2))
+    scores = scores * scale
+    if mask is not None:
+        scores = scores.masked_fill(~mask[..., q_slice, k_slice], float("-inf"))
+    return scores
+
+
+SDPA_AVAILABLE = hasattr(torch.nn.functional, "scaled_dot_product_attention")
+
+
+def _has_forward_hooks(module):
+    return bool(
+        module._forward_hooks
+        or module._forward_pre_hooks
+        or torch.nn.modules.module._global_forward_hooks
+        or torch.nn.modules.module._global_forward_pre_hooks
+    )
+
+
+def chunked_attention(q, k, v, mask=None, chunk_size: int = 128):
+    """
+    Equivalent of softmax(q k^T / sqrt(dhead)) v for (..., heads, length, dhead) inputs
+    and an optional boolean mask broadcastable to (..., heads, length, length).
+    """
+    return ChunkedAttentionFunction.apply(q, k, v, mask, chunk_size)
+
+
 @ash.check("... d -> ... d")
 class Attention(nn.Module):
-    def __init__(self, dmodel, heads, dhead=None):
+    """
+    Multi-head self-attention.
+    Q, K and V are projected with a single matmul over their concatenated weights,
+    the parameters (and so the state dict) stay split into the Q, K, V and D EinMix layers.
+    While any of these layers has forward hooks (e.g. from nn.ModuleProfiler), they are called one by one instead.
+    backend="einsum" materializes the (..., heads, l, L) scores,
+    backend="sdpa" uses torch.nn.functional.scaled_dot_product_attention (torch>=2.0), which picks
+    a fused kernel (flash or memory-efficient) that doesn't store them.
+    backend="chunked" computes them in (chunk_size, chunk_size) blocks, see chunked_attention.
+    """
+
+    def __init__(
+        self,
+        dmodel,
+        heads,
+        dhead=None,
+        backend: AttentionBackend = "einsum",
+        chunk_size: int = 128,
+    ):
         super(Attention, self).__init__()
         if dhead is None:
             assert dmodel % heads == 0
             dhead = dmodel // heads
+        assert backend in ["einsum", "sdpa", "chunked"]
+        if backend == "sdpa" and not SDPA_AVAILABLE:
+            raise ValueError(
+                f'backend="sdpa" needs torch>=2.0, got torch {torch.__version__}; '
+                'use backend="chunked" to avoid storing the attention scores'
+            )
 
         self.heads = heads
         self.dhead = dhead
         self.dmodel = dmodel
+        self.backend = backend
+        self.chunk_size = chunk_size
 
         key_query_value_gen = lambda: misc.EinMix(
             "... dmodel -> ... heads dhead",
@@ -129,20 +259,96 @@ class Attention(nn.Module):
             dhead=dhead,
         )
         self.D = combine_gen()
+        # optional boolean (..., l, L) mask of allowed query-key pairs, see set_attention_mask
+        self.attention_mask = None
+
+    def count_activation_flops(self, x):
+        """FLOPs of q k^T and of multiplying its softmax by v, for nn.ModuleProfiler."""
+        length = x.shape[-2]
+        n_sequences = x.numel() // (length * x.shape[-1])
+        return 2 * 2 * n_sequences * self.heads * length * length * self.dhead
+
+    def _project_qkv(self, x):
+        if any(_has_forward_hooks(layer) for layer in [self.Q, self.K, self.V]):
+            return self.Q(x), self.K(x), self.V(x)
+        layers = [self.Q.layer, self.K.layer, self.V.layer]
+        weight = torch.cat([layer.weight for layer in layers], dim=1)
+        bias = torch.cat([layer.bias for layer in layers], dim=1)
+        qkv = torch.matmul(x, weight.view(self.dmodel, -1)) + bias.view(-1)
+        qkv = qkv.view(x.shape[:-1] + (3, self.heads, self.dhead))
+        return qkv.unbind(dim=-3)
+
+    def _combine_heads(self, prefinal):
+        if _has_forward_hooks(self.D):
+            return self.D(prefinal)
+        weight = self.D.layer.weight.view(-1, self.dmodel)
+        prefinal = prefinal.reshape(prefinal.shape[:-2] + (-1,))
+        return torch.matmul(prefinal, weight) + self.D.layer.bias.view(-1)
 
     def forward(self, x):
-        q = self.Q(x)
-        k = self.K(x)
-        v = self.V(x)
-
-        a = torch.einsum("... l h d, ... L h d -> ... h l L", q, k)
-        a = a * (1 / self.dhead**0.5)
-        a = torch.softmax(a, dim=-1)
-        prefinal = torch.einsum("... h l L, ... L h d -> ... l h d", a, v)
-        output = self.D(prefinal)
+        q, k, v = self._project_qkv(x)
+
+        if self.backend == "sdpa":
+            mask = self.attention_mask
+            if mask is not None:
+                mask = mask.unsqueeze(-3)
+            prefinal = torch.nn.functional.scaled_dot_product_attention(
+                q.transpose(-2, -3),
+                k.transpose(-2, -3),
+                v.transpose(-2, -3),
+                attn_mask=mask,
+            ).transpose(-2, -3)
+        elif self.backend == "chunked":
+            mask = self.attention_mask
+            if mask is not None:
+                mask = mask.unsqueeze(-3)
+            prefinal = chunked_attention(
+                q.transpose(-2, -3),
+                k.transpose(-2, -3),
+                v.transpose(-2, -3),
+                mask,
+                self.chunk_size,
+            ).transpose(-2, -3)
+        else:
+            a = torch.einsum("... l h d, ... L h d -> ... h l L", q, k)
+            a = a * (1 / self.dhead**0.5)
+            if self.attention_mask is not None:
+                a = a.masked_fill(~self.attention_mask.unsqueeze(-3), float("-inf"))
+            a = torch.softmax(a, dim=-1)
+            prefinal = torch.einsum("... h l L, ... L h d -> ... l h d", a, v)
+        output = self._combine_heads(prefinal)
         return output
 
 
+def get_packed_attention_mask(tokens, sep_id, pad_id):
+    """
+    Block-diagonal attention mask for rows packed with several chunks separated by sep_id.
+    Tokens attend only within their own chunk (the separator closes it), padding only to padding.
+    """
+    is_sep = tokens == sep_id
+    segment_ids = torch.cumsum(is_sep, dim=-1) - is_sep.long()
+    segment_ids = torch.where(tokens == pad_id, -1, segment_ids)
+    return segment_ids.unsqueeze(-1) == segment_ids.unsqueeze(-2)
+
+
+def set_attention_backend(
+    model, backend: AttentionBackend, chunk_size: Optional[int] = None
+):
+    """Switches all Attention layers of the model to `backend`, keeping their parameters."""
+    for module in model.modules():
+        if isinstance(module, Attention):
+            module.backend = backend
+            if chunk_size is not None:
+                module.chunk_size = chunk_size
+
+
+def set_attention_mask(model, attention_mask):
+    """Sets the mask used by all Attention layers of the model in the following forward passes."""
+    for module in model.modules():
+        if isinstance(module, Attention):
+            module.attention_mask = attention_mask
+
+
 @ash.check("... d -> ... d")
 def ResidualBlock(dmodel, layer, name):
     return Residual(
@@ -166,7 +372,13 @@ def EncoderBlock(dmodel, layers):
 
 
 @ash.check("... d -> ... d")
-def EncoderTower(n_blocks, dmodel, layer_dict):
+def EncoderTower(
+    n_blocks,
+    dmodel,
+    layer_dict,
+    attention_backend: Optional[AttentionBackend] = None,
+    attention_chunk_size: Optional[int] = None,
+):
     misc.check_layer_funs(*layer_dict.values())
     encoder_blocks = []
     for i_block in range(n_blocks):
@@ -174,7 +386,10 @@ def EncoderTower(n_blocks, dmodel, layer_dict):
         name_and_block = (f"block_{i_block}", EncoderBlock(dmodel, layers_info))
         encoder_blocks.append(name_and_block)
 
-    return nn.Sequential(OrderedDict(encoder_blocks))
+    tower = nn.Sequential(OrderedDict(encoder_blocks))
+    if attention_backend is not None:
+        set_attention_backend(tower, attention_backend, attention_chunk_size)
+    return tower
 
 
 @ash.check("... -> ... d")
@@ -217,3 +432,14 @@ def BERT(embedding_layer, encoder_tower, head):
             ]
         )
     )
+
+
+def get_masked_predictions(model, x, mask):
+    """
+    Equivalent to model(x)[mask] for a model built with BERT, but runs the prediction head
+    only on the encoder states of the positions selected by the boolean mask.
+    """
+    if isinstance(model, ash.Check):
+        model = model.layer
+    encoded = model.encoder(model.embedding_layer(x))
+    return model.prediction_head(encoded[mask])
@@ -1,6 +1,14 @@
+import functools
+import itertools
+import math
+import re
+import time
+
 import torch
 from einops.layers.torch import EinMix as OGEinMix
+from einops.parsing import ParsedExpression
 import opt_einsum
+from attr import define
 from lizrd.core import nn
 from lizrd.support import ash
 
@@ -38,20 +46,71 @@ def get_init_bias(shape, fan_in=None, fan_out=None, dtype=torch.float32):
     return torch.zeros(shape, dtype=dtype)
 
 
+EINSUM_CACHE_SIZE = 256
+
+
+@define
+class EinsumCacheStats:
+    hits: int = 0
+    misses: int = 0
+    path_search_time: float = 0.0
+
+    @property
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+
+einsum_cache_stats = EinsumCacheStats()
+
+
+@functools.lru_cache(maxsize=EINSUM_CACHE_SIZE)
+def _get_contract_expression(subscript, shapes, dtypes, kwargs):
+    # dtypes don't change the path, but are part of the key so that each expression sees one dtype
+    del dtypes
+    start = time.perf_counter()
+    expression = opt_einsum.contract_expression(subscript, *shapes, **dict(kwargs))
+    einsum_cache_stats.path_search_time += time.perf_counter() - start
+    return expression
+
+
 def einsum(subscript, *operands, use_opt_einsum=False, **kwargs):
+    """
+    With use_opt_einsum, the contraction path is searched by opt_einsum once for each subscript
+    and operand shapes, and kept in an LRU cache, see einsum_cache_stats.
+    """
     if use_opt_einsum:
-        return opt_einsum.contract(subscript, *operands, **kwargs)
+        expression = _get_contract_expression(
+            subscript,
+            tuple(tuple(operand.shape) for operand in operands),
+            tuple(operand.dtype for operand in operands),
+            tuple(sorted(kwargs.items())),
+        )
+        cache_info = _get_contract_expression.cache_info()
+        einsum_cache_stats.hits = cache_info.hits
+        einsum_cache_stats.misses = cache_info.misses
+        return expression(*operands)
     else:
         return torch.einsum(subscript, *operands, **kwargs)
 
 
+def reset_einsum_cache():
+    _get_contract_expression.cache_clear()
+    einsum_cache_stats.hits = einsum_cache_stats.misses = 0
+    einsum_cache_stats.path_search_time = 0.0
+
+
 class EinMix(nn.Module):
+    """
+    einops EinMix, which also accepts an ellipsis for any number of leading axes.
+    The contraction is compiled once here into a single einsum (with an ellipsis for the leading axes)
+    and the reshapes for the grouped axes, so forward does no parsing.
+    """
+
     def __init__(self, signature, weight_shape=None, bias_shape=None, **kwargs):
         super(EinMix, self).__init__()
         self.change_anything = False
         if "..." in signature:
             self.change_anything = True
-            self.og_signature = signature
             signature = signature.replace("...", "squeezed")
         self.layer = OGEinMix(
             signature, weight_shape=weight_shape, bias_shape=bias_shape, **kwargs
@@ -59,23 +118,62 @@ class EinMix(nn.Module):
         if self.layer.bias is not None:
             self.layer.bias.data *= 0.0
 
+        # reshapes of the axes from the first group on, as (number of axes before, shape after)
+        left, right = [ParsedExpression(side) for side in signature.split("->")]
+        self.input_reshape = None
+        input_suffix = _grouped_suffix(left.composition, kwargs)
+        if input_suffix is not None:
+            grouped_shape, flat_shape = input_suffix
+            self.input_reshape = (len(grouped_shape), flat_shape)
+        self.output_reshape = None
+        output_suffix = _grouped_suffix(right.composition, kwargs)
+        if output_suffix is not None:
+            grouped_shape, flat_shape = output_suffix
+            self.output_reshape = (len(flat_shape), grouped_shape)
+
+        self.einsum_pattern = self.layer.einsum_pattern
+        if self.change_anything:
+            # "squeezed" is the first axis of both sides, so the first letter of their patterns
+            assert left.composition[0] == right.composition[0] == ["squeezed"]
+            left_pattern, weight_pattern, right_pattern = re.split(
+                ",|->", self.einsum_pattern
+            )
+            self.einsum_pattern = (
+                f"...{left_pattern[1:]},{weight_pattern}->...{right_pattern[1:]}"
+            )
+
     def forward(self, x):
-        if not self.change_anything:
-            return self.layer(x)
-        # else
-        beginning, end = self.og_signature.split("->")
-        beginning = beginning.split()
-        end = end.split()
-        assert beginning[0] == end[0] == "..."
-        # TODO(jaszczur): fix this hack below, properly
-        contracted_dims = (
-            len(x.shape) - len(beginning) + 1 + (1 if "(" in "".join(beginning) else 0)
-        )
-        ellipsis_shape = list(x.shape[:contracted_dims])
-        newx = torch.reshape(x, [-1] + list(x.shape[contracted_dims:]))
-        output = self.layer(newx)
-        newoutput = torch.reshape(output, ellipsis_shape + list(output.shape[1:]))
-        return newoutput
+        if self.input_reshape is not None:
+            n_axes, shape = self.input_reshape
+            x = x.reshape(x.shape[: x.ndim - n_axes] + shape)
+        output = torch.einsum(self.einsum_pattern, x, self.layer.weight)
+        if self.layer.bias is not None:
+            bias = self.layer.bias
+            if self.change_anything:
+                bias = bias[0]
+            output = output + bias
+        if self.output_reshape is not None:
+            n_axes, shape = self.output_reshape
+            output = output.reshape(output.shape[: output.ndim - n_axes] + shape)
+        return output
+
+
+def _grouped_suffix(composition, axes_lengths):
+    """
+    Shapes of a side of an EinMix signature from its first group of axes on, with the groups and flattened.
+    None if there are no groups.
+    """
+    groups = [i for i, group in enumerate(composition) if len(group) != 1]
+    if not groups:
+        return None
+    suffix = composition[groups[0] :]
+    for axis in itertools.chain(*suffix):
+        assert axis in axes_lengths, f"Length of axis {axis} not given"
+    grouped_shape = tuple(
+        math.prod(axes_lengths[axis] for axis in group) for group in suffix
+    )
+    flat_shape = tuple(axes_lengths[axis] for axis in itertools.chain(*suffix))
+    return grouped_shape, flat_shape
 
 
 @ash.check("... inp -> ... out")
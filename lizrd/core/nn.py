@@ -1,5 +1,9 @@
 # Here be dragons.
+import time
+from typing import Dict, Optional
+
 import torch.nn
+from attr import define
 
 # This whole thing is a bit of a hack.
 # When we create a new layer, we want it to inherit from the `Module` class.
@@ -45,6 +49,8 @@ class Module(torch.nn.Module):
 
 # This class will be a child of all our modules. It will allow us to add a stack,
 # and to profile all the layers. We just cannot use __new__ method in Layers.
+# Profiling doesn't need it after all: ModuleProfiler below adds torch hooks to the modules of a model,
+# which also covers the torch.nn modules we don't recreate here, and costs nothing once removed.
 class OverModule(torch.nn.Module):
     def __init__(self, *args, **kwargs):
         super(OverModule, self).__init__(*args, **kwargs)
@@ -80,3 +86,183 @@ class LayerNorm(torch.nn.LayerNorm, Module):
 
 class Embedding(torch.nn.Embedding, Module):
     pass
+
+
+@define
+class ModuleStats:
+    n_calls: int = 0
+    forward_time: float = 0.0
+    n_backward_calls: int = 0
+    backward_time: float = 0.0
+    activation_bytes: int = 0
+    parameter_flops: int = 0
+    activation_flops: int = 0
+
+    @property
+    def flops(self):
+        return self.parameter_flops + self.activation_flops
+
+
+def _tensors(value):
+    if isinstance(value, torch.Tensor):
+        return [value]
+    if isinstance(value, (tuple, list)):
+        return [item for item in value if isinstance(item, torch.Tensor)]
+    return []
+
+
+def _n_vectors(tensor):
+    return tensor.numel() // max(tensor.shape[-1], 1)
+
+
+def _subtree_weights(module):
+    """Numbers of elements of the weights of `module` and its submodules, by id, without embedding tables."""
+    lookups = {
+        id(p)
+        for submodule in module.modules()
+        if isinstance(submodule, torch.nn.Embedding)
+        for p in submodule.parameters(recurse=False)
+    }
+    # EinMix biases also have several dimensions
+    return {
+        id(p): p.numel()
+        for name, p in module.named_parameters()
+        if p.dim() >= 2 and not name.endswith("bias") and id(p) not in lookups
+    }
+
+
+class ModuleProfiler:
+    """
+    Per-module profile of a model, aggregated by module path (e.g. "encoder.block_2.feedforward"):
+    forward and backward wall time, number of calls, bytes of the outputs and FLOPs.
+    Parameter FLOPs are estimated as 2 * (weights of the module itself) per token (exact for linear layers),
+    with the tokens counted as the vectors of the input or of the output, whichever are fewer,
+    where weights of submodules that weren't called during the forward (e.g. ones whose weights are used
+    directly) count as the module's own. Modules with a `count_activation_flops(input)` method also
+    report activation FLOPs, of the products that don't involve weights (e.g. q k^T in attention).
+    Times of a module include its submodules. The backward time is measured from the gradient of
+    the output to the gradient of the first input, so it's only recorded when the input requires grad.
+
+    The hooks are only attached between `enable` and `disable` (or inside `with profiler:`),
+    so a disabled profiler costs nothing.
+    """
+
+    def __init__(self, model: torch.nn.Module, synchronize: bool = False):
+        self.model = model
+        self.synchronize = synchronize
+        self.stats: Dict[str, ModuleStats] = {}
+        self.handles = []
+        self.forward_starts: Dict[int, list] = {}
+        # modules being run, each with the modules called directly inside it
+        self.call_stack = []
+        self.weights: Dict[int, Dict[int, int]] = {}
+
+    def enable(self):
+        if self.handles:
+            return self
+        for module in self.model.modules():
+            self.weights[id(module)] = _subtree_weights(module)
+        for path, module in self.model.named_modules():
+            path = path or "model"
+            self.handles.append(
+                module.register_forward_pre_hook(self._make_pre_hook(module))
+            )
+            self.handles.append(
+                module.register_forward_hook(self._make_hook(path, module))
+            )
+        return self
+
+    def disable(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        self.forward_starts = {}
+        self.call_stack = []
+
+    def __enter__(self):
+        return self.enable()
+
+    def __exit__(self, *args):
+        self.disable()
+
+    def reset(self):
+        self.stats = {}
+
+    def _now(self):
+        if self.synchronize and torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _make_pre_hook(self, module):
+        def pre_hook(module, args):
+            if self.call_stack:
+                self.call_stack[-1][1].append(module)
+            self.call_stack.append((module, []))
+            self.forward_starts.setdefault(id(module), []).append(self._now())
+
+        return pre_hook
+
+    def _own_weights(self, module, called):
+        weights = dict(self.weights[id(module)])
+        for submodule in called:
+            for key in self.weights.get(id(submodule), {}):
+                weights.pop(key, None)
+        return sum(weights.values())
+
+    def _make_hook(self, path, module):
+        count_activation_flops = getattr(module, "count_activation_flops", None)
+
+        def hook(module, args, output):
+            elapsed = self._now() - self.forward_starts[id(module)].pop()
+            _, called = self.call_stack.pop()
+            n_weights = self._own_weights(module, called)
+            stats = self.stats.setdefault(path, ModuleStats())
+            stats.n_calls += 1
+            stats.forward_time += elapsed
+            outputs = _tensors(output)
+            stats.activation_bytes += sum(t.numel() * t.element_size() for t in outputs)
+            inputs = _tensors(args)
+            if n_weights and inputs:
+                # layers like attention.D take (..., heads, dhead) and return (..., dmodel)
+                vectors = inputs[:1] + [t for t in outputs[:1] if t.dim() > 1]
+                n_tokens = min(_n_vectors(t) for t in vectors)
+                stats.parameter_flops += 2 * n_weights * n_tokens
+            if count_activation_flops is not None and inputs:
+                stats.activation_flops += count_activation_flops(inputs[0])
+            if torch.is_grad_enabled() and inputs and inputs[0].requires_grad:
+                self._add_backward_hooks(stats, inputs[0], outputs)
+
+        return hook
+
+    def _add_backward_hooks(self, stats, input, outputs):
+        outputs = [t for t in outputs if t.requires_grad]
+        if not outputs:
+            return
+        backward_start = []
+
+        def output_hook(grad):
+            if not backward_start:
+                backward_start.append(self._now())
+
+        def input_hook(grad):
+            if backward_start:
+                stats.n_backward_calls += 1
+                stats.backward_time += self._now() - backward_start.pop()
+
+        for output in outputs:
+            output.register_hook(output_hook)
+        input.register_hook(input_hook)
+
+    def summary(self, sort_by: str = "forward_time", top: Optional[int] = None):
+        rows = sorted(self.stats.items(), key=lambda item: -getattr(item[1], sort_by))[
+            :top
+        ]
+        lines = [
+            f"{'module':50} {'calls':>7} {'fwd s':>9} {'bwd s':>9} {'act MB':>9} {'GFLOPs':>9}"
+        ]
+        for path, stats in rows:
+            lines.append(
+                f"{path[-50:]:50} {stats.n_calls:7} {stats.forward_time:9.4f} {stats.backward_time:9.4f} "
+                f"{stats.activation_bytes / 2**20:9.2f} {stats.flops / 1e9:9.3f}"
+            )
+        return "\n".join(lines)
@@ -50,6 +50,105 @@ class AttentionTest(GeneralTestCase):
         out = layer(input)
         self.assertShape(out, (batch, seql, dm))
 
+    def test_packed_attention_mask(self):
+        dm, heads = 32, 4
+        sep_id, pad_id = 1, 0
+        tokens = torch.tensor([[5, 6, 1, 7, 8, 9, 1, 5, 0, 0]])
+        mask = bert.get_packed_attention_mask(tokens, sep_id, pad_id)
+        self.assertShape(mask, (1, 10, 10))
+        self.assertTrue(mask[0, 0, 2] and not mask[0, 0, 3])
+        self.assertTrue(mask[0, 8, 9] and not mask[0, 7, 8])
+
+        layer = bert.Attention(dm, heads)
+        input = torch.normal(0.0, 1.0, (1, 10, dm))
+        bert.set_attention_mask(layer, mask)
+        out = layer(input)
+        bert.set_attention_mask(layer, None)
+        for begin, end in [(0, 3), (3, 7), (7, 8), (8, 10)]:
+            self.assertTensorAlmostEqual(out[:, begin:end], layer(input[:, begin:end]))
+
+    def _randomize(self, layer):
+        with torch.no_grad():
+            for param in layer.parameters():
+                param.normal_(0.0, 0.2)
+
+    def test_fused_projection(self):
+        # the same parameters as the separate Q, K, V and D layers, applied one by one
+        batch, seql, dm, heads = 3, 7, 32, 4
+        layer = bert.Attention(dm, heads)
+        self._randomize(layer)
+        self.assertEqual(
+            sorted(layer.state_dict().keys()),
+            sorted(
+                f"{name}.layer.{param}"
+                for name in "QKVD"
+                for param in ["weight", "bias"]
+            ),
+        )
+        input = torch.normal(0.0, 1.0, (batch, seql, dm))
+        q, k, v = layer.Q(input), layer.K(input), layer.V(input)
+        a = (
+            torch.einsum("... l h d, ... L h d -> ... h l L", q, k)
+            / (dm // heads) ** 0.5
+        )
+        prefinal = torch.einsum("... h l L, ... L h d -> ... l h d", a.softmax(-1), v)
+        self.assertTensorAlmostEqual(layer(input), layer.D(prefinal))
+
+    @unittest.skipUnless(bert.SDPA_AVAILABLE, "needs torch>=2.0")
+    def test_sdpa_backend(self):
+        batch, seql, dm, heads = 3, 10, 32, 4
+        layer = bert.Attention(dm, heads)
+        self._randomize(layer)
+        sdpa_layer = bert.Attention(dm, heads, backend="sdpa")
+        sdpa_layer.load_state_dict(layer.state_dict())
+        input = torch.normal(0.0, 1.0, (batch, seql, dm))
+        self.assertTensorAlmostEqual(sdpa_layer(input), layer(input))
+
+        tokens = torch.tensor([[5, 6, 1, 7, 8, 9, 1, 5, 0, 0]] * batch)
+        mask = bert.get_packed_attention_mask(tokens, sep_id=1, pad_id=0)
+        bert.set_attention_mask(layer, mask)
+        bert.set_attention_mask(sdpa_layer, mask)
+        self.assertTensorAlmostEqual(sdpa_layer(input), layer(input))
+
+    def test_hooks_see_projections(self):
+        batch, seql, dm, heads = 3, 10, 32, 4
+        layer = bert.Attention(dm, heads)
+        self._randomize(layer)
+        input = torch.normal(0.0, 1.0, (batch, seql, dm))
+        fused_output = layer(input)
+        called = []
+        handles = [
+            getattr(layer, name).register_forward_hook(
+                lambda module, args, output, name=name: called.append(name)
+            )
+            for name in "QKVD"
+        ]
+        self.assertTensorAlmostEqual(layer(input), fused_output)
+        self.assertEqual(called, ["Q", "K", "V", "D"])
+        for handle in handles:
+            handle.remove()
+
+    def test_chunked_backend(self):
+        batch, seql, dm, heads = 3, 10, 32, 4
+        layer = bert.Attention(dm, heads)
+        self._randomize(layer)
+        chunked_layer = bert.Attention(dm, heads, backend="chunked", chunk_size=3)
+        chunked_layer.load_state_dict(layer.state_dict())
+        tokens = torch.tensor([[5, 6, 1, 7, 8, 9, 1, 5, 0, 0]] * batch)
+        mask = bert.get_packed_attention_mask(tokens, sep_id=1, pad_id=0)
+        for attention_mask in [None, mask]:
+            bert.set_attention_mask(layer, attention_mask)
+            bert.set_attention_mask(chunked_layer, attention_mask)
+            input = torch.normal(0.0, 1.0, (batch, seql, dm), requires_grad=True)
+            output = layer(input)
+            chunked_output = chunked_layer(input)
+            self.assertTensorAlmostEqual(chunked_output, output)
+
+            grad = torch.normal(0.0, 1.0, output.shape)
+            (input_grad,) = torch.autograd.grad(output, input, grad)
+            (chunked_input_grad,) = torch.autograd.grad(chunked_output, input, grad)
+            self.assertTensorAlmostEqual(chunked_input_grad, input_grad)
+
 
 class EncoderTowerTest(GeneralTestCase):
     def test_basic(self):
@@ -64,6 +163,27 @@ class EncoderTowerTest(GeneralTestCase):
         out = model(input)
         self.assertShape(out, (batch, seql, dm))
 
+    def test_attention_backend(self):
+        batch, seql, dm, heads, dff = 3, 7, 32, 4, 64
+        layer_dict = {
+            "attention": lambda: bert.Attention(dm, heads),
+            "feedforward": lambda: bert.FeedForward(dm, dff),
+        }
+        model = bert.EncoderTower(2, dm, layer_dict)
+        chunked_model = bert.EncoderTower(
+            2, dm, layer_dict, attention_backend="chunked", attention_chunk_size=2
+        )
+        chunked_model.load_state_dict(model.state_dict())
+        attention_layers = [
+            module
+            for module in chunked_model.modules()
+            if isinstance(module, bert.Attention)
+        ]
+        self.assertEqual(len(attention_layers), 2)
+        self.assertTrue(all(layer.chunk_size == 2 for layer in attention_layers))
+        input = torch.normal(0.0, 1.0, (batch, seql, dm))
+        self.assertTensorAlmostEqual(chunked_model(input), model(input))
+
 
 class BERTTest(GeneralTestCase):
     def test_basic(self):
@@ -92,6 +212,29 @@ class BERTTest(GeneralTestCase):
 
         self.assertShape(output, (batch, seql, output_size))
 
+    def test_masked_predictions(self):
+        batch, seql, dm, heads, dff = 3, 7, 32, 4, 64
+        vocab_size, max_length = 107, 33
+        n_blocks = 2
+
+        embedding_layer = bert.EmbeddingLayer(
+            bert.PositionalEmbedding(max_length, dm),
+            bert.TokenEmbedding(vocab_size, dm),
+        )
+        layer_dict = {
+            "attention": lambda: bert.Attention(dm, heads),
+            "feedforward": lambda: bert.FeedForward(dm, dff),
+        }
+        encoder_tower = bert.EncoderTower(n_blocks, dm, layer_dict)
+        head = bert.PredictionHead(dm, vocab_size)
+        model = bert.BERT(embedding_layer, encoder_tower, head)
+
+        input = torch.randint(0, vocab_size, (batch, seql))
+        mask = torch.rand((batch, seql)) < 0.3
+        output = bert.get_masked_predictions(model, input, mask)
+        self.assertShape(output, (int(mask.sum()), vocab_size))
+        self.assertTensorAlmostEqual(output, model(input)[mask])
+
 
 if __name__ == "__main__":
     unittest.main()
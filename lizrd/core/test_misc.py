@@ -1,4 +1,5 @@
 import torch
+from einops.layers.torch import EinMix as OGEinMix
 
 from lizrd.core import misc
 from lizrd.support.test_utils import GeneralTestCase
@@ -72,3 +73,112 @@ class TestEinMix(GeneralTestCase):
         input = torch.normal(0.0, 1.0, (batch, seqlen, whatever, dinp))
         output = layer(input)
         self.assertShape(output, (batch, seqlen, whatever, dout))
+
+    def test_parity_with_einops(self):
+        # signatures used in bert.py, ffs.py and research_bert.py,
+        # with the input shape after the batch and sequence axes
+        heads, dmodel, dhead, dff = 3, 12, 4, 5
+        signatures = [
+            (
+                "... dmodel -> ... heads dhead",
+                dict(weight_shape="dmodel heads dhead", bias_shape="heads dhead"),
+                dict(dmodel=dmodel, heads=heads, dhead=dhead),
+                (dmodel,),
+            ),
+            (
+                "... heads dhead -> ... dmodel",
+                dict(weight_shape="heads dhead dmodel", bias_shape="dmodel"),
+                dict(dmodel=dmodel, heads=heads, dhead=dhead),
+                (heads, dhead),
+            ),
+            (
+                "... a b -> ... a c",
+                dict(weight_shape="a b c"),
+                dict(a=2, b=3, c=4),
+                (2, 3),
+            ),
+            (
+                "... dinp -> ... modules dinp",
+                dict(weight_shape="modules dinp"),
+                dict(dinp=dmodel, modules=heads),
+                (dmodel,),
+            ),
+            (
+                "... modules dinp -> ... (modules dmodule)",
+                dict(weight_shape="dinp dmodule"),
+                dict(dinp=dmodel, modules=heads, dmodule=dhead),
+                (heads, dmodel),
+            ),
+            (
+                "batch seqlen dmodel -> batch seqlen nheads dhead",
+                dict(weight_shape="nheads dmodel dhead", bias_shape="nheads dhead"),
+                dict(dmodel=dmodel, nheads=heads, dhead=dhead),
+                (dmodel,),
+            ),
+            (
+                "batch seqlen nheads dhead -> batch seqlen nheads dff",
+                dict(weight_shape="nheads dhead dff", bias_shape="nheads dff"),
+                dict(dff=dff, nheads=heads, dhead=dhead),
+                (heads, dhead),
+            ),
+            (
+                "batch seqlen nheads dff -> batch seqlen nheads dhead",
+                dict(weight_shape="dff dhead", bias_shape="dhead"),
+                dict(dff=dff, nheads=heads, dhead=dhead),
+                (heads, dff),
+            ),
+            (
+                "batch seqlen (n_chunks chunk_size)-> batch seqlen n_chunks dff_chunk_size",
+                dict(
+                    weight_shape="n_chunks chunk_size dff_chunk_size",
+                    bias_shape="(n_chunks dff_chunk_size)",
+                ),
+                dict(n_chunks=heads, chunk_size=dhead, dff_chunk_size=dff),
+                (heads * dhead,),
+            ),
+            (
+                "batch seqlen n_chunks dff_chunk_size-> batch seqlen (n_chunks chunk_size)",
+                dict(
+                    weight_shape="n_chunks dff_chunk_size chunk_size",
+                    bias_shape="(n_chunks chunk_size)",
+                ),
+                dict(n_chunks=heads, chunk_size=dhead, dff_chunk_size=dff),
+                (heads, dff),
+            ),
+        ]
+        for signature, shapes, axes_lengths, input_shape in signatures:
+            layer = misc.EinMix(signature, **shapes, **axes_lengths)
+            reference = OGEinMix(
+                signature.replace("...", "batch seqlen"), **shapes, **axes_lengths
+            )
+            with torch.no_grad():
+                for param, reference_param in zip(
+                    layer.layer.parameters(), reference.parameters()
+                ):
+                    reference_param.normal_()
+                    # the bias of the layer has one leading axis for the ellipsis
+                    param.copy_(reference_param.view(param.shape))
+
+            input = torch.normal(0.0, 1.0, (5, 7) + input_shape)
+            self.assertTensorAlmostEqual(layer(input), reference(input))
+            if signature.startswith("..."):
+                self.assertTensorAlmostEqual(layer(input[0]), reference(input)[0])
+
+
+class TestEinsumCache(GeneralTestCase):
+    def test_cached_expression(self):
+        misc.reset_einsum_cache()
+        subscript = "... d, m d, d f -> ... m f"
+        x = torch.normal(0.0, 1.0, (4, 5, 6))
+        gating = torch.normal(0.0, 1.0, (3, 6))
+        projection = torch.normal(0.0, 1.0, (6, 2))
+        for _ in range(3):
+            output = misc.einsum(subscript, x, gating, projection, use_opt_einsum=True)
+            self.assertTensorAlmostEqual(
+                output, torch.einsum(subscript, x, gating, projection)
+            )
+        misc.einsum(subscript, x[0], gating, projection, use_opt_einsum=True)
+        self.assertEqual(misc.einsum_cache_stats.hits, 2)
+        self.assertEqual(misc.einsum_cache_stats.misses, 2)
+        self.assertAlmostEqual(misc.einsum_cache_stats.hit_rate, 0.5)
+        self.assertGreater(misc.einsum_cache_stats.path_search_time, 0.0)
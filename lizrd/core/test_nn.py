@@ -0,0 +1,69 @@
+import torch
+
+from lizrd.core import bert, nn
+from lizrd.support.test_utils import GeneralTestCase
+
+
+class TestModuleProfiler(GeneralTestCase):
+    def test_stats(self):
+        batch, seql, dm, dff = 3, 7, 32, 64
+        layer = bert.FeedForward(dm, dff)
+        input = torch.normal(0.0, 1.0, (batch, seql, dm), requires_grad=True)
+        profiler = nn.ModuleProfiler(layer)
+        with profiler:
+            for _ in range(2):
+                layer(input).sum().backward()
+        layer(input)
+
+        self.assertEqual(len(profiler.handles), 0)
+        self.assertEqual(profiler.stats["model"].n_calls, 2)
+        self.assertEqual(profiler.stats["model"].n_backward_calls, 2)
+        self.assertGreater(profiler.stats["model"].backward_time, 0.0)
+        pre_relu = profiler.stats["layer.logging_ff_pre_relu"]
+        self.assertEqual(pre_relu.parameter_flops, 2 * 2 * dm * dff * batch * seql)
+        self.assertEqual(pre_relu.activation_bytes, 2 * 4 * batch * seql * dff)
+        self.assertEqual(profiler.stats["layer.relu"].parameter_flops, 0)
+        self.assertIn("layer.logging_ff_post_relu", profiler.summary())
+
+    def test_attention_flops(self):
+        batch, seql, dm, heads, dff = 3, 7, 32, 4, 64
+        layer_dict = {
+            "attention": lambda: bert.Attention(dm, heads),
+            "feedforward": lambda: bert.FeedForward(dm, dff),
+        }
+        model = bert.EncoderTower(2, dm, layer_dict)
+        input = torch.normal(0.0, 1.0, (batch, seql, dm))
+        profiler = nn.ModuleProfiler(model)
+        with profiler:
+            model(input)
+
+        attention_paths = [
+            path for path in profiler.stats if path.endswith("attention")
+        ]
+        self.assertEqual(len(attention_paths), 2)
+        for path in attention_paths:
+            self.assertEqual(
+                profiler.stats[path].activation_flops,
+                2 * 2 * batch * seql * seql * dm,
+            )
+            for name in "QKVD":
+                self.assertEqual(
+                    profiler.stats[f"{path}.{name}"].parameter_flops,
+                    2 * dm * dm * batch * seql,
+                )
+        total_flops = sum(stats.flops for stats in profiler.stats.values())
+        block_flops = (
+            2 * (2 * dm * dff + 4 * dm * dm) * batch * seql
+            + 2 * 2 * batch * seql * seql * dm
+        )
+        self.assertEqual(total_flops, 2 * block_flops)
+
+    def test_uncalled_submodule_weights(self):
+        batch, dm = 3, 8
+        linear = torch.nn.Linear(dm, dm)
+        model = torch.nn.ModuleDict({"linear": linear})
+        model.forward = lambda x: x @ linear.weight.T
+        profiler = nn.ModuleProfiler(model)
+        with profiler:
+            model(torch.normal(0.0, 1.0, (batch, dm)))
+        self.assertEqual(profiler.stats["model"].parameter_flops, 2 * dm * dm * batch)
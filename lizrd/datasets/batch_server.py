@@ -0,0 +1,273 @@
+"""
+A local process that tokenizes once for several trainers on the same node, instead of each trainer
+running its own DataLoader workers. The server serves padded, unmasked token batches over a unix socket.
+Every trainer connected with BatchServerClient gets its own share of the batches, and masks them
+on its device with its own seed, like ProcessedDatasetWrapper with masking="device".
+
+Usage:
+python3 -m lizrd.datasets.batch_server --address=/tmp/batches.sock --batch_size=128 --num_workers=16
+then pass --batch_server_address=/tmp/batches.sock to the training scripts.
+"""
+import argparse
+import threading
+import time
+import traceback
+from multiprocessing.connection import Client, Listener
+from typing import Optional
+
+import torch
+from torch.utils.data import DataLoader
+
+from lizrd.datasets.wikibookdata import (
+    BatchPrefetcher,
+    DataWaitStats,
+    ParallelCompatibleDataset,
+    ProcessedBatch,
+    ProcessedDataset,
+    SentenceProcessor,
+)
+from lizrd.support.logging import AbstractLogger, get_current_logger
+
+
+class BatchServer:
+    """
+    Serves batches to BatchServerClients at `address` until `close` is called.
+    The number of connected clients is printed and, when there is a current logger, reported to it.
+    """
+
+    def __init__(
+        self,
+        pdataset: ProcessedDataset,
+        address: str,
+        batch_size: int,
+        num_workers: int = 8,
+        seed: int = 42,
+        logger: Optional[AbstractLogger] = None,
+    ):
+        self.address = address
+        self.batch_size = batch_size
+        self.max_total_length = pdataset.processor.max_total_length
+        dataset = ParallelCompatibleDataset(
+            pdataset, batch_size=batch_size, seed=seed, masking="device"
+        )
+        self.batches = iter(
+            DataLoader(dataset, num_workers=num_workers, batch_size=None)
+        )
+        self.lock = threading.Lock()
+        self.n_clients = 0
+        self.n_batches = 0
+        self.logger = logger if logger is not None else get_current_logger()
+        self.closing = False
+        self.serving = threading.Event()
+        self.stopped = threading.Event()
+
+    def serve_forever(self):
+        with Listener(self.address, family="AF_UNIX") as listener:
+            self.serving.set()
+            while True:
+                connection = listener.accept()
+                if self.closing:
+                    connection.close()
+                    break
+                threading.Thread(
+                    target=self._serve_client, args=(connection,), daemon=True
+                ).start()
+        self._release_batches()
+        self.stopped.set()
+
+    def close(self):
+        """Stops serve_forever and the DataLoader workers. Connected clients get an error on their next batch."""
+        with self.lock:
+            already_closing = self.closing
+            self.closing = True
+        if self.serving.is_set() and not self.stopped.is_set():
+            if not already_closing:
+                # wakes up the accept() in serve_forever
+                Client(self.address, family="AF_UNIX").close()
+            self.stopped.wait()
+        else:
+            self._release_batches()
+
+    def _release_batches(self):
+        with self.lock:
+            # the workers are shut down when their iterator is deleted
+            self.batches = None
+
+    def _log_clients(self, message):
+        print(f"{message}, {self.n_clients} connected")
+        if self.logger is not None:
+            self.logger.report_scalar(
+                title="batch server",
+                series="clients",
+                value=self.n_clients,
+                iteration=self.n_batches,
+            )
+
+    def _serve_client(self, connection):
+        with connection:
+            settings = connection.recv()
+            connection.send(
+                {
+                    "batch_size": self.batch_size,
+                    "max_total_length": self.max_total_length,
+                }
+            )
+            with self.lock:
+                self.n_clients += 1
+            self._log_clients(f"Client connected with {settings}")
+            failed = False
+            try:
+                while True:
+                    try:
+                        connection.recv()
+                    except EOFError:
+                        break
+                    with self.lock:
+                        if self.batches is None:
+                            break
+                        try:
+                            tokens, _ = next(self.batches)
+                        except Exception:
+                            # e.g. a crashed worker, the DataLoader can't be used anymore
+                            traceback.print_exc()
+                            failed = True
+                            break
+                        self.n_batches += 1
+                    # sent as numpy, as torch would try to share the memory with the client
+                    connection.send(tokens.numpy())
+            finally:
+                with self.lock:
+                    self.n_clients -= 1
+                self._log_clients("Client disconnected")
+        if failed:
+            print("Closing the batch server, as its DataLoader failed")
+            self.close()
+
+
+class BatchServerClient:
+    """
+    Gets token batches from a BatchServer and masks them on `device` with a generator seeded with `seed`.
+    Has the same interface as ProcessedDatasetWrapper, but batches are split between all clients of the server
+    in the order they ask for them, so the stream cannot be reproduced or resumed.
+    """
+
+    def __init__(
+        self,
+        address: str,
+        processor: SentenceProcessor,
+        device: torch.device,
+        batch_size: int,
+        seed: int = 42,
+        prefetch: int = 0,
+    ):
+        self.address = address
+        self.processor = processor
+        self.device = torch.device(device)
+        self.batch_size = batch_size
+        self.seed = seed
+        self.n_batches = 0
+        self.connection = Client(address, family="AF_UNIX")
+        self.connection.send({"batch_size": batch_size, "seed": seed})
+        server_settings = self.connection.recv()
+        expected_settings = {
+            "batch_size": batch_size,
+            "max_total_length": processor.max_total_length,
+        }
+        if server_settings != expected_settings:
+            self.connection.close()
+            raise ValueError(
+                f"Server at {address} serves {server_settings}, expected {expected_settings}"
+            )
+        self.generator = torch.Generator(device=self.device)
+        self.generator.manual_seed(seed)
+        self.stats = DataWaitStats()
+        self.prefetcher = None
+        if prefetch > 0:
+            self.prefetcher = BatchPrefetcher(
+                self._fetch_batch, device=self.device, n_prefetch=prefetch
+            )
+            self.stats = self.prefetcher.stats
+
+    def _fetch_batch(self) -> ProcessedBatch:
+        try:
+            self.connection.send(None)
+            tokens = torch.from_numpy(self.connection.recv())
+        except (EOFError, BrokenPipeError) as e:
+            raise RuntimeError(
+                f"The batch server at {self.address} closed the connection, see its output"
+            ) from e
+        if self.device.type == "cuda":
+            tokens = tokens.pin_memory()
+        tokens = tokens.to(self.device, non_blocking=True).long()
+        mask_mask, masked_tokens = self.processor.mask_batch_on_device(
+            tokens, generator=self.generator
+        )
+        return ProcessedBatch.from_arrays(tokens, mask_mask, masked_tokens)
+
+    def get_batch(self) -> ProcessedBatch:
+        if self.prefetcher is not None:
+            batch = self.prefetcher.get_batch()
+        else:
+            start = time.perf_counter()
+            batch = self._fetch_batch()
+            self.stats.n_batches += 1
+            self.stats.n_waits += 1
+            self.stats.wait_time += time.perf_counter() - start
+        self.n_batches += 1
+        return batch
+
+    def state_dict(self) -> dict:
+        return {"batch_server_address": self.address, "n_batches": self.n_batches}
+
+    def pop_wait_stats(self) -> DataWaitStats:
+        stats = DataWaitStats(
+            n_batches=self.stats.n_batches,
+            n_waits=self.stats.n_waits,
+            wait_time=self.stats.wait_time,
+        )
+        self.stats.n_batches = self.stats.n_waits = 0
+        self.stats.wait_time = 0.0
+        return stats
+
+    def close(self):
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+        self.connection.close()
+
+
+if __name__ == "__main__":
+    from lizrd.train.train_utils import make_processed_dataset
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--address", type=str, required=True)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--cutoff", type=int, default=128)
+    parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--tokenized_dataset_path", type=str, default=None)
+    parser.add_argument("--chunk_index_path", type=str, default=None)
+    parser.add_argument("--streaming_dataset_path", type=str, default=None)
+    parser.add_argument("--fast_tokenizer", action="store_true")
+    parser.add_argument("--packing", action="store_true")
+    parser.add_argument("--bucket_batches", type=int, default=0)
+    args = parser.parse_args()
+
+    pdataset = make_processed_dataset(
+        max_total_length=args.cutoff,
+        tokenized_dataset_path=args.tokenized_dataset_path,
+        chunk_index_path=args.chunk_index_path,
+        streaming_dataset_path=args.streaming_dataset_path,
+        use_fast_tokenizer=args.fast_tokenizer,
+        packing=args.packing,
+        bucket_batches=args.bucket_batches,
+    )
+    server = BatchServer(
+        pdataset,
+        address=args.address,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        seed=args.seed,
+    )
+    print(f"Serving batches at {args.address}")
+    server.serve_forever()
@@ -0,0 +1,120 @@
+"""
+One-shot indexing of the chunks WikiBookDataset splits Wikipedia and BookCorpus into,
+which are then read by wikibookdata.IndexedWikiBookDataset.
+The index stores only offsets, the text itself is still read from the HF datasets.
+
+Usage:
+python3 -m lizrd.datasets.chunk_index --output_dir=/path/to/index
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+from lizrd.datasets import wikibookdata
+
+CHUNK_INDEX_DTYPE = np.int64
+
+
+def wiki_chunk_index(
+    dataset_wiki,
+    min_sentence_length,
+    max_documents=None,
+    chunk_length: int = 450,
+    read_size: int = 1000,
+):
+    """Returns a (chunks, 3) array of (document, first char, end char), the same chunks as process_wiki_text."""
+    n_documents = len(dataset_wiki)
+    if max_documents is not None:
+        n_documents = min(n_documents, max_documents)
+    index = []
+    for read_begin in range(0, n_documents, read_size):
+        read_end = min(read_begin + read_size, n_documents)
+        for document, text in enumerate(
+            dataset_wiki[read_begin:read_end]["text"], start=read_begin
+        ):
+            char_begins = np.arange(0, len(text), chunk_length)
+            char_ends = np.minimum(char_begins + chunk_length, len(text))
+            keep = char_ends - char_begins > min_sentence_length
+            index.append(
+                np.stack(
+                    [np.full(keep.sum(), document), char_begins[keep], char_ends[keep]],
+                    axis=1,
+                )
+            )
+    return np.concatenate(index).astype(CHUNK_INDEX_DTYPE)
+
+
+def book_chunk_index(
+    dataset_book,
+    bookcorpus_lines,
+    min_sentence_length,
+    n_lines=None,
+    chunk_length: int = 450,
+    read_size: int = 100,
+):
+    """
+    Returns a (chunks, 2) array of (first line, end line), the same chunks as process_book_text
+    gives for consecutive blocks of bookcorpus_lines lines.
+    """
+    if n_lines is None:
+        n_lines = len(dataset_book)
+    index = []
+    read_lines = read_size * bookcorpus_lines
+    for read_begin in range(0, n_lines, read_lines):
+        lines = dataset_book[read_begin : min(read_begin + read_lines, n_lines)]["text"]
+        for linebegin in range(0, len(lines), bookcorpus_lines):
+            chunk_begin = linebegin
+            chunk_length_so_far = 0
+            for line in range(linebegin, min(linebegin + bookcorpus_lines, len(lines))):
+                sentence_length = len(lines[line])
+                if chunk_length_so_far + sentence_length > chunk_length:
+                    if chunk_length_so_far > min_sentence_length:
+                        index.append((read_begin + chunk_begin, read_begin + line))
+                    chunk_begin = line
+                    chunk_length_so_far = sentence_length
+                else:
+                    chunk_length_so_far += sentence_length
+    return np.array(index, dtype=CHUNK_INDEX_DTYPE).reshape(-1, 2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--max_documents", type=int, default=None)
+    args = parser.parse_args()
+
+    raw_dataset = wikibookdata.WikiBookDataset()
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    wiki_index = wiki_chunk_index(
+        raw_dataset.dataset_wiki, raw_dataset.min_sentence_length, args.max_documents
+    )
+    np.save(os.path.join(args.output_dir, "wiki.npy"), wiki_index)
+    print("wiki chunks:", len(wiki_index))
+
+    wiki_documents = len(raw_dataset.dataset_wiki)
+    book_lines = len(raw_dataset.dataset_book)
+    if args.max_documents is not None:
+        wiki_documents = min(wiki_documents, args.max_documents)
+        book_lines = min(book_lines, args.max_documents * raw_dataset.bookcorpus_lines)
+    book_index = book_chunk_index(
+        raw_dataset.dataset_book,
+        raw_dataset.bookcorpus_lines,
+        raw_dataset.min_sentence_length,
+        book_lines,
+    )
+    np.save(os.path.join(args.output_dir, "book.npy"), book_index)
+    print("book chunks:", len(book_index))
+
+    meta = {
+        "wikipedia_chance": raw_dataset.wikipedia_chance,
+        "bookcorpus_lines": raw_dataset.bookcorpus_lines,
+        "wiki_documents": wiki_documents,
+        "wiki_chunks": len(wiki_index),
+        "book_lines": book_lines,
+        "book_chunks": len(book_index),
+    }
+    with open(os.path.join(args.output_dir, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
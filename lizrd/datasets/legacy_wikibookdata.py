@@ -1,10 +1,12 @@
+import itertools
 import random
 
 import torch
 from datasets import load_dataset
-from transformers import BertTokenizer
 import numpy as np
 
+from lizrd.datasets.wikibookdata import MaskingReplacementConfig, SentenceProcessor
+
 
 # dataset_book = load_dataset("bookcorpus")
 # dataset_wiki = load_dataset("wikipedia", "20220301.en")
@@ -41,6 +43,7 @@ class ProcessedExample(object):
         self.tokens = processor.pad_tokens(self.tokens)
 
         self.special_token_mask = processor.special_token_mask(self.tokens)
+        self.segment_ids = processor.get_segment_ids(np.array(self.tokens))
         self.mask_mask = processor.get_mask_mask(self.special_token_mask)
         self.masked_tokens = processor.mask_tokens(self.tokens, self.mask_mask)
         self.swapped = sentence_pair.swapped
@@ -48,29 +51,54 @@ class ProcessedExample(object):
 
 class ProcessedBatch(object):
     def __init__(self, processed_examples, device):
-        self.device = device
-        self.sen1_tokens = [example.sen1_tokens for example in processed_examples]
-        self.sen2_tokens = [example.sen2_tokens for example in processed_examples]
-
-        self.tokens = self._make_tensor(
-            [example.tokens for example in processed_examples]
-        )
-        self.special_token_mask = self._make_tensor(
-            [example.special_token_mask for example in processed_examples]
-        )
-        self.mask_mask = self._make_tensor(
-            [example.mask_mask for example in processed_examples]
-        )
-        self.masked_tokens = self._make_tensor(
-            [example.masked_tokens for example in processed_examples]
-        )
-        self.swapped = self._make_tensor(
-            [example.swapped for example in processed_examples]
+        self._set_tensors(
+            device=device,
+            sen1_tokens=[example.sen1_tokens for example in processed_examples],
+            sen2_tokens=[example.sen2_tokens for example in processed_examples],
+            tokens=[example.tokens for example in processed_examples],
+            special_token_mask=[
+                example.special_token_mask for example in processed_examples
+            ],
+            segment_ids=[example.segment_ids for example in processed_examples],
+            mask_mask=[example.mask_mask for example in processed_examples],
+            masked_tokens=[example.masked_tokens for example in processed_examples],
+            swapped=[example.swapped for example in processed_examples],
         )
+
+    @classmethod
+    def from_arrays(cls, device, sen1_tokens, sen2_tokens, **arrays):
+        """Builds the batch directly from (batch, seq_len) arrays, see SentencePairProcessor.process_batch."""
+        batch = cls.__new__(cls)
+        batch._set_tensors(device, sen1_tokens, sen2_tokens, **arrays)
+        return batch
+
+    def _set_tensors(
+        self,
+        device,
+        sen1_tokens,
+        sen2_tokens,
+        tokens,
+        special_token_mask,
+        segment_ids,
+        mask_mask,
+        masked_tokens,
+        swapped,
+    ):
+        self.device = device
+        self.sen1_tokens = sen1_tokens
+        self.sen2_tokens = sen2_tokens
+
+        self.tokens = self._make_tensor(tokens)
+        self.special_token_mask = self._make_tensor(special_token_mask)
+        self.segment_ids = self._make_tensor(segment_ids)
+        self.mask_mask = self._make_tensor(mask_mask)
+        self.masked_tokens = self._make_tensor(masked_tokens)
+        self.swapped = self._make_tensor(swapped)
         assert self.tokens.shape == self.masked_tokens.shape
         assert self.tokens.shape == self.special_token_mask.shape
+        assert self.tokens.shape == self.segment_ids.shape
         assert self.tokens.shape == self.mask_mask.shape
-        assert self.swapped.shape == (len(processed_examples),)
+        assert self.swapped.shape == (len(sen1_tokens),)
 
     def _make_tensor(self, matrix):
         matrix = np.array(matrix)
@@ -78,62 +106,78 @@ class ProcessedBatch(object):
         return matrix
 
 
-class SentencePairProcessor(object):
+class SentencePairProcessor(SentenceProcessor):
+    """
+    SentenceProcessor for pairs of sentences with NSP labels.
+    Masking always replaces with [MASK], as it used to here, and is shared with wikibookdata.
+    """
+
     def __init__(
-        self, max_total_length=128, mask_percent=0.15, swap_percent=0.5, device="cpu"
+        self,
+        max_total_length=128,
+        mask_percent=0.15,
+        swap_percent=0.5,
+        device="cpu",
+        rng=None,
+        use_fast_tokenizer=False,
     ):
+        super().__init__(
+            max_total_length=max_total_length,
+            mask_percent=mask_percent,
+            mask_replace_config=MaskingReplacementConfig(
+                replace_with_mask=1.0,
+                replace_with_random=0.0,
+                replace_with_original=0.0,
+            ),
+            rng=rng,
+            use_fast_tokenizer=use_fast_tokenizer,
+        )
         self.device = device
-        self.tokenizer = BertTokenizer.from_pretrained("bert-base-uncased")
-        self.max_total_length = max_total_length
         self.max_sentence_length = (max_total_length - 4) // 2
-        self.mask_token = "[MASK]"
-        self.sep_token = "[SEP]"
-        self.cls_token = "[CLS]"
-        self.pad_token = "[PAD]"
-        self.mask_id = self.tokenizer._convert_token_to_id("[MASK]")
-        self.cls_id = self.tokenizer._convert_token_to_id("[CLS]")
-        self.sep_id = self.tokenizer._convert_token_to_id("[SEP]")
-        self.pad_id = self.tokenizer._convert_token_to_id("[PAD]")
-        self.special_tokens = [
-            self.cls_token,
-            self.sep_token,
-            self.pad_token,
-            self.mask_token,
-        ]
-        self.special_token_ids = [self.cls_id, self.sep_id, self.pad_id, self.mask_id]
-        self.mask_percent = mask_percent
         self.swap_percent = swap_percent  # only for batches!
 
     def process(self, sentence_pair):
         return ProcessedExample(sentence_pair, self)
 
     def process_batch(self, sentence_pairs):
-        for i in range(0, int(len(sentence_pairs) * self.swap_percent), 2):
-            sentence_pairs[i].swap(sentence_pairs[i + 1])
-        random.shuffle(sentence_pairs)
-        return ProcessedBatch(
-            [self.process(sentence_pair) for sentence_pair in sentence_pairs],
-            device=self.device,
+        """
+        Batched equivalent of swapping, shuffling and processing the pairs one by one.
+        Tokenizes all the sentences at once, then joins, pads and masks them as (batch, seq_len) arrays.
+        """
+        n_pairs = len(sentence_pairs)
+        # swap the second sentences of consecutive pairs, for the first swap_percent of the batch
+        first = np.arange(0, int(n_pairs * self.swap_percent), 2)
+        sen2_index = np.arange(n_pairs)
+        sen2_index[first], sen2_index[first + 1] = first + 1, first
+        swapped = np.zeros(n_pairs, dtype=bool)
+        swapped[first] = swapped[first + 1] = True
+
+        order = self.rng.permutation(n_pairs)
+        sen2_index = sen2_index[order]
+        sentence_tokens = self.tokenize_batch(
+            [sentence_pairs[i].sen1 for i in order]
+            + [sentence_pairs[i].sen2 for i in sen2_index]
         )
+        sen1_tokens, sen2_tokens = sentence_tokens[:n_pairs], sentence_tokens[n_pairs:]
 
-    def tokenize_text(self, sentence_text):
-        # note: tokenizer.encode _claims_ to be equivalent. This isn't true.
-        return self.tokenizer.convert_tokens_to_ids(
-            self.tokenizer.tokenize(sentence_text)
+        tokens = self.join_batch(sen1_tokens, sen2_tokens)
+        mask_mask, masked_tokens = self.mask_batch(tokens)
+        return ProcessedBatch.from_arrays(
+            device=self.device,
+            sen1_tokens=sen1_tokens,
+            sen2_tokens=sen2_tokens,
+            tokens=tokens,
+            special_token_mask=self.special_token_mask(tokens),
+            segment_ids=self.get_segment_ids(tokens),
+            mask_mask=mask_mask,
+            masked_tokens=masked_tokens,
+            swapped=swapped[order],
         )
 
-    def special_token_mask(self, sentence_tokens):
-        return np.isin(sentence_tokens, self.special_token_ids)
-
-    def get_mask_mask(self, special_token_mask):
-        mask_mask = np.random.binomial(1, self.mask_percent, len(special_token_mask))
-        mask_mask = mask_mask.astype(bool)
-        mask_mask = np.where(special_token_mask, 0, mask_mask)
-        return mask_mask
-
-    def mask_tokens(self, sentence_tokens, mask_mask):
-        sentence_tokens = np.where(mask_mask, self.mask_id, sentence_tokens)
-        return sentence_tokens
+    def get_segment_ids(self, tokens):
+        """1 from the first token of the second sentence up to its [SEP], 0 elsewhere."""
+        is_sep = tokens == self.sep_id
+        return (np.cumsum(is_sep, axis=-1) - is_sep == 1).astype(np.int64)
 
     def join_sentence_tokens(self, sentence_tokens1, sentence_tokens2):
         if len(sentence_tokens1) > self.max_sentence_length:
@@ -148,12 +192,49 @@ class SentencePairProcessor(object):
             + [self.sep_id]
         )
 
-    def pad_tokens(self, sentence_tokens):
-        if len(sentence_tokens) > self.max_total_length:
-            sentence_tokens = sentence_tokens[: self.max_total_length]
-        return sentence_tokens + [self.pad_id] * (
-            self.max_total_length - len(sentence_tokens)
+    def join_batch(self, batch_tokens1, batch_tokens2):
+        """
+        Batched equivalent of join_sentence_tokens and pad_tokens, into a (batch, max_total_length) array.
+        The tokens of all the sentences are scattered into it at once.
+        """
+        tokens = np.full(
+            (len(batch_tokens1), self.max_total_length), self.pad_id, dtype=np.int64
+        )
+        tokens[:, 0] = self.cls_id
+        length1 = np.array([len(t) for t in batch_tokens1], dtype=np.int64)
+        length1 = np.minimum(length1, self.max_sentence_length)
+        length2 = np.array([len(t) for t in batch_tokens2], dtype=np.int64)
+        length2 = np.minimum(length2, self.max_sentence_length)
+        # the first sentence is truncated from the left, the second one from the right
+        flat1 = np.fromiter(
+            itertools.chain.from_iterable(
+                t[len(t) - n :] for t, n in zip(batch_tokens1, length1)
+            ),
+            dtype=np.int64,
+            count=length1.sum(),
+        )
+        flat2 = np.fromiter(
+            itertools.chain.from_iterable(
+                t[:n] for t, n in zip(batch_tokens2, length2)
+            ),
+            dtype=np.int64,
+            count=length2.sum(),
         )
+        rows = np.arange(len(tokens))
+        rows1, positions1 = _ragged_positions(length1)
+        tokens[rows1, 1 + positions1] = flat1
+        tokens[rows, 1 + length1] = self.sep_id
+        rows2, positions2 = _ragged_positions(length2)
+        tokens[rows2, 2 + length1[rows2] + positions2] = flat2
+        tokens[rows, 2 + length1 + length2] = self.sep_id
+        return tokens
+
+
+def _ragged_positions(lengths):
+    """Row and position within the row of every element of rows with the given lengths, laid out one after another."""
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    positions = np.arange(len(rows)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return rows, positions
 
 
 class WikiBookDataset(object):
@@ -0,0 +1,108 @@
+"""
+One-shot preprocessing of Wikipedia and BookCorpus into memory-mapped token shards,
+which are then read by wikibookdata.TokenizedWikiBookDataset.
+
+Usage:
+python3 -m lizrd.datasets.pretokenize --output_dir=/path/to/shards --num_workers=32
+"""
+import argparse
+import json
+import os
+from multiprocessing import Pool
+
+from lizrd.datasets import wikibookdata
+
+PROCESSOR = None
+
+
+def _init_worker(use_fast_tokenizer):
+    global PROCESSOR
+    PROCESSOR = wikibookdata.SentenceProcessor(use_fast_tokenizer=use_fast_tokenizer)
+
+
+def _tokenize_chunks(chunks):
+    return PROCESSOR.tokenize_batch(chunks)
+
+
+def _wiki_documents(raw_dataset, max_documents):
+    n_documents = len(raw_dataset.dataset_wiki)
+    if max_documents is not None:
+        n_documents = min(n_documents, max_documents)
+    for i in range(n_documents):
+        yield raw_dataset.dataset_wiki[i]["text"]
+
+
+def _book_documents(raw_dataset, max_documents):
+    n_lines = len(raw_dataset.dataset_book)
+    if max_documents is not None:
+        n_lines = min(n_lines, max_documents * raw_dataset.bookcorpus_lines)
+    for linebegin in range(0, n_lines, raw_dataset.bookcorpus_lines):
+        lineend = min(linebegin + raw_dataset.bookcorpus_lines, n_lines)
+        yield raw_dataset.dataset_book[linebegin:lineend]["text"]
+
+
+def write_corpus(pool, documents, process_fn, writer, min_sentence_length):
+    """Chunks, filters and tokenizes documents in the same way as WikiBookDataset, then writes them."""
+    chunked_documents = (
+        [chunk for chunk in process_fn(document) if len(chunk) > min_sentence_length]
+        for document in documents
+    )
+    for tokenized_chunks in pool.imap(_tokenize_chunks, chunked_documents, 64):
+        for sentence_tokens in tokenized_chunks:
+            writer.add(sentence_tokens)
+    writer.close()
+    return writer.n_chunks
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--shard_size", type=int, default=2**26)
+    parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument("--max_documents", type=int, default=None)
+    parser.add_argument("--fast_tokenizer", action="store_true")
+    args = parser.parse_args()
+
+    raw_dataset = wikibookdata.WikiBookDataset()
+    wiki_writer = wikibookdata.TokenShardWriter(
+        os.path.join(args.output_dir, "wiki"), shard_size=args.shard_size
+    )
+    book_writer = wikibookdata.TokenShardWriter(
+        os.path.join(args.output_dir, "book"), shard_size=args.shard_size
+    )
+
+    with Pool(
+        args.num_workers, initializer=_init_worker, initargs=(args.fast_tokenizer,)
+    ) as pool:
+        wiki_chunks = write_corpus(
+            pool,
+            _wiki_documents(raw_dataset, args.max_documents),
+            wikibookdata.process_wiki_text,
+            wiki_writer,
+            raw_dataset.min_sentence_length,
+        )
+        print("wiki chunks:", wiki_chunks)
+        book_chunks = write_corpus(
+            pool,
+            _book_documents(raw_dataset, args.max_documents),
+            wikibookdata.process_book_text,
+            book_writer,
+            raw_dataset.min_sentence_length,
+        )
+        print("book chunks:", book_chunks)
+
+    wiki_documents = len(raw_dataset.dataset_wiki)
+    book_lines = len(raw_dataset.dataset_book)
+    if args.max_documents is not None:
+        wiki_documents = min(wiki_documents, args.max_documents)
+        book_lines = min(book_lines, args.max_documents * raw_dataset.bookcorpus_lines)
+    meta = {
+        "wikipedia_chance": raw_dataset.wikipedia_chance,
+        "bookcorpus_lines": raw_dataset.bookcorpus_lines,
+        "wiki_documents": wiki_documents,
+        "wiki_chunks": wiki_chunks,
+        "book_lines": book_lines,
+        "book_chunks": book_chunks,
+    }
+    with open(os.path.join(args.output_dir, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
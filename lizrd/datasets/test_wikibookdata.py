@@ -1,7 +1,25 @@
-from lizrd.datasets import wikibookdata
-from lizrd.train.train_utils import get_processed_dataset
+from lizrd.datasets import (
+    batch_server,
+    chunk_index,
+    legacy_wikibookdata,
+    wikibookdata,
+)
+from lizrd.train.train_utils import get_fixed_eval_dataset, get_processed_dataset
 from lizrd.support.test_utils import GeneralTestCase, heavy_test, skip_test
+import json
+import multiprocessing
+import os
 import pickle
+import random
+import tempfile
+import threading
+import time
+
+import datasets
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import torch
 
 
 class TestWikibookdata(GeneralTestCase):
@@ -41,3 +59,767 @@ class TestWikibookdata(GeneralTestCase):
         self.assertShape(batch.masked_tokens, (bs, max_len))
         self.assertShape(batch.tokens, (bs, max_len))
         self.assertShape(batch.mask_mask, (bs, max_len))
+
+
+def write_chunks(path, chunks, shard_size=64):
+    writer = wikibookdata.TokenShardWriter(path, shard_size=shard_size)
+    for chunk in chunks:
+        writer.add(chunk)
+    writer.close()
+    return writer
+
+
+def write_tokenized_dataset(path, wiki_chunks, book_chunks):
+    write_chunks(os.path.join(path, "wiki"), wiki_chunks)
+    write_chunks(os.path.join(path, "book"), book_chunks)
+    meta = {
+        "wikipedia_chance": 0.5,
+        "bookcorpus_lines": 100,
+        "wiki_documents": len(wiki_chunks) // 2,
+        "wiki_chunks": len(wiki_chunks),
+        "book_lines": len(book_chunks) * 50,
+        "book_chunks": len(book_chunks),
+    }
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+
+def write_random_tokenized_dataset(path, n_chunks=200, seed=0):
+    """Writes n_chunks random chunks, half of them as wiki and half as book, and returns them."""
+    rng = random.Random(seed)
+    chunks = [
+        [rng.randint(999, 30521) for _ in range(rng.randint(1, 20))]
+        for _ in range(n_chunks)
+    ]
+    write_tokenized_dataset(path, chunks[: n_chunks // 2], chunks[n_chunks // 2 :])
+    return chunks
+
+
+class TestTokenShards(GeneralTestCase):
+    def test_roundtrip(self):
+        rng = random.Random(0)
+        chunks = [
+            [rng.randint(0, 30521) for _ in range(rng.randint(1, 20))]
+            for _ in range(50)
+        ]
+        with tempfile.TemporaryDirectory() as path:
+            writer = write_chunks(path, chunks, shard_size=64)
+            self.assertGreater(writer.n_shards, 1)
+            reader = wikibookdata.TokenShardReader(path)
+            self.assertEqual(len(reader), len(chunks))
+            for i, chunk in enumerate(chunks):
+                self.assertListEqual(reader[i].tolist(), chunk)
+
+    def test_pickled_reader_does_not_copy_shards(self):
+        with tempfile.TemporaryDirectory() as path:
+            write_chunks(path, [[1, 2, 3], [4, 5]])
+            reader = wikibookdata.TokenShardReader(path)
+            self.assertListEqual(reader[1].tolist(), [4, 5])
+            unpickled = pickle.loads(pickle.dumps(reader))
+            self.assertIsNone(unpickled._shards)
+            self.assertListEqual(unpickled[0].tolist(), [1, 2, 3])
+
+    def test_tokenized_dataset(self):
+        with tempfile.TemporaryDirectory() as path:
+            write_tokenized_dataset(path, [[1, 2, 3]] * 4, [[7, 8]] * 4)
+            dataset = wikibookdata.TokenizedWikiBookDataset(path, rng=random.Random(0))
+            self.assertAlmostEqual(dataset.wikipedia_chance, 0.5)
+            examples = [tuple(example.tolist()) for example in dataset.get_batch(100)]
+            self.assertSetEqual(set(examples), {(1, 2, 3), (7, 8)})
+            self.assertIsInstance(dataset.get_example(), np.ndarray)
+
+    def test_tokenized_dataset_stream_state(self):
+        with tempfile.TemporaryDirectory() as path:
+            write_tokenized_dataset(path, [[i] for i in range(20)], [[100]] * 4)
+            dataset = wikibookdata.TokenizedWikiBookDataset(path, rng=random.Random(0))
+            dataset.get_batch(5)
+            state = dataset.get_stream_state(include_buffer=True)
+            expected = [example.tolist() for example in dataset.get_batch(10)]
+            dataset.set_stream_state(state)
+            self.assertListEqual(
+                [example.tolist() for example in dataset.get_batch(10)], expected
+            )
+
+
+class TestChunkIndex(GeneralTestCase):
+    def test_wiki_chunk_index(self):
+        rng = random.Random(0)
+        texts = ["".join(rng.choices("ab ", k=rng.randint(0, 2000))) for _ in range(30)]
+        dataset_wiki = datasets.Dataset.from_dict({"text": texts})
+        index = chunk_index.wiki_chunk_index(dataset_wiki, 40, read_size=7)
+        expected = [
+            chunk
+            for text in texts
+            for chunk in wikibookdata.process_wiki_text(text)
+            if len(chunk) > 40
+        ]
+        chunks = [texts[d][begin:end] for d, begin, end in index.tolist()]
+        self.assertListEqual(chunks, expected)
+
+    def test_book_chunk_index(self):
+        rng = random.Random(0)
+        lines = [
+            "".join(rng.choices("ab ", k=rng.randint(0, 200))) for _ in range(1000)
+        ]
+        dataset_book = datasets.Dataset.from_dict({"text": lines})
+        index = chunk_index.book_chunk_index(dataset_book, 100, 40, read_size=3)
+        expected = [
+            chunk
+            for linebegin in range(0, len(lines), 100)
+            for chunk in wikibookdata.process_book_text(
+                lines[linebegin : linebegin + 100]
+            )
+            if len(chunk) > 40
+        ]
+        chunks = ["".join(lines[begin:end]) for begin, end in index.tolist()]
+        self.assertListEqual(chunks, expected)
+
+
+def write_text_files(path, texts, n_files):
+    """Writes texts as n_files files, cycling through the supported formats."""
+    os.makedirs(path)
+    for i in range(n_files):
+        file_texts = texts[i::n_files]
+        table = pa.table({"text": file_texts})
+        suffix = wikibookdata.STREAMING_FILE_SUFFIXES[i % 3]
+        file_path = os.path.join(path, f"{i:05d}{suffix}")
+        if suffix == ".parquet":
+            pq.write_table(table, file_path, row_group_size=7)
+        elif suffix == ".arrow":
+            with pa.OSFile(file_path, "wb") as sink:
+                with pa.ipc.new_stream(sink, table.schema) as writer:
+                    writer.write_table(table, max_chunksize=7)
+        else:
+            with open(file_path, "w") as f:
+                for text in file_texts:
+                    f.write(json.dumps({"text": text}) + "\n")
+
+
+class TestStreaming(GeneralTestCase):
+    def test_read_text_rows(self):
+        texts = [f"text {i}" for i in range(30)]
+        with tempfile.TemporaryDirectory() as path:
+            write_text_files(os.path.join(path, "texts"), texts, 3)
+            for i, suffix in enumerate(wikibookdata.STREAMING_FILE_SUFFIXES):
+                file_path = os.path.join(path, "texts", f"{i:05d}{suffix}")
+                self.assertListEqual(
+                    list(wikibookdata.read_text_rows(file_path)), texts[i::3]
+                )
+
+    def test_workers_read_disjoint_rows(self):
+        texts = [f"text {i}" for i in range(60)]
+        with tempfile.TemporaryDirectory() as path:
+            for n_files in [2, 6]:
+                files_path = os.path.join(path, str(n_files))
+                write_text_files(files_path, texts, n_files)
+                files = [
+                    os.path.join(files_path, name) for name in os.listdir(files_path)
+                ]
+                rows = []
+                for worker_id in range(3):
+                    stream = wikibookdata.TextFileStream(files)
+                    stream.set_worker(worker_id, 3)
+                    rows += stream.next_rows(20, random.Random(worker_id))
+                self.assertListEqual(sorted(rows), sorted(texts))
+
+    def test_stream_state(self):
+        rng = random.Random(0)
+        texts = [
+            "".join(rng.choices("ab ", k=rng.randint(0, 1000))) for _ in range(200)
+        ]
+        tokenize_batch = lambda texts: [[ord(char) for char in text] for text in texts]
+        with tempfile.TemporaryDirectory() as path:
+            write_text_files(os.path.join(path, "wiki"), texts[:100], 4)
+            write_text_files(os.path.join(path, "book"), texts[100:], 5)
+            for tokenize_batch_fn in [None, tokenize_batch]:
+                get_dataset = lambda seed: wikibookdata.StreamingWikiBookDataset(
+                    path,
+                    rng=random.Random(seed),
+                    tokenize_batch_fn=tokenize_batch_fn,
+                    wikipedia_chance=0.5,
+                    bookcorpus_lines=10,
+                )
+                dataset = get_dataset(1)
+                dataset.buffer_refill_to = 20
+                for _ in range(50):
+                    dataset.get_example()
+                state = pickle.loads(pickle.dumps(dataset.get_stream_state(True)))
+                expected = [list(dataset.get_example()) for _ in range(200)]
+
+                resumed = get_dataset(2)
+                resumed.buffer_refill_to = 20
+                resumed.set_stream_state(state)
+                self.assertListEqual(
+                    [list(resumed.get_example()) for _ in range(200)], expected
+                )
+
+
+class TestTokenBuffer(GeneralTestCase):
+    def test_refill_and_pop(self):
+        rng = random.Random(0)
+        buffer = wikibookdata.TokenBuffer()
+        examples = [list(range(i, 2 * i)) for i in range(1, 20)]
+        buffer.refill(examples[:10], rng)
+        popped = [buffer.pop() for _ in range(4)]
+        buffer.refill(examples[10:], rng)
+        self.assertEqual(len(buffer), 15)
+        popped += [buffer.pop() for _ in range(15)]
+        self.assertEqual(len(buffer), 0)
+        self.assertListEqual(
+            sorted(example.tolist() for example in popped), sorted(examples)
+        )
+
+    def test_state(self):
+        rng = random.Random(0)
+        buffer = wikibookdata.TokenBuffer()
+        buffer.refill([[i] * (i % 5 + 1) for i in range(100)], rng)
+        for _ in range(30):
+            buffer.pop()
+        state = pickle.loads(pickle.dumps(buffer.get_state()))
+        restored = wikibookdata.TokenBuffer()
+        restored.set_state(state, len(buffer))
+        self.assertEqual(len(restored), 70)
+        for _ in range(70):
+            self.assertListEqual(restored.pop().tolist(), buffer.pop().tolist())
+
+
+class TestBatchMasking(GeneralTestCase):
+    def _get_processor(self, seed):
+        return wikibookdata.SentenceProcessor(
+            max_total_length=128, rng=np.random.default_rng(seed)
+        )
+
+    def _get_tokens(self, processor, batch_size=256):
+        rng = np.random.default_rng(0)
+        batch_tokens = [
+            list(rng.integers(999, 30522, size=rng.integers(1, 200)))
+            for _ in range(batch_size)
+        ]
+        return processor.pad_batch(batch_tokens)
+
+    @heavy_test
+    def test_pad_batch(self):
+        processor = self._get_processor(0)
+        tokens = processor.pad_batch([[1000, 1001], list(range(2000, 2200))])
+        self.assertEqual(tokens.shape, (2, 128))
+        self.assertListEqual(tokens[0, :2].tolist(), [1000, 1001])
+        self.assertTrue((tokens[0, 2:] == processor.pad_id).all())
+        self.assertListEqual(tokens[1].tolist(), list(range(2000, 2128)))
+
+    @heavy_test
+    def test_pad_batch_dynamic_length(self):
+        processor = self._get_processor(0)
+        tokens = processor.pad_batch([[1000, 1001], list(range(2000, 2010))], True)
+        self.assertEqual(tokens.shape, (2, 16))
+        self.assertListEqual(tokens[1, :10].tolist(), list(range(2000, 2010)))
+        tokens = processor.pad_batch([[1000], list(range(2000, 2200))], True)
+        self.assertEqual(tokens.shape, (2, 128))
+
+    @heavy_test
+    def test_mask_batch(self):
+        processor = self._get_processor(0)
+        tokens = self._get_tokens(processor)
+        mask_mask, masked_tokens = processor.mask_batch(tokens)
+        mask_mask = mask_mask.astype(bool)
+        special_token_mask = np.isin(tokens, processor.special_token_ids)
+
+        self.assertFalse((mask_mask & special_token_mask).any())
+        self.assertTrue((masked_tokens[~mask_mask] == tokens[~mask_mask]).all())
+        mask_ratio = mask_mask.sum() / (~special_token_mask).sum()
+        self.assertAlmostEqual(mask_ratio, processor.mask_percent, delta=0.01)
+        replaced_with_mask = (masked_tokens[mask_mask] == processor.mask_id).mean()
+        self.assertAlmostEqual(replaced_with_mask, 0.8, delta=0.03)
+        replacements = masked_tokens[mask_mask]
+        self.assertTrue((replacements[replacements != processor.mask_id] >= 999).all())
+
+    @heavy_test
+    def test_mask_batch_seeded(self):
+        tokens = self._get_tokens(self._get_processor(0))
+        mask_mask1, masked_tokens1 = self._get_processor(7).mask_batch(tokens)
+        mask_mask2, masked_tokens2 = self._get_processor(7).mask_batch(tokens)
+        self.assertTrue((mask_mask1 == mask_mask2).all())
+        self.assertTrue((masked_tokens1 == masked_tokens2).all())
+
+    @heavy_test
+    def test_process_batch(self):
+        processor = self._get_processor(0)
+        batch = processor.process_batch([[1000, 1001, 1002]] * 4)
+        self.assertIsInstance(batch, wikibookdata.ProcessedBatch)
+        self.assertShape(batch.tokens, (4, 128))
+        self.assertShape(batch.masked_tokens, (4, 128))
+        self.assertShape(batch.mask_mask, (4, 128))
+
+    @heavy_test
+    def test_mask_batch_on_device(self):
+        processor = self._get_processor(0)
+        tokens = torch.from_numpy(self._get_tokens(processor))
+        generator = torch.Generator().manual_seed(0)
+        mask_mask, masked_tokens = processor.mask_batch_on_device(tokens, generator)
+        mask_mask = mask_mask.bool()
+        special_token_mask = torch.isin(
+            tokens, torch.tensor(processor.special_token_ids)
+        )
+
+        self.assertFalse((mask_mask & special_token_mask).any())
+        self.assertTensorEqual(masked_tokens[~mask_mask], tokens[~mask_mask])
+        mask_ratio = mask_mask.sum() / (~special_token_mask).sum()
+        self.assertAlmostEqual(mask_ratio.item(), processor.mask_percent, delta=0.01)
+        replacements = masked_tokens[mask_mask]
+        replaced_with_mask = (replacements == processor.mask_id).float().mean()
+        self.assertAlmostEqual(replaced_with_mask.item(), 0.8, delta=0.03)
+        self.assertTrue((replacements[replacements != processor.mask_id] >= 999).all())
+
+    @heavy_test
+    def test_mask_batch_on_device_seeded(self):
+        processor = self._get_processor(0)
+        tokens = torch.from_numpy(self._get_tokens(processor))
+        results = [
+            processor.mask_batch_on_device(tokens, torch.Generator().manual_seed(3))
+            for _ in range(2)
+        ]
+        self.assertTensorEqual(results[0][0], results[1][0])
+        self.assertTensorEqual(results[0][1], results[1][1])
+
+
+class TestFastTokenizer(GeneralTestCase):
+    SENTENCES = [
+        "Hello, my name is John.",
+        "The quick brown fox jumps over the lazy dog!",
+        "  leading and trailing whitespace \t\n",
+        "UPPER case, MiXeD case and numbers like 3.14159 or 1,000,000.",
+        "Accents: café, naïve, résumé, Zürich, São Paulo.",
+        "Non-latin scripts: Москва, 東京, ελληνικά, العربية.",
+        "Punctuation (brackets) [square] {curly} \"quotes\" 'single' -- dashes; colons: ...",
+        "Emails and urls: john.doe@example.com, https://en.wikipedia.org/wiki/BERT",
+        "Special-looking tokens [MASK] [SEP] [CLS] [PAD] should be treated as text.",
+        "A" * 150 + " overly long words become unknown tokens",
+        "Control\x00characters\x1fand​zero width",
+        "",
+    ]
+
+    def _set_processors(self):
+        self.slow_processor = wikibookdata.SentenceProcessor()
+        self.fast_processor = wikibookdata.SentenceProcessor(use_fast_tokenizer=True)
+
+    @heavy_test
+    def test_tokenize_text_equivalence(self):
+        self._set_processors()
+        for sentence in self.SENTENCES:
+            self.assertListEqual(
+                self.fast_processor.tokenize_text(sentence),
+                self.slow_processor.tokenize_text(sentence),
+                msg=repr(sentence),
+            )
+
+    @heavy_test
+    def test_tokenize_batch_equivalence(self):
+        self._set_processors()
+        chunks = wikibookdata.process_wiki_text(" ".join(self.SENTENCES * 10), 100)
+        self.assertListEqual(
+            self.fast_processor.tokenize_batch(chunks),
+            self.slow_processor.tokenize_batch(chunks),
+        )
+
+    @heavy_test
+    def test_special_token_ids(self):
+        self._set_processors()
+        self.assertListEqual(
+            self.fast_processor.special_token_ids,
+            self.slow_processor.special_token_ids,
+        )
+
+
+class TestBatchPrefetcher(GeneralTestCase):
+    def test_order_and_stats(self):
+        counter = iter(range(1000))
+        prefetcher = wikibookdata.BatchPrefetcher(
+            lambda: next(counter), device=torch.device("cpu"), n_prefetch=3
+        )
+        self.assertListEqual(
+            [prefetcher.get_batch() for _ in range(10)], list(range(10))
+        )
+        self.assertEqual(prefetcher.stats.n_batches, 10)
+        self.assertLessEqual(prefetcher.stats.n_waits, 10)
+
+    def test_waits_are_counted(self):
+        def slow_fetch():
+            time.sleep(0.05)
+            return 0
+
+        prefetcher = wikibookdata.BatchPrefetcher(
+            slow_fetch, device=torch.device("cpu"), n_prefetch=1
+        )
+        for _ in range(3):
+            prefetcher.get_batch()
+        self.assertGreaterEqual(prefetcher.stats.n_waits, 2)
+        self.assertGreater(prefetcher.stats.wait_time, 0.0)
+        self.assertGreater(prefetcher.stats.waited_fraction, 0.5)
+
+    def test_exception_is_reraised(self):
+        def failing_fetch():
+            raise StopIteration()
+
+        prefetcher = wikibookdata.BatchPrefetcher(
+            failing_fetch, device=torch.device("cpu"), n_prefetch=2
+        )
+        # the thread is gone, so later batches must not block
+        for _ in range(2):
+            with self.assertRaises(StopIteration):
+                prefetcher.get_batch()
+
+    def test_close(self):
+        counter = iter(range(1000))
+        prefetcher = wikibookdata.BatchPrefetcher(
+            lambda: next(counter), device=torch.device("cpu"), n_prefetch=2
+        )
+        prefetcher.get_batch()
+        prefetcher.close()
+        self.assertFalse(prefetcher.thread.is_alive())
+        self.assertTrue(prefetcher.queue.empty())
+
+
+class TestStreamState(GeneralTestCase):
+    def _get_wrapper(
+        self, path, masking, num_workers, stream_state=None, bucket_batches=0
+    ):
+        pdataset = wikibookdata.ProcessedDataset(
+            wikibookdata.TokenizedWikiBookDataset(path),
+            wikibookdata.SentenceProcessor(max_total_length=16),
+            bucket_batches=bucket_batches,
+        )
+        return wikibookdata.ProcessedDatasetWrapper(
+            pdataset,
+            device="cpu",
+            batch_size=4,
+            num_workers=num_workers,
+            seed=5,
+            masking=masking,
+            stream_state=stream_state,
+        )
+
+    @heavy_test
+    def test_close(self):
+        with tempfile.TemporaryDirectory() as path:
+            write_random_tokenized_dataset(path)
+            n_threads = threading.active_count()
+            wrapper = wikibookdata.ProcessedDatasetWrapper(
+                wikibookdata.ProcessedDataset(
+                    wikibookdata.TokenizedWikiBookDataset(path),
+                    wikibookdata.SentenceProcessor(max_total_length=16),
+                ),
+                device="cpu",
+                batch_size=4,
+                num_workers=2,
+                prefetch=2,
+            )
+            wrapper.get_batch()
+            self.assertEqual(len(multiprocessing.active_children()), 2)
+            wrapper.close()
+            self.assertEqual(len(multiprocessing.active_children()), 0)
+            self.assertEqual(threading.active_count(), n_threads)
+
+    @heavy_test
+    def test_resume(self):
+        with tempfile.TemporaryDirectory() as path:
+            write_random_tokenized_dataset(path)
+            for masking in ["example", "vectorized", "device"]:
+                for num_workers in [0, 3]:
+                    wrapper = self._get_wrapper(path, masking, num_workers)
+                    for _ in range(5):
+                        wrapper.get_batch()
+                    stream_state = pickle.loads(pickle.dumps(wrapper.state_dict()))
+                    expected = [wrapper.get_batch() for _ in range(7)]
+
+                    resumed = self._get_wrapper(
+                        path, masking, num_workers, stream_state=stream_state
+                    )
+                    for batch in expected:
+                        resumed_batch = resumed.get_batch()
+                        self.assertTensorEqual(resumed_batch.tokens, batch.tokens)
+                        self.assertTensorEqual(
+                            resumed_batch.masked_tokens, batch.masked_tokens
+                        )
+
+    @heavy_test
+    def test_resume_bucketed(self):
+        with tempfile.TemporaryDirectory() as path:
+            write_random_tokenized_dataset(path)
+            for masking in ["vectorized", "device"]:
+                wrapper = self._get_wrapper(path, masking, 2, bucket_batches=3)
+                for _ in range(5):
+                    wrapper.get_batch()
+                stream_state = pickle.loads(pickle.dumps(wrapper.state_dict()))
+                expected = [wrapper.get_batch() for _ in range(7)]
+
+                resumed = self._get_wrapper(
+                    path, masking, 2, stream_state=stream_state, bucket_batches=3
+                )
+                for batch in expected:
+                    self.assertIn(batch.tokens.shape[1], [8, 16])
+                    self.assertTensorEqual(resumed.get_batch().tokens, batch.tokens)
+
+    @heavy_test
+    def test_mismatched_stream_state(self):
+        with tempfile.TemporaryDirectory() as path:
+            write_tokenized_dataset(path, [[1000, 1001]] * 4, [[1002]] * 4)
+            stream_state = self._get_wrapper(path, "vectorized", 0).state_dict()
+            with self.assertRaises(ValueError):
+                self._get_wrapper(path, "device", 0, stream_state=stream_state)
+            with self.assertRaises(ValueError):
+                self._get_wrapper(
+                    path,
+                    "vectorized",
+                    0,
+                    stream_state={
+                        "batch_server_address": "batches.sock",
+                        "n_batches": 5,
+                    },
+                )
+
+
+class TestPacking(GeneralTestCase):
+    @heavy_test
+    def test_packed_batch(self):
+        with tempfile.TemporaryDirectory() as path:
+            chunks = write_random_tokenized_dataset(path)
+            processor = wikibookdata.SentenceProcessor(max_total_length=32)
+            pdataset = wikibookdata.ProcessedDataset(
+                wikibookdata.TokenizedWikiBookDataset(path), processor, packing=True
+            )
+            batch = pdataset.get_batch(8)
+            self.assertShape(batch.tokens, (8, 32))
+            chunk_set = set(tuple(chunk) for chunk in chunks)
+            n_chunks = 0
+            for row in batch.tokens.tolist():
+                row = [token for token in row if token != processor.pad_id]
+                packed = []
+                for token in row + [processor.sep_id]:
+                    if token == processor.sep_id:
+                        self.assertIn(tuple(packed), chunk_set)
+                        packed = []
+                        n_chunks += 1
+                    else:
+                        packed.append(token)
+            self.assertGreater(n_chunks, 8)
+            self.assertTensorEqual(
+                batch.mask_mask[batch.tokens == processor.sep_id],
+                torch.zeros_like(batch.mask_mask[batch.tokens == processor.sep_id]),
+            )
+
+
+class TestFixedEvalDataset(GeneralTestCase):
+    def test_batches_and_cache(self):
+        tokens = torch.randint(999, 30522, (10, 16), dtype=torch.int16)
+        mask_mask = torch.rand((10, 16)) < 0.15
+        masked_tokens = torch.where(mask_mask, 103, tokens)
+        eval_dataset = wikibookdata.FixedEvalDataset(
+            tokens, mask_mask, masked_tokens, device="cpu", batch_size=4
+        )
+        batches = list(eval_dataset.get_batches())
+        self.assertListEqual([len(batch.tokens) for batch in batches], [4, 4, 2])
+        self.assertTensorEqual(
+            torch.cat([batch.tokens for batch in batches]), tokens.long()
+        )
+        with tempfile.TemporaryDirectory() as path:
+            eval_dataset.save(os.path.join(path, "eval_set.pt"))
+            loaded = wikibookdata.FixedEvalDataset.load(
+                os.path.join(path, "eval_set.pt"), "cpu", batch_size=8
+            )
+        self.assertEqual(len(loaded), 10)
+        self.assertTensorEqual(loaded.mask_mask, mask_mask)
+        self.assertTensorEqual(loaded.masked_tokens, masked_tokens)
+
+    @heavy_test
+    def test_cache_key(self):
+        with tempfile.TemporaryDirectory() as path:
+            write_random_tokenized_dataset(path)
+            cache_dir = os.path.join(path, "cache")
+            get_eval_set = lambda masking, num_workers: get_fixed_eval_dataset(
+                cache_dir=cache_dir,
+                n_batches=2,
+                eval_batch_size=4,
+                batch_size=4,
+                max_total_length=16,
+                mask_percent=0.15,
+                device="cpu",
+                num_workers=num_workers,
+                seed=3,
+                tokenized_dataset_path=path,
+                masking=masking,
+            )
+            eval_set = get_eval_set("example", 0)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            # loading does not depend on the workers used to draw the set
+            loaded = get_eval_set("example", 1)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            self.assertTensorEqual(loaded.tokens, eval_set.tokens)
+            get_eval_set("vectorized", 0)
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+    @heavy_test
+    def test_from_wrapper(self):
+        with tempfile.TemporaryDirectory() as path:
+            write_random_tokenized_dataset(path)
+            get_wrapper = lambda: wikibookdata.ProcessedDatasetWrapper(
+                wikibookdata.ProcessedDataset(
+                    wikibookdata.TokenizedWikiBookDataset(path),
+                    wikibookdata.SentenceProcessor(max_total_length=32),
+                    bucket_batches=2,
+                ),
+                device="cpu",
+                batch_size=4,
+                num_workers=0,
+                seed=7,
+                masking="vectorized",
+            )
+            eval_dataset = wikibookdata.FixedEvalDataset.from_wrapper(
+                get_wrapper(), n_batches=6, batch_size=24
+            )
+            self.assertEqual(len(eval_dataset), 24)
+            wrapper = get_wrapper()
+            for i in range(6):
+                batch = wrapper.get_batch()
+                length = batch.tokens.shape[1]
+                self.assertTensorEqual(
+                    eval_dataset.masked_tokens[4 * i : 4 * i + 4, :length].long(),
+                    batch.masked_tokens,
+                )
+
+
+class TestBatchServer(GeneralTestCase):
+    def test_stream_state_rejected(self):
+        with self.assertRaises(ValueError):
+            get_processed_dataset(
+                batch_size=4,
+                max_total_length=16,
+                mask_percent=0.15,
+                device="cpu",
+                num_workers=0,
+                seed=3,
+                stream_state={"n_batches": 5},
+                batch_server_address="/nonexistent/batches.sock",
+            )
+
+    @heavy_test
+    def test_single_client_matches_wrapper(self):
+        # cleanups run in reverse, so the server and client are closed before the directory is removed
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = directory.name
+        write_random_tokenized_dataset(path)
+        get_pdataset = lambda: wikibookdata.ProcessedDataset(
+            wikibookdata.TokenizedWikiBookDataset(path),
+            wikibookdata.SentenceProcessor(max_total_length=16),
+        )
+        address = os.path.join(path, "batches.sock")
+        server = batch_server.BatchServer(
+            get_pdataset(), address, batch_size=4, num_workers=0, seed=3
+        )
+        self.addCleanup(server.close)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        server.serving.wait()
+
+        processor = wikibookdata.SentenceProcessor(max_total_length=16)
+        with self.assertRaises(ValueError):
+            batch_server.BatchServerClient(address, processor, "cpu", batch_size=8)
+        client = batch_server.BatchServerClient(
+            address, processor, "cpu", batch_size=4, seed=3
+        )
+        self.addCleanup(client.close)
+        wrapper = wikibookdata.ProcessedDatasetWrapper(
+            get_pdataset(),
+            device="cpu",
+            batch_size=4,
+            num_workers=0,
+            seed=3,
+            masking="device",
+        )
+        for _ in range(5):
+            batch = wrapper.get_batch()
+            client_batch = client.get_batch()
+            self.assertTensorEqual(client_batch.tokens, batch.tokens)
+            self.assertTensorEqual(client_batch.masked_tokens, batch.masked_tokens)
+        self.assertEqual(client.pop_wait_stats().n_batches, 5)
+        wrapper.close()
+
+    @heavy_test
+    def test_closes_when_dataloader_fails(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        write_random_tokenized_dataset(directory.name)
+        pdataset = wikibookdata.ProcessedDataset(
+            wikibookdata.TokenizedWikiBookDataset(directory.name),
+            wikibookdata.SentenceProcessor(max_total_length=16),
+        )
+        address = os.path.join(directory.name, "batches.sock")
+        server = batch_server.BatchServer(
+            pdataset, address, batch_size=4, num_workers=0
+        )
+        self.addCleanup(server.close)
+
+        def failing_batches():
+            raise RuntimeError("worker crashed")
+            yield
+
+        server.batches = failing_batches()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        server.serving.wait()
+
+        client = batch_server.BatchServerClient(
+            address,
+            wikibookdata.SentenceProcessor(max_total_length=16),
+            "cpu",
+            batch_size=4,
+        )
+        self.addCleanup(client.close)
+        with self.assertRaises(RuntimeError):
+            client.get_batch()
+        self.assertTrue(server.stopped.wait(timeout=10))
+        self.assertEqual(server.n_clients, 0)
+        self.assertIsNone(server.batches)
+
+
+class TestSentencePairBatch(GeneralTestCase):
+    @heavy_test
+    def test_process_batch(self):
+        processor = legacy_wikibookdata.SentencePairProcessor(
+            max_total_length=32, rng=np.random.default_rng(0)
+        )
+        words = ["one", "two", "three", "four", "five", "six", "seven"]
+        rng = random.Random(0)
+        sentence_pairs = [
+            legacy_wikibookdata.SentencePair(
+                " ".join(rng.choices(words, k=rng.randint(0, 20))),
+                " ".join(rng.choices(words, k=rng.randint(0, 20))),
+            )
+            for _ in range(20)
+        ]
+        batch = processor.process_batch(sentence_pairs)
+
+        self.assertEqual(batch.swapped.sum(), 10)
+        for i in range(20):
+            expected = processor.pad_tokens(
+                processor.join_sentence_tokens(
+                    batch.sen1_tokens[i], batch.sen2_tokens[i]
+                )
+            )
+            self.assertEqual(batch.tokens[i].tolist(), expected)
+            # the per-example path sees the same tokens as the batched one
+            example = processor.process(
+                legacy_wikibookdata.SentencePair(
+                    processor.tokenizer.decode(batch.sen1_tokens[i]),
+                    processor.tokenizer.decode(batch.sen2_tokens[i]),
+                )
+            )
+            self.assertEqual(
+                batch.segment_ids[i].tolist(), example.segment_ids.tolist()
+            )
+        self.assertTensorEqual(
+            batch.special_token_mask,
+            torch.isin(batch.tokens, torch.tensor(processor.special_token_ids)),
+        )
+        self.assertFalse((batch.mask_mask.bool() & batch.special_token_mask).any())
+        self.assertTensorEqual(
+            batch.masked_tokens,
+            torch.where(batch.mask_mask.bool(), processor.mask_id, batch.tokens),
+        )
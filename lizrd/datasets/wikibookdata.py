@@ -1,17 +1,25 @@
+import itertools
+import json
+import os
+import queue
 import random
+import threading
+import time
+from typing import Literal, Optional
 
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import torch
 from datasets import load_dataset
 from torch.utils.data import DataLoader, IterableDataset
-from transformers import BertTokenizer
+from transformers import BertTokenizer, BertTokenizerFast
 from attr import define
 
 
 class ProcessedExample(object):
-    def __init__(self, sentence, processor):
-        self.tokens = processor.tokenize_text(sentence)
-        self.tokens = processor.pad_tokens(self.tokens)
+    def __init__(self, sentence_tokens, processor):
+        self.tokens = processor.pad_tokens(sentence_tokens)
         special_token_mask = processor.special_token_mask(self.tokens)
         self.mask_mask = processor.get_mask_mask(special_token_mask)
         self.masked_tokens = processor.mask_tokens(self.tokens, self.mask_mask)
@@ -19,29 +27,54 @@ class ProcessedExample(object):
 
 class ProcessedBatch(object):
     def __init__(self, processed_examples):
-        self.tokens = self._make_tensor(
-            [example.tokens for example in processed_examples]
-        )
-        self.mask_mask = self._make_tensor(
-            [example.mask_mask for example in processed_examples]
-        )
-        self.masked_tokens = self._make_tensor(
-            [example.masked_tokens for example in processed_examples]
+        self._set_tensors(
+            tokens=[example.tokens for example in processed_examples],
+            mask_mask=[example.mask_mask for example in processed_examples],
+            masked_tokens=[example.masked_tokens for example in processed_examples],
         )
 
+    @classmethod
+    def from_arrays(cls, tokens, mask_mask, masked_tokens):
+        """Builds the batch directly from (batch, seq_len) arrays, e.g. from SentenceProcessor.mask_batch."""
+        batch = cls.__new__(cls)
+        batch._set_tensors(tokens, mask_mask, masked_tokens)
+        return batch
+
+    def _set_tensors(self, tokens, mask_mask, masked_tokens):
+        self.tokens = self._make_tensor(tokens)
+        self.mask_mask = self._make_tensor(mask_mask)
+        self.masked_tokens = self._make_tensor(masked_tokens)
+        # position in the data stream right after this batch, see ProcessedDatasetWrapper.state_dict
+        self.stream_state = None
+
         assert self.tokens.shape == self.masked_tokens.shape
         assert self.tokens.shape == self.mask_mask.shape
 
     def _make_tensor(self, list_of_token_lists):
-        matrix = np.array(list_of_token_lists)
+        if isinstance(list_of_token_lists, torch.Tensor):
+            return list_of_token_lists
+        matrix = np.asarray(list_of_token_lists)
         return torch.from_numpy(matrix)
 
-    def to_(self, device):
-        self.tokens = self.tokens.to(device)
-        self.masked_tokens = self.masked_tokens.to(device)
-        self.mask_mask = self.mask_mask.to(device)
+    def to_(self, device, non_blocking=False):
+        self.tokens = self.tokens.to(device, non_blocking=non_blocking)
+        self.masked_tokens = self.masked_tokens.to(device, non_blocking=non_blocking)
+        self.mask_mask = self.mask_mask.to(device, non_blocking=non_blocking)
+        return self
+
+    def pin_memory(self):
+        # called by DataLoader when pin_memory=True
+        self.tokens = self.tokens.pin_memory()
+        self.masked_tokens = self.masked_tokens.pin_memory()
+        self.mask_mask = self.mask_mask.pin_memory()
         return self
 
+    def record_stream(self, stream):
+        """Marks tensors created on a side CUDA stream as used by `stream`."""
+        self.tokens.record_stream(stream)
+        self.masked_tokens.record_stream(stream)
+        self.mask_mask.record_stream(stream)
+
 
 @define
 class MaskingReplacementConfig:
@@ -64,17 +97,22 @@ class SentenceProcessor(object):
         mask_percent=0.15,
         mask_replace_config=None,
         rng=None,
+        use_fast_tokenizer=False,
     ):
-        self.tokenizer = BertTokenizer.from_pretrained("bert-base-uncased")
+        self.use_fast_tokenizer = use_fast_tokenizer
+        if use_fast_tokenizer:
+            self.tokenizer = BertTokenizerFast.from_pretrained("bert-base-uncased")
+        else:
+            self.tokenizer = BertTokenizer.from_pretrained("bert-base-uncased")
         self.max_total_length = max_total_length
         self.mask_token = "[MASK]"
         self.sep_token = "[SEP]"
         self.cls_token = "[CLS]"
         self.pad_token = "[PAD]"
-        self.mask_id = self.tokenizer._convert_token_to_id("[MASK]")
-        self.cls_id = self.tokenizer._convert_token_to_id("[CLS]")
-        self.sep_id = self.tokenizer._convert_token_to_id("[SEP]")
-        self.pad_id = self.tokenizer._convert_token_to_id("[PAD]")
+        self.mask_id = self.tokenizer.convert_tokens_to_ids("[MASK]")
+        self.cls_id = self.tokenizer.convert_tokens_to_ids("[CLS]")
+        self.sep_id = self.tokenizer.convert_tokens_to_ids("[SEP]")
+        self.pad_id = self.tokenizer.convert_tokens_to_ids("[PAD]")
         self.special_tokens = [
             self.cls_token,
             self.sep_token,
@@ -89,16 +127,41 @@ class SentenceProcessor(object):
         if rng is None:
             rng = np.random.default_rng()
         self.rng = rng
+        # smallest dtype holding every token id, for shipping unmasked tokens between processes
+        if self.tokenizer.vocab_size <= np.iinfo(np.int16).max:
+            self.compact_token_dtype = np.int16
+        else:
+            self.compact_token_dtype = np.int32
 
     def process(self, sentence):
-        return ProcessedExample(sentence, self)
+        return ProcessedExample(self.tokenize_text(sentence), self)
+
+    def process_tokens(self, sentence_tokens):
+        return ProcessedExample(np.asarray(sentence_tokens).tolist(), self)
 
     def tokenize_text(self, sentence_text):
+        if self.use_fast_tokenizer:
+            return self.tokenize_batch([sentence_text])[0]
         # note: tokenizer.encode _claims_ to be equivalent. This isn't true.
         return self.tokenizer.convert_tokens_to_ids(
             self.tokenizer.tokenize(sentence_text)
         )
 
+    def tokenize_batch(self, sentence_texts):
+        """Tokenizes a list of texts, in a single call to the Rust tokenizer if `use_fast_tokenizer` is set."""
+        if not self.use_fast_tokenizer:
+            return [
+                self.tokenize_text(sentence_text) for sentence_text in sentence_texts
+            ]
+        # without special tokens, this gives the same ids as tokenize + convert_tokens_to_ids
+        return self.tokenizer(
+            sentence_texts,
+            add_special_tokens=False,
+            return_attention_mask=False,
+            return_token_type_ids=False,
+            verbose=False,
+        )["input_ids"]
+
     def special_token_mask(self, sentence_tokens):
         return np.isin(sentence_tokens, self.special_token_ids)
 
@@ -140,6 +203,89 @@ class SentenceProcessor(object):
             self.max_total_length - len(sentence_tokens)
         )
 
+    def pad_batch(self, batch_tokens, dynamic_length=False):
+        """
+        Truncates and pads a list of token sequences into a (batch, max_total_length) array.
+        With dynamic_length, pads only up to the longest sequence, rounded up to a multiple of 8.
+        """
+        length = self.max_total_length
+        if dynamic_length:
+            longest = max(len(sentence_tokens) for sentence_tokens in batch_tokens)
+            length = min(length, -(-longest // 8) * 8)
+        tokens = np.full((len(batch_tokens), length), self.pad_id, dtype=np.int64)
+        for row, sentence_tokens in zip(tokens, batch_tokens):
+            sentence_tokens = sentence_tokens[:length]
+            row[: len(sentence_tokens)] = sentence_tokens
+        return tokens
+
+    def mask_batch(self, tokens):
+        """
+        Batched equivalent of get_mask_mask and mask_tokens for a (batch, seq_len) array.
+        Replacements are drawn only for the masked positions.
+        """
+        mask_mask = self.rng.random(tokens.shape) < self.mask_percent
+        mask_mask &= ~np.isin(tokens, self.special_token_ids)
+
+        replacement = tokens[mask_mask]
+        how_to_mask = self.rng.choice(
+            3,
+            size=len(replacement),
+            p=[
+                self.mask_replace_config.replace_with_mask,
+                self.mask_replace_config.replace_with_random,
+                self.mask_replace_config.replace_with_original,
+            ],
+        )
+        replace_with_random = how_to_mask == 1
+        replacement[how_to_mask == 0] = self.mask_id
+        replacement[replace_with_random] = self.get_valid_random_tokens(
+            np.count_nonzero(replace_with_random)
+        )
+
+        masked_tokens = tokens.copy()
+        masked_tokens[mask_mask] = replacement
+        return mask_mask.astype(np.int64), masked_tokens
+
+    def mask_batch_on_device(self, tokens, generator=None):
+        """
+        Torch equivalent of mask_batch, run on the device of `tokens`.
+        Draws for every position instead of only the masked ones, so that nothing synchronizes with the host.
+        """
+        config = self.mask_replace_config
+        special_token_ids = torch.tensor(self.special_token_ids, device=tokens.device)
+        mask_mask = (
+            torch.rand(tokens.shape, generator=generator, device=tokens.device)
+            < self.mask_percent
+        )
+        mask_mask &= ~torch.isin(tokens, special_token_ids)
+
+        how_to_mask = torch.rand(
+            tokens.shape, generator=generator, device=tokens.device
+        )
+        replace_with_mask = mask_mask & (how_to_mask < config.replace_with_mask)
+        replace_with_random = (
+            mask_mask
+            & (how_to_mask >= config.replace_with_mask)
+            & (how_to_mask < config.replace_with_mask + config.replace_with_random)
+        )
+        # see get_valid_random_tokens
+        random_tokens = torch.randint(
+            999,
+            self.tokenizer.vocab_size,
+            tokens.shape,
+            generator=generator,
+            device=tokens.device,
+        )
+
+        masked_tokens = torch.where(replace_with_mask, self.mask_id, tokens)
+        masked_tokens = torch.where(replace_with_random, random_tokens, masked_tokens)
+        return mask_mask.long(), masked_tokens
+
+    def process_batch(self, batch_tokens, dynamic_length=False):
+        tokens = self.pad_batch(batch_tokens, dynamic_length)
+        mask_mask, masked_tokens = self.mask_batch(tokens)
+        return ProcessedBatch.from_arrays(tokens, mask_mask, masked_tokens)
+
 
 def process_wiki_text(document_text, chunk_length: int = 450):
     "splits document into a list of chunks of specified length"
@@ -167,16 +313,90 @@ def process_book_text(document_sentences, chunk_length: int = 450):
     return chunks
 
 
+class TokenBuffer:
+    """
+    Buffer of tokenized examples, kept in a single flat array along with their offsets and lengths.
+    `refill` adds a bulk of new examples to the remaining ones and draws a random permutation of them,
+    in which `pop` returns the examples as slices of the array.
+    Each refill writes a new array, so the slices returned before stay valid.
+    """
+
+    def __init__(self, dtype=np.int32):
+        self.dtype = dtype
+        self.tokens = np.empty(0, dtype)
+        self.offsets = np.empty(0, np.int64)
+        self.lengths = np.empty(0, np.int64)
+        self.order = np.empty(0, np.int64)
+        self.position = 0
+
+    def __len__(self):
+        return len(self.order) - self.position
+
+    def pop(self):
+        index = self.order[self.position]
+        self.position += 1
+        offset = self.offsets[index]
+        return self.tokens[offset : offset + self.lengths[index]]
+
+    def refill(self, new_examples, rng):
+        remaining = self.order[self.position :]
+        new_lengths = np.fromiter(map(len, new_examples), np.int64, len(new_examples))
+        new_tokens = np.fromiter(
+            itertools.chain.from_iterable(new_examples),
+            self.dtype,
+            int(new_lengths.sum()),
+        )
+        remaining_tokens = [
+            self.tokens[offset : offset + length]
+            for offset, length in zip(self.offsets[remaining], self.lengths[remaining])
+        ]
+        self.tokens = np.concatenate(remaining_tokens + [new_tokens])
+        self.lengths = np.concatenate([self.lengths[remaining], new_lengths])
+        self.offsets = np.cumsum(self.lengths) - self.lengths
+        # a permutation of indices is much cheaper than shuffling the examples themselves
+        self.order = np.random.default_rng(rng.getrandbits(64)).permutation(
+            len(self.lengths)
+        )
+        self.position = 0
+
+    def get_state(self):
+        # refill replaces the arrays instead of modifying them, so they can be shared
+        return {
+            "tokens": self.tokens,
+            "offsets": self.offsets,
+            "lengths": self.lengths,
+            "order": self.order,
+        }
+
+    def set_state(self, state, n_remaining):
+        self.tokens = state["tokens"]
+        self.offsets = state["offsets"]
+        self.lengths = state["lengths"]
+        self.order = state["order"]
+        self.position = len(self.order) - n_remaining
+
+
 class WikiBookDataset:
-    def __init__(self, rng=random):
-        self.examples_buffer = []
-        self.dataset_wiki = load_dataset("wikipedia", "20220301.en")["train"]
-        self.dataset_book = load_dataset("bookcorpus")["train"]
+    """
+    Mixes random Wikipedia articles and BookCorpus fragments, split into chunks.
+    If `tokenize_batch_fn` is given, every refill of the buffer is tokenized in bulk with it,
+    examples are kept in a TokenBuffer and returned as arrays of token ids instead of text.
+    """
+
+    def __init__(self, rng=random, tokenize_batch_fn=None):
+        self.examples_buffer = [] if tokenize_batch_fn is None else TokenBuffer()
+        self.refill_count = 0
+        self.tokenize_batch_fn = tokenize_batch_fn
         self.rng = rng
 
         self.buffer_refill_to = 10000
         self.buffer_refill_from = 0
         self.min_sentence_length = 40
+        self._load_datasets()
+
+    def _load_datasets(self):
+        self.dataset_wiki = load_dataset("wikipedia", "20220301.en")["train"]
+        self.dataset_book = load_dataset("bookcorpus")["train"]
         self.bookcorpus_chance = 0.5
         self.bookcorpus_lines = len(self.dataset_book) // len(self.dataset_wiki) + 1
         self.bookcorpus_chance = self.bookcorpus_chance / 100 * self.bookcorpus_lines
@@ -195,10 +415,44 @@ class WikiBookDataset:
         batch = [self.get_example() for _ in range(batch_size)]
         return batch
 
+    @property
+    def yields_tokens(self):
+        return self.tokenize_batch_fn is not None
+
     def _refill_buffer(self):
-        while len(self.examples_buffer) <= self.buffer_refill_to:
-            self._add_examples(self._get_random_document())
-        self.rng.shuffle(self.examples_buffer)
+        new_examples = []
+        while len(self.examples_buffer) + len(new_examples) <= self.buffer_refill_to:
+            new_examples += self._filter_examples(self._get_random_document())
+        if self.yields_tokens:
+            self.examples_buffer.refill(self.tokenize_batch_fn(new_examples), self.rng)
+        else:
+            self.examples_buffer += new_examples
+            self.rng.shuffle(self.examples_buffer)
+        self.refill_count += 1
+
+    def get_stream_state(self, include_buffer: bool):
+        """
+        Examples are only popped from the buffer between refills, so the buffer contents
+        only need to be included once per refill; afterwards `buffer_len` is enough.
+        """
+        state = {
+            "rng": self.rng.getstate(),
+            "refill_count": self.refill_count,
+            "buffer_len": len(self.examples_buffer),
+        }
+        if include_buffer and self.yields_tokens:
+            state["buffer"] = self.examples_buffer.get_state()
+        elif include_buffer:
+            state["buffer"] = list(self.examples_buffer)
+        return state
+
+    def set_stream_state(self, state):
+        self.rng.setstate(state["rng"])
+        self.refill_count = state["refill_count"]
+        if self.yields_tokens:
+            self.examples_buffer.set_state(state["buffer"], state["buffer_len"])
+        else:
+            self.examples_buffer = list(state["buffer"][: state["buffer_len"]])
 
     def _get_random_document(self):
         if self.rng.random() < self.wikipedia_chance:
@@ -219,47 +473,655 @@ class WikiBookDataset:
             assert isinstance(documents_sentences[0], str)
         return documents_sentences
 
-    def _add_examples(self, param):
-        """This version simply filters out all sentences that are too short, then adds all remaining sentences to the buffer."""
+    def _filter_examples(self, document_sentences):
+        """This version simply filters out all sentences that are too short."""
+        lengths = np.fromiter(
+            map(len, document_sentences), np.int64, len(document_sentences)
+        )
+        return [
+            document_sentences[i]
+            for i in np.flatnonzero(lengths > self.min_sentence_length)
+        ]
+
+
+class IndexedWikiBookDataset(WikiBookDataset):
+    """
+    WikiBookDataset reading the chunks listed in an index built by `lizrd.datasets.chunk_index`.
+    Each draw reads `read_size` consecutive chunks of one corpus with a single slice of the HF dataset,
+    and after `set_worker`, only from the worker's own range of the index, disjoint from other workers.
+    The index is memory-mapped lazily, so that DataLoader workers share it instead of copying it.
+    """
+
+    def __init__(self, index_path, rng=random, tokenize_batch_fn=None, read_size=64):
+        super().__init__(rng=rng, tokenize_batch_fn=tokenize_batch_fn)
+        self.index_path = index_path
+        self.read_size = read_size
+        self.wikipedia_chance = chunk_level_wikipedia_chance(index_path)
+        print("wikipedia_chance (per chunk):", self.wikipedia_chance)
+        self._open()
+        self.n_chunks = {"wiki": len(self._wiki_index), "book": len(self._book_index)}
+        self.set_worker(0, 1)
+
+    def _open(self):
+        self._wiki_index = np.load(
+            os.path.join(self.index_path, "wiki.npy"), mmap_mode="r"
+        )
+        self._book_index = np.load(
+            os.path.join(self.index_path, "book.npy"), mmap_mode="r"
+        )
+
+    def set_worker(self, worker_id, num_workers):
+        """Restricts reads to the `worker_id`-th of `num_workers` equal ranges of both indices."""
+        self.worker_ranges = {}
+        for name, n_chunks in self.n_chunks.items():
+            begin = n_chunks * worker_id // num_workers
+            end = n_chunks * (worker_id + 1) // num_workers
+            assert begin < end, f"Too few {name} chunks for {num_workers} workers"
+            self.worker_ranges[name] = (begin, end)
+
+    def _get_random_range(self, name):
+        begin, end = self.worker_ranges[name]
+        first = self.rng.randint(begin, max(begin, end - self.read_size))
+        return first, min(first + self.read_size, end)
+
+    def _get_random_document(self):
+        if self._wiki_index is None:
+            self._open()
+        if self.rng.random() < self.wikipedia_chance:
+            first, last = self._get_random_range("wiki")
+            chunks = np.asarray(self._wiki_index[first:last])
+            first_document = int(chunks[0, 0])
+            texts = self.dataset_wiki[first_document : int(chunks[-1, 0]) + 1]["text"]
+            return [
+                texts[document - first_document][char_begin:char_end]
+                for document, char_begin, char_end in chunks.tolist()
+            ]
+        first, last = self._get_random_range("book")
+        chunks = np.asarray(self._book_index[first:last])
+        first_line = int(chunks[0, 0])
+        lines = self.dataset_book[first_line : int(chunks[-1, 1])]["text"]
+        return [
+            "".join(lines[line_begin - first_line : line_end - first_line])
+            for line_begin, line_end in chunks.tolist()
+        ]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_wiki_index"] = None
+        state["_book_index"] = None
+        return state
+
+
+STREAMING_FILE_SUFFIXES = (".arrow", ".parquet", ".jsonl")
+
+
+def read_text_rows(path, batch_size: int = 1024):
+    """Lazily yields the "text" column of a local .arrow, .parquet or .jsonl file."""
+    if path.endswith(".parquet"):
+        parquet_file = pq.ParquetFile(path)
+        for batch in parquet_file.iter_batches(batch_size, columns=["text"]):
+            yield from batch.column(0).to_pylist()
+    elif path.endswith(".arrow"):
+        with pa.memory_map(path) as source:
+            try:
+                batches = pa.ipc.open_stream(source)
+            except pa.ArrowInvalid:
+                reader = pa.ipc.open_file(source)
+                batches = (
+                    reader.get_batch(i) for i in range(reader.num_record_batches)
+                )
+            for batch in batches:
+                yield from batch.column("text").to_pylist()
+    else:
+        with open(path) as f:
+            for line in f:
+                yield json.loads(line)["text"]
+
+
+class TextFileStream:
+    """
+    Endless stream of rows read lazily from local files, see read_text_rows.
+    Files are read one after another, in an order reshuffled on every pass over them.
+    """
+
+    def __init__(self, files):
+        assert len(files) > 0, "No files to stream"
+        self.files = sorted(files)
+        self.set_worker(0, 1)
+
+    def set_worker(self, worker_id, num_workers):
+        """
+        Restricts the stream to the `worker_id`-th of `num_workers` parts of the files,
+        or, if there are fewer files than workers, to every `num_workers`-th row.
+        """
+        if len(self.files) >= num_workers:
+            self.worker_files = self.files[worker_id::num_workers]
+            self.row_shard = (0, 1)
+        else:
+            self.worker_files = self.files
+            self.row_shard = (worker_id, num_workers)
+        self.set_state({"order": [], "file_pos": 0, "rows_read": 0})
+
+    def get_state(self):
+        return {
+            "order": list(self.order),
+            "file_pos": self.file_pos,
+            "rows_read": self.rows_read,
+        }
+
+    def set_state(self, state):
+        self.order = list(state["order"])
+        self.file_pos = state["file_pos"]
+        self.rows_read = state["rows_read"]
+        self._rows = None
+
+    def next_rows(self, n_rows, rng):
+        rows = []
+        shard_id, n_shards = self.row_shard
+        while len(rows) < n_rows:
+            if self._rows is None:
+                if self.file_pos >= len(self.order):
+                    self.order = list(range(len(self.worker_files)))
+                    rng.shuffle(self.order)
+                    self.file_pos = 0
+                path = self.worker_files[self.order[self.file_pos]]
+                self._rows = itertools.islice(
+                    read_text_rows(path), self.rows_read, None
+                )
+            row = next(self._rows, None)
+            if row is None:
+                self._rows = None
+                self.file_pos += 1
+                self.rows_read = 0
+                continue
+            if self.rows_read % n_shards == shard_id:
+                rows.append(row)
+            self.rows_read += 1
+        return rows
+
+
+class StreamingWikiBookDataset(WikiBookDataset):
+    """
+    WikiBookDataset reading local copies of the datasets lazily instead of loading them up front.
+    `path` should contain `wiki` and `book` directories of .arrow, .parquet or .jsonl files with a "text" column,
+    e.g. the files of the HF datasets. Documents come in order from shuffled files, then get shuffled
+    in the examples buffer. Each worker reads its own files, see TextFileStream.set_worker.
+    The defaults of `wikipedia_chance` and `bookcorpus_lines` are what WikiBookDataset computes.
+    """
+
+    def __init__(
+        self,
+        path,
+        rng=random,
+        tokenize_batch_fn=None,
+        wikipedia_chance: float = 0.94,
+        bookcorpus_lines: int = 100,
+    ):
+        self.path = path
+        self.wikipedia_chance = wikipedia_chance
+        self.bookcorpus_lines = bookcorpus_lines
+        super().__init__(rng=rng, tokenize_batch_fn=tokenize_batch_fn)
+
+    def _load_datasets(self):
+        streams = {}
+        for name in ["wiki", "book"]:
+            corpus_path = os.path.join(self.path, name)
+            streams[name] = TextFileStream(
+                [
+                    os.path.join(corpus_path, file_name)
+                    for file_name in os.listdir(corpus_path)
+                    if file_name.endswith(STREAMING_FILE_SUFFIXES)
+                ]
+            )
+        self.wiki_stream = streams["wiki"]
+        self.book_stream = streams["book"]
+
+    def set_worker(self, worker_id, num_workers):
+        self.wiki_stream.set_worker(worker_id, num_workers)
+        self.book_stream.set_worker(worker_id, num_workers)
+
+    def get_stream_state(self, include_buffer: bool):
+        state = super().get_stream_state(include_buffer)
+        state["wiki_stream"] = self.wiki_stream.get_state()
+        state["book_stream"] = self.book_stream.get_state()
+        return state
+
+    def set_stream_state(self, state):
+        super().set_stream_state(state)
+        self.wiki_stream.set_state(state["wiki_stream"])
+        self.book_stream.set_state(state["book_stream"])
+
+    def _get_random_document(self):
+        if self.rng.random() < self.wikipedia_chance:
+            return process_wiki_text(self.wiki_stream.next_rows(1, self.rng)[0])
+        return process_book_text(
+            self.book_stream.next_rows(self.bookcorpus_lines, self.rng)
+        )
+
+
+TOKEN_SHARD_DTYPE = np.uint16  # bert-base-uncased vocabulary fits in 16 bits
+
+
+class TokenShardWriter:
+    """
+    Writes tokenized chunks into flat `TOKEN_SHARD_DTYPE` shards of at most `shard_size` tokens.
+    Shard `shard_{i}.bin` holds concatenated chunks, `shard_{i}.idx.npy` holds offsets of consecutive chunks.
+    Chunks never cross shard boundaries; chunks longer than `shard_size` are truncated.
+    """
+
+    def __init__(self, output_dir, shard_size: int = 2**26):
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.n_shards = 0
+        self.n_chunks = 0
+        self._buffer = np.empty(shard_size, dtype=TOKEN_SHARD_DTYPE)
+        self._offsets = [0]
+
+    def add(self, sentence_tokens):
+        sentence_tokens = sentence_tokens[: self.shard_size]
+        begin = self._offsets[-1]
+        if begin + len(sentence_tokens) > self.shard_size:
+            self._flush()
+            begin = 0
+        end = begin + len(sentence_tokens)
+        self._buffer[begin:end] = sentence_tokens
+        self._offsets.append(end)
+        self.n_chunks += 1
+
+    def close(self):
+        if len(self._offsets) > 1:
+            self._flush()
+
+    def _flush(self):
+        name = os.path.join(self.output_dir, f"shard_{self.n_shards:05d}")
+        self._buffer[: self._offsets[-1]].tofile(f"{name}.bin")
+        np.save(f"{name}.idx.npy", np.array(self._offsets, dtype=np.int64))
+        self.n_shards += 1
+        self._offsets = [0]
+
+
+class TokenShardReader:
+    """
+    Random access to chunks written by TokenShardWriter. Shards are memory-mapped lazily, on first access,
+    so that pickling the reader into DataLoader workers doesn't copy the data.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.shard_names = sorted(
+            name[: -len(".bin")] for name in os.listdir(path) if name.endswith(".bin")
+        )
+        assert len(self.shard_names) > 0, f"No token shards found in {path}"
+        chunks_per_shard = [
+            len(np.load(self._shard_path(name, ".idx.npy"), mmap_mode="r")) - 1
+            for name in self.shard_names
+        ]
+        self.cumulative_chunks = np.cumsum(chunks_per_shard)
+        self._shards = None
+        self._offsets = None
+
+    def _shard_path(self, name, suffix):
+        return os.path.join(self.path, f"{name}{suffix}")
 
-        document_sentences = [
-            sentence for sentence in param if len(sentence) > self.min_sentence_length
+    def _open(self):
+        self._shards = [
+            np.memmap(self._shard_path(name, ".bin"), dtype=TOKEN_SHARD_DTYPE, mode="r")
+            for name in self.shard_names
         ]
-        self.examples_buffer += document_sentences
+        self._offsets = [
+            np.load(self._shard_path(name, ".idx.npy"), mmap_mode="r")
+            for name in self.shard_names
+        ]
+
+    def __len__(self):
+        return int(self.cumulative_chunks[-1])
+
+    def __getitem__(self, index):
+        if self._shards is None:
+            self._open()
+        shard = int(np.searchsorted(self.cumulative_chunks, index, side="right"))
+        if shard > 0:
+            index -= int(self.cumulative_chunks[shard - 1])
+        offsets = self._offsets[shard]
+        return self._shards[shard][offsets[index] : offsets[index + 1]]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_shards"] = None
+        state["_offsets"] = None
+        return state
+
+
+def chunk_level_wikipedia_chance(path):
+    """
+    WikiBookDataset draws whole documents, so convert its document-level probability,
+    saved in meta.json in `path`, into the chunk-level probability it effectively produces.
+    """
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    wiki_chunks_per_draw = meta["wiki_chunks"] / meta["wiki_documents"]
+    book_chunks_per_draw = (
+        meta["book_chunks"] / meta["book_lines"] * meta["bookcorpus_lines"]
+    )
+    wiki_weight = meta["wikipedia_chance"] * wiki_chunks_per_draw
+    book_weight = (1.0 - meta["wikipedia_chance"]) * book_chunks_per_draw
+    return wiki_weight / (wiki_weight + book_weight)
+
+
+class TokenizedWikiBookDataset:
+    """
+    Serves chunks pre-tokenized by `lizrd.datasets.pretokenize` straight from memory-mapped shards.
+    `get_example` returns a view of the shard, so no tokenization happens during training.
+    """
+
+    def __init__(self, path, rng=random):
+        self.dataset_wiki = TokenShardReader(os.path.join(path, "wiki"))
+        self.dataset_book = TokenShardReader(os.path.join(path, "book"))
+        self.rng = rng
+        self.yields_tokens = True
+
+        self.wikipedia_chance = chunk_level_wikipedia_chance(path)
+        print("wikipedia_chance (per chunk):", self.wikipedia_chance)
+
+    def get_example(self):
+        if self.rng.random() < self.wikipedia_chance:
+            dataset = self.dataset_wiki
+        else:
+            dataset = self.dataset_book
+        return dataset[self.rng.randint(0, len(dataset) - 1)]
+
+    def get_stream_state(self, include_buffer: bool):
+        del include_buffer  # there is no buffer
+        return {"rng": self.rng.getstate(), "refill_count": None}
+
+    def set_stream_state(self, state):
+        self.rng.setstate(state["rng"])
+
+    def get_batch(self, batch_size):
+        batch = [self.get_example() for _ in range(batch_size)]
+        return batch
 
 
 class ProcessedDataset:
-    def __init__(self, dataset, processor):
-        assert isinstance(dataset, WikiBookDataset)
+    def __init__(self, dataset, processor, packing=False, bucket_batches=0):
+        assert isinstance(dataset, (WikiBookDataset, TokenizedWikiBookDataset))
         self.dataset = dataset
         assert isinstance(processor, SentenceProcessor)
         self.processor = processor
+        # whether to pack several chunks into each row of a batch, separated by [SEP]
+        self.packing = packing
+        # if positive, that many batches are drawn at once and split into buckets of similar length,
+        # and each batch is padded only to its longest sequence
+        assert not (packing and bucket_batches), "packed rows are already full"
+        self.bucket_batches = bucket_batches
+        self.buckets = []
+        self.bucket_fill_count = 0
+
+    @property
+    def dynamic_length(self):
+        return self.bucket_batches > 0
+
+    def get_stream_state(self, include_buffer: bool):
+        """Like the dataset's stream state; the buckets are included when include_buffer is set."""
+        state = self.dataset.get_stream_state(include_buffer)
+        if self.bucket_batches:
+            state["buckets_len"] = len(self.buckets)
+            if include_buffer:
+                state["buckets"] = list(self.buckets)
+        return state
+
+    def set_stream_state(self, state):
+        self.dataset.set_stream_state(state)
+        if self.bucket_batches:
+            self.buckets = list(state["buckets"][: state["buckets_len"]])
 
     def get_example(self):
         example = self.dataset.get_example()
+        if self.dataset.yields_tokens:
+            return self.processor.process_tokens(example)
         processed_example = self.processor.process(example)
         return processed_example
 
+    def _get_packed_batch(self, batch_size):
+        """
+        Greedily packs consecutive chunks into batch_size rows of at most max_total_length tokens.
+        The chunk which does not fit into the last row is dropped, so that no state is kept between batches.
+        """
+        max_length = self.processor.max_total_length
+        rows = []
+        row = []
+        while len(rows) < batch_size:
+            example = self.dataset.get_example()
+            if not self.dataset.yields_tokens:
+                example = self.processor.tokenize_text(example)
+            example = np.asarray(example[:max_length]).tolist()
+            if row and len(row) + 1 + len(example) > max_length:
+                rows.append(row)
+                row = []
+            if row:
+                row.append(self.processor.sep_id)
+            row += example
+            if len(row) == max_length:
+                rows.append(row)
+                row = []
+        return rows
+
+    def _fill_buckets(self, batch_size):
+        """Draws bucket_batches batches, sorts them by length and splits them back, in random order."""
+        examples = self._get_examples(batch_size * self.bucket_batches)
+        examples = sorted(
+            (np.asarray(example).tolist() for example in examples), key=len
+        )
+        self.buckets = [
+            examples[i : i + batch_size] for i in range(0, len(examples), batch_size)
+        ]
+        self.dataset.rng.shuffle(self.buckets)
+        self.bucket_fill_count += 1
+
+    def _get_examples(self, batch_size):
+        examples = self.dataset.get_batch(batch_size)
+        if not self.dataset.yields_tokens:
+            examples = self.processor.tokenize_batch(examples)
+        return examples
+
+    def _get_tokenized_batch(self, batch_size):
+        if self.packing:
+            return self._get_packed_batch(batch_size)
+        if self.bucket_batches:
+            if not self.buckets:
+                self._fill_buckets(batch_size)
+            return self.buckets.pop()
+        return self._get_examples(batch_size)
+
+    def get_batch(self, batch_size):
+        return self.processor.process_batch(
+            self._get_tokenized_batch(batch_size), self.dynamic_length
+        )
+
+    def get_token_batch(self, batch_size):
+        """Returns padded, unmasked tokens in the most compact dtype, to be masked on the target device."""
+        tokens = self.processor.pad_batch(
+            self._get_tokenized_batch(batch_size), self.dynamic_length
+        )
+        return torch.from_numpy(tokens.astype(self.processor.compact_token_dtype))
+
+
+MaskingMode = Literal["example", "vectorized", "device"]
+
+
+class WorkerStreamState:
+    """
+    Position of a single worker in the data stream, sent by the worker along with the batches it produces.
+    Wrapping the state dict keeps DataLoader from traversing it when pinning memory.
+    """
+
+    def __init__(self, state: dict):
+        self.state = state
+
 
 class ParallelCompatibleDataset(IterableDataset):
-    def __init__(self, dataset: ProcessedDataset, batch_size: int, seed: int = 42):
+    """
+    Yields `(item, WorkerStreamState or None)` pairs, where the state describes the worker right after
+    the batch that the item completes. Workers are identified by logical ids: the DataLoader takes batches
+    from workers in turns, starting from the worker with physical id 0, which is given logical id `first_worker`.
+    Workers listed in `worker_states` resume from there instead of starting from their seed.
+    """
+
+    def __init__(
+        self,
+        dataset: ProcessedDataset,
+        batch_size: int,
+        seed: int = 42,
+        masking: MaskingMode = "example",
+        first_worker: int = 0,
+        worker_states: Optional[dict] = None,
+    ):
         super().__init__()
         self.dataset = dataset
         self.seed = seed
         self.batch_size = batch_size
+        self.masking = masking
+        self.first_worker = first_worker
+        self.worker_states = worker_states or {}
 
-    def __iter__(self):
+    def _get_worker_id(self):
         worker_info = torch.utils.data.get_worker_info()
         if worker_info is None:
-            seed = self.seed
-        else:
-            seed = self.seed + worker_info.id
+            return 0
+        return (worker_info.id + self.first_worker) % worker_info.num_workers
+
+    def _get_worker_state(self, worker_id):
+        refill_count = (
+            getattr(self.dataset.dataset, "refill_count", None),
+            self.dataset.bucket_fill_count,
+        )
+        include_buffer = refill_count != self._sent_refill_count
+        self._sent_refill_count = refill_count
+        state = self.dataset.get_stream_state(include_buffer)
+        state["worker_id"] = worker_id
+        state["np_rng"] = self.np_rng.bit_generator.state
+        return WorkerStreamState(state)
+
+    def _set_worker_state(self, state):
+        self.dataset.set_stream_state(state)
+        self.np_rng.bit_generator.state = state["np_rng"]
+
+    def __iter__(self):
+        worker_id = self._get_worker_id()
+        seed = self.seed + worker_id
         self.rng = random.Random(seed)
         self.np_rng = np.random.default_rng(seed)
         self.dataset.dataset.rng = self.rng
         self.dataset.processor.rng = self.np_rng
+        if hasattr(self.dataset.dataset, "set_worker"):
+            worker_info = torch.utils.data.get_worker_info()
+            num_workers = 1 if worker_info is None else worker_info.num_workers
+            self.dataset.dataset.set_worker(worker_id, num_workers)
+        if worker_id in self.worker_states:
+            self._set_worker_state(self.worker_states[worker_id])
+        self._sent_refill_count = None
+        n_examples = 0
         while True:
-            yield self.dataset.get_example()
+            if self.masking == "example":
+                item = self.dataset.get_example()
+                n_examples += 1
+                if n_examples % self.batch_size != 0:
+                    yield item, None
+                    continue
+            elif self.masking == "vectorized":
+                item = self.dataset.get_batch(self.batch_size)
+            else:
+                item = self.dataset.get_token_batch(self.batch_size)
+            yield item, self._get_worker_state(worker_id)
+
+
+@define
+class DataWaitStats:
+    n_batches: int = 0
+    n_waits: int = 0
+    wait_time: float = 0.0
+
+    @property
+    def waited_fraction(self):
+        return self.n_waits / max(self.n_batches, 1)
+
+
+class BatchPrefetcher:
+    """
+    Keeps up to `n_prefetch` batches in flight, fetched by `fetch_fn` in a background thread.
+    On CUDA, `fetch_fn` runs on a side stream, so host-to-device copies overlap with compute.
+    Counts how often `get_batch` actually had to wait for data.
+    If `fetch_fn` raises, the thread stops and every later `get_batch` raises the same exception.
+    Call `close` to stop the thread.
+    """
+
+    def __init__(self, fetch_fn, device: torch.device, n_prefetch: int = 2):
+        assert n_prefetch > 0
+        self.fetch_fn = fetch_fn
+        self.device = device
+        self.stats = DataWaitStats()
+        self.queue = queue.Queue(maxsize=n_prefetch)
+        self.stream = None
+        if device.type == "cuda":
+            self.stream = torch.cuda.Stream(device)
+        self.error = None
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._prefetch_loop, daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        # gives up once close() is called, instead of blocking on a full queue forever
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _prefetch_loop(self):
+        try:
+            while not self.stop_event.is_set():
+                if self.stream is None:
+                    self._put((self.fetch_fn(), None))
+                    continue
+                with torch.cuda.stream(self.stream):
+                    batch = self.fetch_fn()
+                    ready = torch.cuda.Event()
+                    ready.record(self.stream)
+                self._put((batch, ready))
+        except Exception as e:
+            self.error = e
+            self._put((e, None))
+
+    def get_batch(self) -> ProcessedBatch:
+        try:
+            batch, ready = self.queue.get_nowait()
+        except queue.Empty:
+            if self.error is not None:
+                raise self.error
+            start = time.perf_counter()
+            batch, ready = self.queue.get()
+            self.stats.n_waits += 1
+            self.stats.wait_time += time.perf_counter() - start
+        self.stats.n_batches += 1
+        if isinstance(batch, Exception):
+            raise batch
+        if ready is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_event(ready)
+            batch.record_stream(current_stream)
+        return batch
+
+    def close(self):
+        self.stop_event.set()
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        while not self.queue.empty():
+            self.queue.get_nowait()
 
 
 class ProcessedDatasetWrapper:
@@ -267,11 +1129,25 @@ class ProcessedDatasetWrapper:
     This class is a wrapper around a ProcessedDataset that provides a get_batch() method that returns a batch of processed examples.
     Takes care of seeding the rng, collating the examples into a batch, and moving the batch to the correct device.
     Allows multiple workers to be used.
+    `masking` decides where the examples are masked:
+    * "example" - each sentence is masked separately, as a ProcessedExample,
+    * "vectorized" - workers pad and mask whole batches at once (see SentenceProcessor.mask_batch),
+    * "device" - workers ship only compact unmasked tokens in pinned memory, which are moved to `device`
+      with a single non-blocking copy and masked there (see SentenceProcessor.mask_batch_on_device).
+    With `pdataset.packing`, rows hold several chunks separated by [SEP], which needs batch-level masking
+    (see bert.get_packed_attention_mask to keep the chunks from attending to each other).
+    With `pdataset.bucket_batches`, batches hold examples of similar length and are only padded
+    to their longest example, which also needs batch-level masking.
+    With `prefetch` > 0, that many batches are prepared ahead of time by a BatchPrefetcher.
+    Call `close` on wrappers that are not needed anymore, to stop their workers.
+    `pop_wait_stats` tells how often `get_batch` had to wait for data.
     To make `get_batch` return the same sequence of batches, keep the seed, batch_size and num_workers unchanged.
+    To continue the sequence after a restart, pass `state_dict()` saved before as `stream_state`.
     """
 
-    def _collate_fn(self, batch) -> ProcessedBatch:
-        return ProcessedBatch(batch)
+    def _collate_fn(self, batch):
+        examples = [example for example, _ in batch]
+        return ProcessedBatch(examples), batch[-1][1]
 
     def __init__(
         self,
@@ -280,18 +1156,225 @@ class ProcessedDatasetWrapper:
         batch_size: int,
         num_workers: int = 8,
         seed: int = 42,
+        masking: MaskingMode = "example",
+        prefetch: int = 0,
+        stream_state: Optional[dict] = None,
     ):
+        assert masking in ["example", "vectorized", "device"]
+        assert not (
+            pdataset.packing and masking == "example"
+        ), "packing needs vectorized or device masking"
+        assert not (
+            pdataset.bucket_batches and masking == "example"
+        ), "bucketing needs vectorized or device masking"
         self.pdataset = pdataset
-        self.device = device
-        self.dataloader = iter(
-            DataLoader(
-                ParallelCompatibleDataset(pdataset, batch_size=batch_size, seed=seed),
+        self.device = torch.device(device)
+        self.masking = masking
+        self.seed = seed
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.n_batches = 0
+        self.worker_states = {}
+        self.generator_state = None
+        if stream_state is not None:
+            self._check_stream_state(stream_state)
+            self.n_batches = stream_state["n_batches"]
+            self.worker_states = dict(stream_state["workers"])
+            self.generator_state = stream_state["generator"]
+        dataset = ParallelCompatibleDataset(
+            pdataset,
+            batch_size=batch_size,
+            seed=seed,
+            masking=masking,
+            first_worker=self.n_batches % max(num_workers, 1),
+            worker_states=self.worker_states,
+        )
+        if masking == "example":
+            dataloader = DataLoader(
+                dataset,
                 num_workers=num_workers,
                 batch_size=batch_size,
                 collate_fn=self._collate_fn,
                 shuffle=False,  # WikiBookDataset already shuffles
+                pin_memory=self.device.type == "cuda",
             )
-        )
+        else:
+            # batches are already formed inside the workers
+            dataloader = DataLoader(
+                dataset,
+                num_workers=num_workers,
+                batch_size=None,
+                pin_memory=self.device.type == "cuda",
+            )
+        self.dataloader = iter(dataloader)
+        if masking == "device":
+            self.generator = torch.Generator(device=self.device)
+            self.generator.manual_seed(seed)
+            if self.generator_state is not None:
+                self.generator.set_state(self.generator_state)
+        self.stats = DataWaitStats()
+        self.prefetcher = None
+        if prefetch > 0:
+            self.prefetcher = BatchPrefetcher(
+                self._fetch_batch, device=self.device, n_prefetch=prefetch
+            )
+            self.stats = self.prefetcher.stats
+
+    @property
+    def processor(self) -> SentenceProcessor:
+        return self.pdataset.processor
+
+    def _fetch_batch(self) -> ProcessedBatch:
+        item, worker_state = next(self.dataloader)
+        if self.masking == "device":
+            tokens = item.to(self.device, non_blocking=True).long()
+            mask_mask, masked_tokens = self.pdataset.processor.mask_batch_on_device(
+                tokens, generator=self.generator
+            )
+            batch = ProcessedBatch.from_arrays(tokens, mask_mask, masked_tokens)
+            batch.stream_state = (worker_state, self.generator.get_state())
+        else:
+            batch = item.to_(self.device, non_blocking=True)
+            batch.stream_state = (worker_state, None)
+        return batch
 
     def get_batch(self) -> ProcessedBatch:
-        return next(self.dataloader).to_(self.device)
+        if self.prefetcher is not None:
+            batch = self.prefetcher.get_batch()
+        else:
+            # without prefetching, the trainer always waits for the batch
+            start = time.perf_counter()
+            batch = self._fetch_batch()
+            self.stats.n_batches += 1
+            self.stats.n_waits += 1
+            self.stats.wait_time += time.perf_counter() - start
+        self._advance_stream_state(batch)
+        return batch
+
+    def _advance_stream_state(self, batch: ProcessedBatch):
+        worker_state, generator_state = batch.stream_state
+        batch.stream_state = None
+        state = dict(worker_state.state)
+        previous_state = self.worker_states.get(state["worker_id"], {})
+        for key in ["buffer", "buckets"]:
+            if key not in state and key in previous_state:
+                state[key] = previous_state[key]
+        self.worker_states[state["worker_id"]] = state
+        if generator_state is not None:
+            self.generator_state = generator_state
+        self.n_batches += 1
+
+    def _check_stream_state(self, stream_state: dict):
+        missing = {"seed", "workers", "generator"} - set(stream_state)
+        if missing:
+            # e.g. the state of a BatchServerClient, whose stream cannot be resumed
+            raise ValueError(
+                f"Not a stream state of ProcessedDatasetWrapper, it has no {sorted(missing)}"
+            )
+        for key in ["seed", "batch_size", "num_workers", "masking"]:
+            if stream_state[key] != getattr(self, key):
+                raise ValueError(
+                    f"Stream state saved with {key}={stream_state[key]}, got {getattr(self, key)}"
+                )
+
+    def state_dict(self) -> dict:
+        """Position in the data stream after the last batch returned by `get_batch`."""
+        return {
+            "seed": self.seed,
+            "batch_size": self.batch_size,
+            "num_workers": self.num_workers,
+            "masking": self.masking,
+            "n_batches": self.n_batches,
+            "workers": dict(self.worker_states),
+            "generator": self.generator_state,
+        }
+
+    def pop_wait_stats(self) -> DataWaitStats:
+        stats = DataWaitStats(
+            n_batches=self.stats.n_batches,
+            n_waits=self.stats.n_waits,
+            wait_time=self.stats.wait_time,
+        )
+        self.stats.n_batches = self.stats.n_waits = 0
+        self.stats.wait_time = 0.0
+        return stats
+
+    def close(self):
+        """Stops the prefetching thread and the DataLoader workers, the wrapper cannot be used afterwards."""
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+        # the workers are shut down when their iterator is deleted
+        self.dataloader = None
+
+
+class FixedEvalDataset:
+    """
+    A fixed set of processed examples, drawn once and kept on `device` in compact dtypes,
+    so that every evaluation sees the same examples without going through the data pipeline.
+    `get_batches` iterates over the whole set in batches of `batch_size`.
+    """
+
+    def __init__(self, tokens, mask_mask, masked_tokens, device, batch_size: int):
+        self.device = torch.device(device)
+        self.tokens = tokens.to(self.device)
+        self.mask_mask = mask_mask.to(self.device)
+        self.masked_tokens = masked_tokens.to(self.device)
+        self.batch_size = batch_size
+
+    @classmethod
+    def from_wrapper(
+        cls, pdataset: "ProcessedDatasetWrapper", n_batches: int, batch_size: int
+    ):
+        """Materializes the next n_batches batches of pdataset. Batches of dynamic length are padded to the longest."""
+        processor = pdataset.processor
+        batches = [pdataset.get_batch().to_("cpu") for _ in range(n_batches)]
+        length = max(batch.tokens.shape[1] for batch in batches)
+
+        def concatenate(name, padding):
+            tensors = [getattr(batch, name) for batch in batches]
+            tensors = [
+                torch.nn.functional.pad(
+                    tensor, (0, length - tensor.shape[1]), value=padding
+                )
+                for tensor in tensors
+            ]
+            return torch.cat(tensors)
+
+        def compact(tensor):
+            return torch.from_numpy(
+                tensor.numpy().astype(processor.compact_token_dtype)
+            )
+
+        return cls(
+            tokens=compact(concatenate("tokens", processor.pad_id)),
+            mask_mask=concatenate("mask_mask", 0).bool(),
+            masked_tokens=compact(concatenate("masked_tokens", processor.pad_id)),
+            device=pdataset.device,
+            batch_size=batch_size,
+        )
+
+    @classmethod
+    def load(cls, path, device, batch_size: int):
+        tensors = torch.load(path, map_location=device)
+        return cls(**tensors, device=device, batch_size=batch_size)
+
+    def save(self, path):
+        tensors = {
+            "tokens": self.tokens.cpu(),
+            "mask_mask": self.mask_mask.cpu(),
+            "masked_tokens": self.masked_tokens.cpu(),
+        }
+        torch.save(tensors, path)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def get_batches(self):
+        for begin in range(0, len(self), self.batch_size):
+            end = begin + self.batch_size
+            yield ProcessedBatch.from_arrays(
+                self.tokens[begin:end].long(),
+                self.mask_mask[begin:end].long(),
+                self.masked_tokens[begin:end].long(),
+            )
@@ -1,7 +1,39 @@
+from typing import Optional
+
 import einops
 from lizrd.core import nn
 
 DISABLE_CHECKS = False
+# checks run only in the first CHECK_FIRST_N forwards of each module, see set_check_mode
+CHECK_FIRST_N = None
+# checks run once for each input shape of each module instead
+CHECK_PER_SHAPE = False
+
+
+def set_check_mode(first_n: Optional[int] = None, per_shape: bool = False):
+    """
+    Makes the checks of every module run only in its first `first_n` forwards,
+    or only once for each input shape with `per_shape`. `first_n=None` checks every forward.
+    After its first `first_n` forwards a module calls its layer directly, without the checking wrapper,
+    until reset_checks is called on it.
+    """
+    global CHECK_FIRST_N, CHECK_PER_SHAPE
+    CHECK_FIRST_N = first_n
+    CHECK_PER_SHAPE = per_shape
+
+
+def reset_checks(model):
+    """Makes all modules of the model check their forwards again, according to the current mode."""
+    for module in model.modules():
+        if isinstance(module, Check):
+            checker = module
+        elif hasattr(module, "_shape_checker"):
+            checker = module._shape_checker
+        else:
+            continue
+        checker.n_checked = 0
+        checker.checked_shapes = set()
+        module.__dict__.pop("forward", None)
 
 
 def assert_shape(pattern, tensor, **kwargs):
@@ -18,6 +50,8 @@ class Check(nn.Module):
         self.out_sig = self.out_sig.split()
         self.constants = kwargs
         self.layer = layer
+        self.n_checked = 0
+        self.checked_shapes = set()
 
     def _check_and_add(self, shape, current, past, index):
         if current.isnumeric():
@@ -37,6 +71,25 @@ class Check(nn.Module):
         for index, current in enumerate(signature, start=len(signature) - len(shape)):
             self._check_and_add(shape, current, past, index)
 
+    def should_check(self, x):
+        if DISABLE_CHECKS:
+            return False
+        if CHECK_PER_SHAPE:
+            if x.shape in self.checked_shapes:
+                return False
+            self.checked_shapes.add(x.shape)
+            return True
+        return CHECK_FIRST_N is None or self.n_checked < CHECK_FIRST_N
+
+    def done_checking(self):
+        """Counts a checked forward, returns whether the checks can be dropped for good."""
+        self.n_checked += 1
+        return (
+            not CHECK_PER_SHAPE
+            and CHECK_FIRST_N is not None
+            and self.n_checked >= CHECK_FIRST_N
+        )
+
     def get_past(self):
         if DISABLE_CHECKS:
             return None
@@ -55,10 +108,15 @@ class Check(nn.Module):
         self._check_and_add_all(y.shape, self.out_sig, past)
 
     def forward(self, x):
+        if not self.should_check(x):
+            return self.layer(x)
         past = self.get_past()
         self.before_layer(x, past)
         y = self.layer(x)
         self.after_layer(y, past)
+        if self.done_checking():
+            # an instance attribute, so that it's not registered as a submodule
+            object.__setattr__(self, "forward", self.layer)
         return y
 
 
@@ -81,10 +139,18 @@ def check(signature, **kwargs_shape):
             self._shape_checker = Check(signature, layer=None, **kwargs_shape)
 
         def new_forward(self, x):
+            if not self._shape_checker.should_check(x):
+                return old_forward(self, x)
             past = self._shape_checker.get_past()
             self._shape_checker.before_layer(x, past)
             y = old_forward(self, x)
             self._shape_checker.after_layer(y, past)
+            # subclasses of checked classes share the checker, only the outermost forward is dropped
+            if (
+                self._shape_checker.done_checking()
+                and type(self).forward is new_forward
+            ):
+                self.forward = old_forward.__get__(self)
             return y
 
         module_class.__init__ = new_init
@@ -11,3 +11,17 @@ def update_losses_dict(current_losses: LossDict, new_losses: LossDict) -> LossDi
     if len(overlapping_keys) > 0:
         raise ValueError(f"Keys overlap: {overlapping_keys}")
     return {**current_losses, **new_losses}
+
+
+def mask_loss_denominator(
+    y_mask_set: torch.Tensor, max_total_length: int, mask_percent: float
+) -> float:
+    """
+    The summed loss of masked tokens is divided by this, which approximates the number of masked tokens.
+    Rows count as max_total_length tokens even when the batch is trimmed to its longest example
+    (bucket_batches), so that the loss scale is the same for every batch and for non-bucketed runs.
+    """
+    n_tokens = y_mask_set.numel()
+    if y_mask_set.dim() > 1:
+        n_tokens = n_tokens // y_mask_set.shape[-1] * max_total_length
+    return n_tokens * mask_percent
@@ -1,3 +1,6 @@
+import os
+import random
+import threading
 import time
 
 import numpy as np
@@ -7,8 +10,18 @@ from lizrd.core import nn
 GLOBAL_TIMERS = dict()
 GLOBAL_NAMES = []
 GLOBAL_DEPTHS = dict()
-CURRENT_DEPTH = [0]
 DISABLED = False
+# synchronizing CUDA makes the times include the kernels launched inside a timer, but also stalls the host,
+# so it's off by default and scripts that compare CUDA timings turn it on; RECORD_FUNCTION with TraceProfiler
+# gives the kernel times without stalling
+SYNCHRONIZE = False
+# also open a torch.profiler.record_function range for every timer, so that it shows up in traces
+RECORD_FUNCTION = False
+RESERVOIR_SIZE = 1024
+
+_LOCK = threading.Lock()
+# depth and disable_inner state of the timers currently open, per thread
+_THREAD_STATE = threading.local()
 
 
 def cuda_synchronize():
@@ -16,6 +29,55 @@ def cuda_synchronize():
         torch.cuda.synchronize()
 
 
+class TimerStats(object):
+    """
+    Streaming aggregates of the samples of a timer: count, total, mean and variance (Welford's algorithm),
+    and quantiles estimated from a uniform sample of at most `reservoir_size` of them.
+    """
+
+    def __init__(self, reservoir_size=RESERVOIR_SIZE):
+        self.reservoir_size = reservoir_size
+        self.reservoir = []
+        self.count = 0
+        self.total = 0.0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.rng = random.Random(0)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if len(self.reservoir) < self.reservoir_size:
+            self.reservoir.append(value)
+        else:
+            index = self.rng.randrange(self.count)
+            if index < self.reservoir_size:
+                self.reservoir[index] = value
+
+    @property
+    def var(self):
+        return self.m2 / self.count if self.count else 0.0
+
+    @property
+    def std(self):
+        return self.var**0.5
+
+    def quantile(self, q):
+        if not self.reservoir:
+            return float("nan")
+        return float(np.quantile(self.reservoir, q))
+
+
+def _thread_state():
+    if not hasattr(_THREAD_STATE, "depth"):
+        _THREAD_STATE.depth = 0
+        _THREAD_STATE.inner_disabled = False
+    return _THREAD_STATE
+
+
 class TimerLayer(nn.Module):
     def __init__(self, name, layer, off=False):
         super(TimerLayer, self).__init__()
@@ -33,62 +95,146 @@ class TimerLayer(nn.Module):
 
 
 class Timer(object):
+    """
+    Adds the time spent inside `with Timer(name):` to the stats of `name`, see print_times.
+    With disable_inner, timers opened inside it (in the same thread) are ignored.
+    On CUDA the times only include the kernels that finished inside the timer, unless SYNCHRONIZE is set.
+    """
+
     def __init__(self, name, disable_inner=False, disable=False):
-        global DISABLED
         self.name = name
         self.disable_inner = disable_inner
-        self.i_disabled = False
         self.force_disable = disable
-        if (not DISABLED) and (not self.force_disable):
-            if name not in GLOBAL_TIMERS:
-                GLOBAL_TIMERS[self.name] = []
-                # GLOBAL_TIMERS[self.name+'T'] = []
-            if self.name not in GLOBAL_NAMES:
-                GLOBAL_NAMES.append(name)
-        # self.start = torch.cuda.Event(enable_timing=True)
-        # self.end = torch.cuda.Event(enable_timing=True)
+        self.active = False
+        self.record_function = None
 
     def __enter__(self):
-        global DISABLED
-        if (not DISABLED) and (not self.force_disable):
-            if self.disable_inner:
-                DISABLED = True
-                self.i_disabled = True
+        state = _thread_state()
+        self.active = not (DISABLED or self.force_disable or state.inner_disabled)
+        if not self.active:
+            return self
+        with _LOCK:
+            if self.name not in GLOBAL_TIMERS:
+                GLOBAL_TIMERS[self.name] = TimerStats()
+                GLOBAL_NAMES.append(self.name)
+            GLOBAL_DEPTHS[self.name] = state.depth
+        if self.disable_inner:
+            state.inner_disabled = True
+        state.depth += 1
+        if RECORD_FUNCTION:
+            self.record_function = torch.profiler.record_function(self.name)
+            self.record_function.__enter__()
+        if SYNCHRONIZE:
             cuda_synchronize()
-            GLOBAL_DEPTHS[self.name] = CURRENT_DEPTH[0]
-            CURRENT_DEPTH[0] += 1
-            self.start_time = time.time()
-            # self.start.record()
+        self.start_time = time.perf_counter()
+        return self
 
     def __exit__(self, *args):
-        global DISABLED
-        if ((not DISABLED) or self.i_disabled) and (not self.force_disable):
-            if self.disable_inner:
-                DISABLED = False
-                self.i_disabled = False
-            # self.end.record()
+        if not self.active:
+            return
+        if SYNCHRONIZE:
             cuda_synchronize()
-            self.end_time = time.time()
-
-            CURRENT_DEPTH[0] -= 1
-            GLOBAL_TIMERS[self.name].append(self.end_time - self.start_time)
-            # GLOBAL_TIMERS[self.name+'T'].append(self.start.elapsed_time(self.end)/1000)
+        elapsed = time.perf_counter() - self.start_time
+        if self.record_function is not None:
+            self.record_function.__exit__(*args)
+            self.record_function = None
+        state = _thread_state()
+        state.depth -= 1
+        if self.disable_inner:
+            state.inner_disabled = False
+        self.active = False
+        with _LOCK:
+            GLOBAL_TIMERS[self.name].add(elapsed)
 
 
 def reset_times():
     global GLOBAL_TIMERS, GLOBAL_DEPTHS, GLOBAL_NAMES
-    GLOBAL_TIMERS = dict()
-    GLOBAL_DEPTHS = dict()
-    GLOBAL_NAMES = []
+    with _LOCK:
+        GLOBAL_TIMERS = dict()
+        GLOBAL_DEPTHS = dict()
+        GLOBAL_NAMES = []
 
 
 def print_times(reset=True):
     for name in GLOBAL_NAMES:
-        values = GLOBAL_TIMERS[name]
+        stats = GLOBAL_TIMERS[name]
         depth = GLOBAL_DEPTHS[name]
         print(
-            f'{" "*depth + name:18}: {round(sum(values), 3)} +/- {round(np.std(values)*len(values)**0.5, 2)}'
+            f'{" "*depth + name:18}: {round(stats.total, 3)} +/- {round(stats.std*stats.count**0.5, 2)}'
+            f"  (n={stats.count}, mean={stats.mean:.3g}, p50={stats.quantile(0.5):.3g}, p90={stats.quantile(0.9):.3g})"
         )
     print("\n\n\n")
     if reset:
         reset_times()
+
+
+class TraceProfiler(object):
+    """
+    Runs torch.profiler for the steps in [start_step, end_step), then writes to `output_dir`
+    a Chrome trace (trace.json, open it in chrome://tracing or ui.perfetto.dev), collapsed stacks
+    of the record_function spans and ops they run, weighted by self CPU time in microseconds
+    (stacks.txt, for flamegraph.pl or speedscope), and prints the ops with the most self time.
+    Call step(step) at the beginning of every step and finish() after the last one.
+    """
+
+    def __init__(self, output_dir, start_step, end_step, row_limit=20):
+        assert 0 <= start_step < end_step
+        self.output_dir = output_dir
+        self.start_step = start_step
+        self.end_step = end_step
+        self.row_limit = row_limit
+        self.profiler = None
+
+    def step(self, step):
+        if step == self.start_step and self.profiler is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(
+                activities=activities, record_shapes=True
+            )
+            self.profiler.start()
+        elif step == self.end_step:
+            self.finish()
+
+    def finish(self):
+        if self.profiler is None:
+            return
+        self.profiler.stop()
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.profiler.export_chrome_trace(os.path.join(self.output_dir, "trace.json"))
+        write_collapsed_stacks(
+            self.profiler.events(), os.path.join(self.output_dir, "stacks.txt")
+        )
+        print(
+            f"Profiled steps {self.start_step}-{self.end_step}, trace written to {self.output_dir}"
+        )
+        print(
+            self.profiler.key_averages().table(
+                sort_by="self_cpu_time_total", row_limit=self.row_limit
+            )
+        )
+        self.profiler = None
+
+
+def collapsed_stacks(events):
+    """Returns {"outer;...;inner": self CPU microseconds} for the CPU events of a profiler."""
+    stacks = dict()
+    for event in events:
+        if event.device_type != torch.autograd.DeviceType.CPU:
+            continue
+        names = []
+        parent = event
+        while parent is not None:
+            names.append(parent.name.replace(";", ":").replace(" ", "_"))
+            parent = parent.cpu_parent
+        stack = ";".join(reversed(names))
+        stacks[stack] = stacks.get(stack, 0.0) + event.self_cpu_time_total
+    return stacks
+
+
+def write_collapsed_stacks(events, path):
+    with open(path, "w") as f:
+        for stack, time_us in sorted(collapsed_stacks(events).items()):
+            if round(time_us) > 0:
+                f.write(f"{stack} {round(time_us)}\n")
@@ -0,0 +1,43 @@
+import torch
+
+from lizrd.core import bert
+from lizrd.support import ash
+from lizrd.support.test_utils import GeneralTestCase
+
+
+class TestCheckMode(GeneralTestCase):
+    def tearDown(self):
+        ash.set_check_mode()
+
+    def test_first_n(self):
+        ash.set_check_mode(first_n=2)
+        dm, heads, dff = 32, 4, 64
+        feedforward = bert.FeedForward(dm, dff)
+        attention = bert.Attention(dm, heads)
+        state_dict_keys = list(feedforward.state_dict().keys())
+        input = torch.normal(0.0, 1.0, (3, 7, dm))
+        with self.assertRaises(AssertionError):
+            ash.Check("... d -> ... d", feedforward.layer, d=dm + 1)(input)
+
+        for _ in range(2):
+            self.assertNotIn("forward", feedforward.__dict__)
+            self.assertNotIn("forward", attention.__dict__)
+            output = feedforward(input)
+            attention(input)
+        self.assertIs(feedforward.forward, feedforward.layer)
+        self.assertIn("forward", attention.__dict__)
+        self.assertEqual(list(feedforward.state_dict().keys()), state_dict_keys)
+        self.assertTensorEqual(feedforward(input), output)
+
+        ash.reset_checks(feedforward)
+        self.assertNotIn("forward", feedforward.__dict__)
+        self.assertEqual(feedforward.n_checked, 0)
+
+    def test_per_shape(self):
+        ash.set_check_mode(per_shape=True)
+        dm, dff = 32, 64
+        feedforward = bert.FeedForward(dm, dff)
+        for seql in [7, 7, 5]:
+            feedforward(torch.normal(0.0, 1.0, (3, seql, dm)))
+        self.assertEqual(feedforward.n_checked, 2)
+        self.assertNotIn("forward", feedforward.__dict__)
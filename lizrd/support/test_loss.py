@@ -0,0 +1,15 @@
+import torch
+
+from lizrd.support.loss import mask_loss_denominator
+from lizrd.support.test_utils import GeneralTestCase
+
+
+class TestMaskLossDenominator(GeneralTestCase):
+    def test_trimmed_batches(self):
+        mask = torch.zeros((4, 128))
+        self.assertAlmostEqual(mask_loss_denominator(mask, 128, 0.15), 4 * 128 * 0.15)
+        # a bucketed batch trimmed to its longest example is normalized the same way
+        self.assertAlmostEqual(
+            mask_loss_denominator(mask[:, :37], 128, 0.15), 4 * 128 * 0.15
+        )
+        self.assertAlmostEqual(mask_loss_denominator(mask[0], 128, 0.15), 128 * 0.15)
@@ -0,0 +1,76 @@
+import json
+import os
+import tempfile
+import threading
+
+import numpy as np
+import torch
+
+from lizrd.support import profile
+from lizrd.support.test_utils import GeneralTestCase
+
+
+class TestTimerStats(GeneralTestCase):
+    def test_aggregates(self):
+        values = np.random.default_rng(0).exponential(size=5000)
+        stats = profile.TimerStats(reservoir_size=1000)
+        for value in values:
+            stats.add(value)
+        self.assertEqual(stats.count, 5000)
+        self.assertEqual(len(stats.reservoir), 1000)
+        self.assertAlmostEqual(stats.total, values.sum())
+        self.assertAlmostEqual(stats.mean, values.mean())
+        self.assertAlmostEqual(stats.std, values.std())
+        self.assertAlmostEqual(stats.quantile(0.5), np.median(values), delta=0.1)
+
+
+class TestTimer(GeneralTestCase):
+    def tearDown(self):
+        profile.reset_times()
+
+    def test_nesting_and_threads(self):
+        profile.reset_times()
+
+        def run():
+            for _ in range(100):
+                with profile.Timer("outer", disable_inner=True):
+                    with profile.Timer("inner"):
+                        pass
+                with profile.Timer("other"):
+                    with profile.Timer("nested"):
+                        pass
+
+        threads = [threading.Thread(target=run) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertNotIn("inner", profile.GLOBAL_TIMERS)
+        self.assertEqual(profile.GLOBAL_TIMERS["outer"].count, 400)
+        self.assertEqual(profile.GLOBAL_TIMERS["nested"].count, 400)
+        self.assertEqual(profile.GLOBAL_DEPTHS["nested"], 1)
+        self.assertEqual(profile.GLOBAL_DEPTHS["other"], 0)
+
+
+class TestTraceProfiler(GeneralTestCase):
+    def test_window(self):
+        layer = torch.nn.Linear(16, 16)
+        with tempfile.TemporaryDirectory() as output_dir:
+            profiler = profile.TraceProfiler(output_dir, start_step=2, end_step=4)
+            for step in range(6):
+                profiler.step(step)
+                with torch.profiler.record_function("forward"):
+                    loss = layer(torch.randn(8, 16)).sum()
+                with torch.profiler.record_function("backward"):
+                    loss.backward()
+            profiler.finish()
+
+            with open(os.path.join(output_dir, "trace.json")) as f:
+                trace = json.load(f)
+            names = [event.get("name") for event in trace["traceEvents"]]
+            self.assertEqual(names.count("forward"), 2)
+            with open(os.path.join(output_dir, "stacks.txt")) as f:
+                stacks = [line.rsplit(" ", 1) for line in f.read().splitlines()]
+            self.assertTrue(any(stack.startswith("forward;") for stack, _ in stacks))
+            self.assertTrue(all(int(time_us) > 0 for _, time_us in stacks))
@@ -1,11 +1,14 @@
 from collections import defaultdict
 import copy
+import hashlib
+import json
 import os
-from typing import Callable, Optional
+from typing import Callable, Optional, Tuple, Union
 
 import torch
 import torch.nn.functional as F
 from attr import define
+from torch.profiler import record_function
 from torch.utils.tensorboard import SummaryWriter
 import torch.nn.functional as F
 import numpy as np
@@ -13,12 +16,14 @@ import plotly.express as px
 
 from lizrd.core import bert
 from lizrd.core.misc import are_state_dicts_the_same
-from lizrd.datasets import wikibookdata
+from lizrd.datasets import batch_server, wikibookdata
 from lizrd.support.logging import AbstractLogger, log_plot
+from lizrd.support.profile import TraceProfiler
 from lizrd.support.loss import (
     LossDict,
     RunningLossDict,
     LossWeightDict,
+    mask_loss_denominator,
 )
 from research.reinitialization.core.pruner import BasePruner
 from research.reinitialization.core.scheduler import BaseScheduler
@@ -54,6 +59,41 @@ def get_model(
     return model.to(device)
 
 
+def make_processed_dataset(
+    max_total_length: int,
+    mask_percent: float = 0.15,
+    tokenized_dataset_path: Optional[str] = None,
+    use_fast_tokenizer: bool = False,
+    packing: bool = False,
+    bucket_batches: int = 0,
+    chunk_index_path: Optional[str] = None,
+    streaming_dataset_path: Optional[str] = None,
+) -> wikibookdata.ProcessedDataset:
+    processor = wikibookdata.SentenceProcessor(
+        max_total_length=max_total_length,
+        mask_percent=mask_percent,
+        use_fast_tokenizer=use_fast_tokenizer,
+    )
+    # raw datasets tokenize whole refills of their buffers at once
+    if tokenized_dataset_path is not None:
+        raw_dataset = wikibookdata.TokenizedWikiBookDataset(tokenized_dataset_path)
+    elif streaming_dataset_path is not None:
+        raw_dataset = wikibookdata.StreamingWikiBookDataset(
+            streaming_dataset_path, tokenize_batch_fn=processor.tokenize_batch
+        )
+    elif chunk_index_path is not None:
+        raw_dataset = wikibookdata.IndexedWikiBookDataset(
+            chunk_index_path, tokenize_batch_fn=processor.tokenize_batch
+        )
+    else:
+        raw_dataset = wikibookdata.WikiBookDataset(
+            tokenize_batch_fn=processor.tokenize_batch
+        )
+    return wikibookdata.ProcessedDataset(
+        raw_dataset, processor, packing=packing, bucket_batches=bucket_batches
+    )
+
+
 def get_processed_dataset(
     batch_size: int,
     max_total_length: int,
@@ -61,28 +101,108 @@ def get_processed_dataset(
     device: torch.device,
     num_workers: int,
     seed: int,
-) -> wikibookdata.ProcessedDatasetWrapper:
-    raw_dataset = wikibookdata.WikiBookDataset()
-    processor = wikibookdata.SentenceProcessor(
+    tokenized_dataset_path: Optional[str] = None,
+    masking: wikibookdata.MaskingMode = "example",
+    use_fast_tokenizer: bool = False,
+    prefetch: int = 0,
+    stream_state: Optional[dict] = None,
+    packing: bool = False,
+    bucket_batches: int = 0,
+    chunk_index_path: Optional[str] = None,
+    streaming_dataset_path: Optional[str] = None,
+    batch_server_address: Optional[str] = None,
+) -> Union[wikibookdata.ProcessedDatasetWrapper, batch_server.BatchServerClient]:
+    if batch_server_address is not None:
+        if stream_state is not None:
+            raise ValueError(
+                "Batches from a batch server cannot be resumed from a stream state, "
+                "don't pass both of them"
+            )
+        # the server reads and tokenizes the data, only masking happens here
+        processor = wikibookdata.SentenceProcessor(
+            max_total_length=max_total_length,
+            mask_percent=mask_percent,
+            use_fast_tokenizer=use_fast_tokenizer,
+        )
+        return batch_server.BatchServerClient(
+            batch_server_address,
+            processor=processor,
+            device=device,
+            batch_size=batch_size,
+            seed=seed,
+            prefetch=prefetch,
+        )
+    dataset = make_processed_dataset(
         max_total_length=max_total_length,
         mask_percent=mask_percent,
+        tokenized_dataset_path=tokenized_dataset_path,
+        use_fast_tokenizer=use_fast_tokenizer,
+        packing=packing,
+        bucket_batches=bucket_batches,
+        chunk_index_path=chunk_index_path,
+        streaming_dataset_path=streaming_dataset_path,
     )
-    dataset = wikibookdata.ProcessedDataset(raw_dataset, processor)
     return wikibookdata.ProcessedDatasetWrapper(
         pdataset=dataset,
         device=device,
         batch_size=batch_size,
         num_workers=num_workers,
         seed=seed,
+        masking=masking,
+        prefetch=prefetch,
+        stream_state=stream_state,
     )
 
 
+def get_fixed_eval_dataset(
+    cache_dir: Optional[str],
+    n_batches: int,
+    eval_batch_size: int,
+    **processed_dataset_kwargs,
+) -> wikibookdata.FixedEvalDataset:
+    """
+    Draws n_batches batches from get_processed_dataset(**processed_dataset_kwargs) once, and caches them
+    in cache_dir, so that later runs with the same settings evaluate on exactly the same examples.
+    """
+    device = processed_dataset_kwargs["device"]
+    cache_path = None
+    if cache_dir is not None:
+        # everything that decides which examples are drawn and how they are masked
+        settings = {
+            key: value
+            for key, value in processed_dataset_kwargs.items()
+            if key not in ["device", "prefetch", "num_workers", "stream_state"]
+        }
+        settings_hash = hashlib.sha1(
+            json.dumps(settings, sort_keys=True, default=str).encode()
+        ).hexdigest()[:16]
+        cache_path = os.path.join(
+            cache_dir, f"eval_set_{settings_hash}_n={n_batches}.pt"
+        )
+        if os.path.exists(cache_path):
+            return wikibookdata.FixedEvalDataset.load(
+                cache_path, device, eval_batch_size
+            )
+
+    pdataset = get_processed_dataset(**processed_dataset_kwargs)
+    eval_dataset = wikibookdata.FixedEvalDataset.from_wrapper(
+        pdataset, n_batches, eval_batch_size
+    )
+    pdataset.close()
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        eval_dataset.save(cache_path)
+    return eval_dataset
+
+
 @define(slots=False)
 class Trainer:
     model: torch.nn.Module
     optimizer: torch.optim.Optimizer
     pdataset: wikibookdata.ProcessedDatasetWrapper
-    pdataset_eval: wikibookdata.ProcessedDatasetWrapper
+    pdataset_eval: Union[
+        wikibookdata.ProcessedDatasetWrapper, wikibookdata.FixedEvalDataset
+    ]
     batch_size: int
     vocab_size: int
     mask_percent: float
@@ -109,6 +229,10 @@ class Trainer:
     noise_interpolation_delay: int = 0
     dataset_token_eval_fn: wikibookdata.ProcessedDataset = None
     write_easy_masks: bool = False
+    packed_attention_mask: bool = False
+    masked_head_only: bool = False
+    # [start, end) steps to run torch.profiler for, see lizrd.support.profile.TraceProfiler
+    profile_steps: Optional[Tuple[int, int]] = None
 
     def __attrs_post_init__(self):
         self.scaler = torch.cuda.amp.GradScaler(enabled=self.mixed_precision)
@@ -133,20 +257,22 @@ class Trainer:
     ):
         optimizer.zero_grad()
 
-        if scaler is not None:
-            scaler.scale(loss).backward()
-            scaler.unscale_(optimizer)
-        else:
-            loss.backward()
+        with record_function("backward"):
+            if scaler is not None:
+                scaler.scale(loss).backward()
+                scaler.unscale_(optimizer)
+            else:
+                loss.backward()
 
         if run_after_backprop:
             self.after_backprop(step)
 
-        if scaler is not None:
-            scaler.step(optimizer)
-            scaler.update()
-        else:
-            optimizer.step()
+        with record_function("optimizer"):
+            if scaler is not None:
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                optimizer.step()
 
     def _pruning_step(self, step):
         if self.scheduler and self.scheduler.is_time_to_prune(step):
@@ -197,20 +323,44 @@ class Trainer:
         y_token_set: torch.Tensor,
         y_mask_set: torch.Tensor,
     ) -> torch.Tensor:
-        model_output = self.model(x_set)
-        self.mask_loss = F.cross_entropy(
-            model_output.reshape(-1, self.vocab_size),
-            y_token_set.reshape(-1).long(),
-            reduction="none",
-        )
+        if self.packed_attention_mask:
+            processor = self.pdataset.processor
+            bert.set_attention_mask(
+                self.model,
+                bert.get_packed_attention_mask(
+                    x_set, processor.sep_id, processor.pad_id
+                ),
+            )
+        if self.masked_head_only:
+            # the loss of unmasked words is zeroed below anyway, so skip their predictions
+            mask = y_mask_set.reshape(-1).bool()
+            masked_output = bert.get_masked_predictions(
+                self.model, x_set, y_mask_set.bool()
+            )
+            masked_loss = F.cross_entropy(
+                masked_output, y_token_set.reshape(-1)[mask].long(), reduction="none"
+            )
+            self.mask_loss = masked_loss.new_zeros(mask.shape).masked_scatter(
+                mask, masked_loss
+            )
+        else:
+            model_output = self.model(x_set)
+            self.mask_loss = F.cross_entropy(
+                model_output.reshape(-1, self.vocab_size),
+                y_token_set.reshape(-1).long(),
+                reduction="none",
+            )
         self.mask_loss *= y_mask_set.reshape(-1)  # only check masked words
         self.token_losses = self.mask_loss.reshape_as(y_mask_set).sum(dim=1)
-        mask_loss = self.mask_loss.mean() / self.mask_percent
+        mask_loss = self.mask_loss.sum() / mask_loss_denominator(
+            y_mask_set, self.pdataset.processor.max_total_length, self.mask_percent
+        )
         return mask_loss
 
     def heavy_task_train_step(self, dataset: wikibookdata.ProcessedDataset, step: int):
         self.model.train()
-        processed_batch = dataset.get_batch()
+        with record_function("data"):
+            processed_batch = dataset.get_batch()
         assert isinstance(processed_batch, wikibookdata.ProcessedBatch)
         x_set = processed_batch.masked_tokens
         y_token_set = processed_batch.tokens
@@ -246,6 +396,7 @@ class Trainer:
         eval_loss_before = self._eval_step(
             step=step, sample=100, log_values=False, dataset=token_eval_dataset
         )
+        token_eval_dataset.close()
 
         # reverse model and optimizer state to previous one and mask tokens to only easy
         self.model.load_state_dict(
@@ -267,6 +418,7 @@ class Trainer:
         eval_loss_only_easy = self._eval_step(
             step=step, sample=100, log_values=False, dataset=token_eval_dataset
         )
+        token_eval_dataset.close()
 
         # reverse model and optimizer state to previous one and mask tokens to only hard
         self.model.load_state_dict(
@@ -287,6 +439,7 @@ class Trainer:
         eval_loss_only_hard = self._eval_step(
             step=step, sample=100, log_values=False, dataset=token_eval_dataset
         )
+        token_eval_dataset.close()
 
         # reverse model and optimizer to the state before update again
         self.model.load_state_dict(
@@ -320,7 +473,8 @@ class Trainer:
 
     def task_diff_train_step(self, dataset: wikibookdata.ProcessedDataset, step: int):
         self.model.train()
-        processed_batch = dataset.get_batch()
+        with record_function("data"):
+            processed_batch = dataset.get_batch()
         assert isinstance(processed_batch, wikibookdata.ProcessedBatch)
         x_set = processed_batch.masked_tokens
         y_token_set = processed_batch.tokens
@@ -356,7 +510,8 @@ class Trainer:
             self.heavy_task_train_step(dataset, step)
         else:
             self.model.train()
-            processed_batch = dataset.get_batch()
+            with record_function("data"):
+                processed_batch = dataset.get_batch()
             assert isinstance(processed_batch, wikibookdata.ProcessedBatch)
             x_set = processed_batch.masked_tokens
             y_token_set = processed_batch.tokens
@@ -379,7 +534,7 @@ class Trainer:
         y_token_set: torch.Tensor,
         y_mask_set: torch.Tensor,
     ):
-        with torch.autocast(
+        with record_function("forward"), torch.autocast(
             device_type="cuda", enabled=self.mixed_precision, dtype=torch.float16
         ):
             losses = {"mask": self._get_mask_loss(x_set, y_token_set, y_mask_set)}
@@ -414,7 +569,7 @@ class Trainer:
 
     def _model_train_step(self, step: int):
         self.model.train()
-        with torch.autocast(
+        with record_function("forward"), torch.autocast(
             device_type="cuda", enabled=self.mixed_precision, dtype=torch.float16
         ):
             losses = self.pruner.get_auxiliary_loss()
@@ -449,6 +604,22 @@ class Trainer:
         if step and (step % self.log_acc_steps == 0):
             self.log_loss_stats(step)
             self.reset_loss_stats()
+            self.log_data_wait_stats(step)
+
+    def log_data_wait_stats(self, step: int):
+        wait_stats = self.pdataset.pop_wait_stats()
+        self.logger.report_scalar(
+            title="data",
+            series="waited fraction",
+            value=wait_stats.waited_fraction,
+            iteration=step,
+        )
+        self.logger.report_scalar(
+            title="data",
+            series="wait time",
+            value=wait_stats.wait_time,
+            iteration=step,
+        )
 
     def _eval_step(
         self,
@@ -462,18 +633,28 @@ class Trainer:
         if dataset is None:
             dataset = self.pdataset_eval
 
+        if isinstance(dataset, wikibookdata.FixedEvalDataset):
+            # the whole fixed set is evaluated every time, `sample` is ignored
+            batches = dataset.get_batches()
+        else:
+            batches = (dataset.get_batch() for _ in range(sample))
+
         with torch.no_grad():
             total_mask_loss = 0.0
-            for _ in range(sample):
-                processed_batch = dataset.get_batch()
+            n_examples = 0
+            for processed_batch in batches:
                 assert isinstance(processed_batch, wikibookdata.ProcessedBatch)
                 mask_loss = self._get_mask_loss(
                     x_set=processed_batch.masked_tokens,
                     y_token_set=processed_batch.tokens,
                     y_mask_set=processed_batch.mask_mask,
                 )
-                total_mask_loss += mask_loss.item()
-            total_mask_loss /= sample
+                # weighted, as the last batch of a fixed set may be smaller
+                total_mask_loss += mask_loss * len(processed_batch.tokens)
+                n_examples += len(processed_batch.tokens)
+            if n_examples == 0:
+                raise ValueError("The eval dataset yielded no batches")
+            total_mask_loss = float(total_mask_loss) / n_examples
 
             if log_values:
                 self.logger.report_scalar(
@@ -631,7 +812,13 @@ class Trainer:
                 sample_size=self.neuron_diff_sample_size,
             )
 
+        profiler = None
+        if self.profile_steps is not None:
+            profiler = TraceProfiler(self.modelpath, *self.profile_steps)
+
         for step in range(n_steps):
+            if profiler is not None:
+                profiler.step(step)
             # lr warmup in the beginning
             if step <= self.lr_warmup_steps and self.lr_warmup_steps > 0:
                 lr = target_lr * step / self.lr_warmup_steps
@@ -652,16 +839,22 @@ class Trainer:
             if step == self.noise_interpolation_delay:
                 self.pruner.enable_noise_interpolation()
 
-            self._pruning_step(step)
+            with record_function("pruning"):
+                self._pruning_step(step)
             self._train_step(dataset=self.pdataset, step=step)
             self.running_loss_steps += 1
-            self._log_train_stats(step)
-            if step % self.log_acc_steps == 0:
-                self.logger.report_scalar(title="step", value=step, iteration=step)
+            with record_function("logging"):
+                self._log_train_stats(step)
+                if step % self.log_acc_steps == 0:
+                    self.logger.report_scalar(title="step", value=step, iteration=step)
             if step % n_steps_eval == 0:
-                eval_loss = self._eval_step(step)
+                with record_function("eval"):
+                    eval_loss = self._eval_step(step)
                 print(f"Eval loss:", eval_loss)
                 torch.save(self.model.state_dict(), f"{self.modelpath}/model.pt")
+                torch.save(
+                    self.pdataset.state_dict(), f"{self.modelpath}/data_state.pt"
+                )
             if (
                 self.n_log_heavy_steps
                 and step > 0
@@ -671,6 +864,8 @@ class Trainer:
                 self.pruner.log_heavy(step)
                 self.log_token_losses(step)
             print(f"Step {step}")
+        if profiler is not None:
+            profiler.finish()
 
 
 class SetLRTemporarily:
@@ -921,7 +1116,9 @@ class LTHTrainer:
             reduction="none",
         )
         mask_loss *= y_mask_set.reshape(-1)  # only check masked words
-        mask_loss = mask_loss.mean() / self.mask_percent
+        mask_loss = mask_loss.sum() / mask_loss_denominator(
+            y_mask_set, pdataset.processor.max_total_length, self.mask_percent
+        )
         scaled_mask_loss = mask_loss * self.mask_loss_weight
         total_loss = scaled_mask_loss
 
@@ -955,7 +1152,9 @@ class LTHTrainer:
                     reduction="none",
                 )
                 mask_loss *= y_mask_set.reshape(-1)  # only check masked words
-                mask_loss = mask_loss.mean() / self.mask_percent
+                mask_loss = mask_loss.sum() / mask_loss_denominator(
+                    y_mask_set, pdataset.processor.max_total_length, self.mask_percent
+                )
                 scaled_mask_loss = mask_loss * self.mask_loss_weight
                 total_mask_loss += scaled_mask_loss.item()
             total_mask_loss /= sample
@@ -972,15 +1171,26 @@ class LTHTrainer:
             optimizer = self.optimizer_creator(self.model)
             pdataset = self.pdataset_creator()
             self.writer.add_scalar("parameters_left", parameters_left, total_step)
-            for step in range(self.n_steps_per_run):
-                self._train_step(optimizer, pdataset, total_step)
-                if step % self.n_steps_eval == 0:
-                    self._eval_step(
-                        pdataset, step=total_step, sample=self.n_steps_eval // 2
-                    )
-                self.writer.add_scalar("total_step", total_step, total_step)
-                print(f"Run step {step}; Total step {total_step}")
-                total_step += 1
+            # every run gets a new dataset, its prefetch thread and workers are stopped at the end
+            try:
+                for step in range(self.n_steps_per_run):
+                    self._train_step(optimizer, pdataset, total_step)
+                    if step % self.n_steps_eval == 0:
+                        self._eval_step(
+                            pdataset, step=total_step, sample=self.n_steps_eval // 2
+                        )
+                    self.writer.add_scalar("total_step", total_step, total_step)
+                    if step % self.n_steps_eval == 0:
+                        wait_stats = pdataset.pop_wait_stats()
+                        self.writer.add_scalar(
+                            "data/waited_fraction",
+                            wait_stats.waited_fraction,
+                            total_step,
+                        )
+                    print(f"Run step {step}; Total step {total_step}")
+                    total_step += 1
+            finally:
+                pdataset.close()
             # just in case parameters left is not exact
             self._save_checkpoint(total_step)
             self._log_masks_percentage(total_step)
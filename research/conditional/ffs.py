@@ -49,94 +49,93 @@ class RewrittenSplitFF(nn.Module):
     def forward(self, x):
         # TODO: I want to, if model is in .train(), then also run all things
         # that we need for
-        with Timer("rewrittenFF", disable_inner=False):
-            # BATCH, embedding
-            ash.assert_shape("... B d", x, d=self.dm)
-            # batch, set, embedding <-- this is just reshape
-            with Timer("grouping", disable=True):
-                grouped = einops.rearrange(
-                    x, f"... (b t) d -> {self.og_batched_act}", t=self.sparsity
-                )
+        # BATCH, embedding
+        ash.assert_shape("... B d", x, d=self.dm)
+        # batch, set, embedding <-- this is just reshape
+        with Timer("grouping", disable=True):
+            grouped = einops.rearrange(
+                x, f"... (b t) d -> {self.og_batched_act}", t=self.sparsity
+            )
 
-            with Timer("Controller"):
-                ## CONTROLLER:
-                # batch, set1, embedding <-- this is starting point
-                cont_logits = misc.einsum(
-                    f"{self.batched_act}, {self.cp} -> {self.cout}",
-                    grouped,
-                    self.controller,
-                )
+        with Timer("Controller"):
+            ## CONTROLLER:
+            # batch, set1, embedding <-- this is starting point
+            cont_logits = misc.einsum(
+                f"{self.batched_act}, {self.cp} -> {self.cout}",
+                grouped,
+                self.controller,
+            )
 
-                # adding bias to controller output is actually dangerous, not only unnecessary
-                # cont_logits += self.controller_bias  # This is unnecessary, but it's a reminder
+            # adding bias to controller output is actually dangerous, not only unnecessary
+            # cont_logits += self.controller_bias  # This is unnecessary, but it's a reminder
 
-                # biases in the controller are not needed, because they are added to
-                # every token in a given expert, and expert chooses the token with max value
+            # biases in the controller are not needed, because they are added to
+            # every token in a given expert, and expert chooses the token with max value
 
-                # batch, set1, set2(experts), expertsets  <--- this comes from linear
-                # batch, set1, set2(experts), expertsets <--- sample on 1st dimension (set1)
-                # In lieu of adding noise, we can prioritize earlier tokens. This breaks symmetry.
+            # batch, set1, set2(experts), expertsets  <--- this comes from linear
+            # batch, set1, set2(experts), expertsets <--- sample on 1st dimension (set1)
+            # In lieu of adding noise, we can prioritize earlier tokens. This breaks symmetry.
 
-                # TODO: add sampling ?
-                cont_logits += torch.reshape(
-                    torch.linspace(
-                        start=0, end=1e-6, steps=self.sparsity, device=x.device
-                    ),  # to break symmetry
-                    (-1, 1),
+            # TODO: add sampling ?
+            cont_logits += torch.reshape(
+                torch.linspace(
+                    start=0, end=1e-6, steps=self.sparsity, device=x.device
+                ),  # to break symmetry
+                (-1, 1),
+            )
+            with Timer("contprocessing", disable=True):
+                cont_probs = F.softmax(cont_logits, dim=-2)
+                # cont_permutation = cont_logits
+                cont_permutation = torch.eq(
+                    cont_logits, torch.max(cont_logits, dim=-2, keepdim=True)[0]
                 )
-                with Timer("contprocessing", disable=True):
-                    cont_probs = F.softmax(cont_logits, dim=-2)
-                    # cont_permutation = cont_logits
-                    cont_permutation = torch.eq(
-                        cont_logits, torch.max(cont_logits, dim=-2, keepdim=True)[0]
+                cont_permutation = cont_permutation * 1.0  # convert to float tensor
+                cont_permutation = (
+                    cont_permutation * cont_probs
+                )  # multiply by probability for training!
+
+        with Timer("FF", disable_inner=True):
+            with Timer("ff1", disable_inner=True):
+                with Timer("ff1main"):
+                    inner = misc.einsum(
+                        f"{self.batched_act}, {self.f1p}, {self.cout} -> {self.inner}",
+                        grouped,
+                        self.f1,
+                        cont_permutation,
+                        use_opt_einsum=True,
+                    )
+                with Timer("ff1b"):
+                    inner += self.f1b
+
+            with Timer("relu", disable=True):
+                inner = torch.relu_(inner)
+
+            with Timer("ff2", disable_inner=True):
+                # with Timer('alternative'):
+                #     result_unpermuted = misc.einsum(f'{self.inner},{self.cout},{self.f2p} -> {self.batched_act}',
+                #                                     inner, cont_permutation, self.f2,
+                #                                     use_opt_einsum=True)
+                with Timer("intermediate"):
+                    intermediate = misc.einsum(
+                        f"{self.inner},{self.f2p} -> {self.inner2}", inner, self.f2
+                    )
+                # with Timer('ff2bias'):
+                #     intermediate += self.f2b
+                with Timer("unpermuting"):
+                    result_unpermuted = misc.einsum(
+                        f"{self.inner2}, {self.cout} -> {self.batched_act}",
+                        intermediate,
+                        cont_permutation,
                     )
-                    cont_permutation = cont_permutation * 1.0  # convert to float tensor
-                    cont_permutation = (
-                        cont_permutation * cont_probs
-                    )  # multiply by probability for training!
-
-            with Timer("FF", disable_inner=True):
-                with Timer("ff1", disable_inner=True):
-                    with Timer("ff1main"):
-                        inner = misc.einsum(
-                            f"{self.batched_act}, {self.f1p}, {self.cout} -> {self.inner}",
-                            grouped,
-                            self.f1,
-                            cont_permutation,
-                            use_opt_einsum=True,
-                        )
-                    with Timer("ff1b"):
-                        inner += self.f1b
-
-                with Timer("relu", disable=True):
-                    inner = torch.relu_(inner)
-
-                with Timer("ff2", disable_inner=True):
-                    # with Timer('alternative'):
-                    #     result_unpermuted = misc.einsum(f'{self.inner},{self.cout},{self.f2p} -> {self.batched_act}',
-                    #                                     inner, cont_permutation, self.f2,
-                    #                                     use_opt_einsum=True)
-                    with Timer("intermediate"):
-                        intermediate = misc.einsum(
-                            f"{self.inner},{self.f2p} -> {self.inner2}", inner, self.f2
-                        )
-                    # with Timer('ff2bias'):
-                    #     intermediate += self.f2b
-                    with Timer("unpermuting"):
-                        result_unpermuted = misc.einsum(
-                            f"{self.inner2}, {self.cout} -> {self.batched_act}",
-                            intermediate,
-                            cont_permutation,
-                        )
-
-            # final reshape
-            # BATCH, embedding
-            with Timer("ungrouping", disable=True):
-                result_final = einops.rearrange(
-                    result_unpermuted, f"{self.og_batched_act} -> ... (b t) d"
-                )
 
-            return result_final
+        # final reshape
+        # BATCH, embedding
+        with Timer("ungrouping", disable=True):
+            result_final = einops.rearrange(
+                result_unpermuted, f"{self.og_batched_act} -> ... (b t) d"
+            )
+
+        return result_final
 
 
 @ash.check("... d -> ... d")
@@ -208,75 +207,72 @@ class SimpleSplitFF(nn.Module):
         self.last_x = x.detach()
         # TODO: I want to, if model is in .train(), then also run all things
         # that we need for
-        with Timer("batchedFF", disable_inner=False):
-            # BATCH, embedding
-            ash.assert_shape("... B d", x, d=self.dm)
-            # batch, set, embedding <-- this is just reshape
-            grouped = einops.rearrange(x, f"... (b t) d -> {self.ogp}", t=self.sparsity)
-
-            ## CONTROLLER:
-            # batch, set1, embedding <-- this is starting point
-            cont_logits = misc.einsum(
-                f"{self.gp}, {self.cp} -> {self.cout}", grouped, self.controller
-            )
-
-            # adding bias to controller output is actually dangerous, not only unnecessary
-            # cont_logits += self.controller_bias  # This is unnecessary, but it's a reminder
+        # BATCH, embedding
+        ash.assert_shape("... B d", x, d=self.dm)
+        # batch, set, embedding <-- this is just reshape
+        grouped = einops.rearrange(x, f"... (b t) d -> {self.ogp}", t=self.sparsity)
+
+        ## CONTROLLER:
+        # batch, set1, embedding <-- this is starting point
+        cont_logits = misc.einsum(
+            f"{self.gp}, {self.cp} -> {self.cout}", grouped, self.controller
+        )
 
-            # biases in the controller are not needed, because they are added to
-            # every token in a given expert, and expert chooses the token with max value
+        # adding bias to controller output is actually dangerous, not only unnecessary
+        # cont_logits += self.controller_bias  # This is unnecessary, but it's a reminder
 
-            # batch, set1, set2(experts), expertsets  <--- this comes from linear
-            # batch, set1, set2(experts), expertsets <--- sample on 1st dimension (set1)
-            # In lieu of adding noise, we can prioritize earlier tokens. This breaks symmetry.
+        # biases in the controller are not needed, because they are added to
+        # every token in a given expert, and expert chooses the token with max value
 
-            # TODO: add sampling ?
-            cont_logits += torch.reshape(
-                torch.linspace(
-                    start=0, end=1e-6, steps=self.sparsity, device=x.device
-                ),  # to break symmetry
-                (-1, 1),
-            )
-            raise ValueError("the line below is a bug")
-            cont_probs = F.softmax(cont_logits, dim=1)
-            # cont_permutation = cont_logits
-            cont_permutation = torch.eq(
-                cont_logits, torch.max(cont_logits, dim=-3, keepdim=True)[0]
-            )
-            cont_permutation = cont_permutation * 1.0  # convert to float tensor
-            cont_permutation = (
-                cont_permutation * cont_probs
-            )  # multiply by probability for training!
-            self.last_permutation = cont_permutation.detach()
+        # batch, set1, set2(experts), expertsets  <--- this comes from linear
+        # batch, set1, set2(experts), expertsets <--- sample on 1st dimension (set1)
+        # In lieu of adding noise, we can prioritize earlier tokens. This breaks symmetry.
 
-            inner = misc.einsum(
-                f"{self.gp}, {self.f1p}, {self.cout} -> {self.inner}",
-                grouped,
-                self.f1,
-                cont_permutation,
-                use_opt_einsum=True,
-            )
+        # TODO: add sampling ?
+        cont_logits += torch.reshape(
+            torch.linspace(
+                start=0, end=1e-6, steps=self.sparsity, device=x.device
+            ),  # to break symmetry
+            (-1, 1),
+        )
+        raise ValueError("the line below is a bug")
+        cont_probs = F.softmax(cont_logits, dim=1)
+        # cont_permutation = cont_logits
+        cont_permutation = torch.eq(
+            cont_logits, torch.max(cont_logits, dim=-3, keepdim=True)[0]
+        )
+        cont_permutation = cont_permutation * 1.0  # convert to float tensor
+        cont_permutation = (
+            cont_permutation * cont_probs
+        )  # multiply by probability for training!
+        self.last_permutation = cont_permutation.detach()
+
+        inner = misc.einsum(
+            f"{self.gp}, {self.f1p}, {self.cout} -> {self.inner}",
+            grouped,
+            self.f1,
+            cont_permutation,
+            use_opt_einsum=True,
+        )
 
-            inner = inner + self.bias
+        inner = inner + self.bias
 
-            inner = torch.relu_(inner)
+        inner = torch.relu_(inner)
 
-            intermediate = misc.einsum(
-                f"{self.inner},{self.f2p} -> {self.inner2}", inner, self.f2
-            )
-            result_unpermuted = misc.einsum(
-                f"{self.inner2}, {self.cout} -> {self.gp}",
-                intermediate,
-                cont_permutation,
-            )
+        intermediate = misc.einsum(
+            f"{self.inner},{self.f2p} -> {self.inner2}", inner, self.f2
+        )
+        result_unpermuted = misc.einsum(
+            f"{self.inner2}, {self.cout} -> {self.gp}",
+            intermediate,
+            cont_permutation,
+        )
 
-            # final reshape
-            # BATCH, embedding
-            result_final = einops.rearrange(
-                result_unpermuted, f"{self.ogp} -> ... (b t) d"
-            )
+        # final reshape
+        # BATCH, embedding
+        result_final = einops.rearrange(result_unpermuted, f"{self.ogp} -> ... (b t) d")
 
-            return result_final
+        return result_final
 
 
 @ash.check("... d -> ... d")
@@ -448,68 +444,63 @@ class BatchSplitFF(nn.Module):
         self.last_x = x.detach()
         # TODO: I want to, if model is in .train(), then also run all things
         # that we need for
-        with Timer("batchedFF", disable_inner=False):
-            # BATCH, embedding
-            ash.assert_shape("... B d", x, d=self.dm)
-            # batch, set, embedding <-- this is just reshape
-            grouped = einops.rearrange(x, f"... (b t) d -> {self.ogp}", t=self.sparsity)
-
-            ## CONTROLLER:
-            # batch, set1, embedding <-- this is starting point
-            cont_logits = misc.einsum(
-                f"{self.gp}, {self.cp} -> {self.cout}", grouped, self.controller
-            )
-            cont_logits += (
-                self.controller_bias
-            )  # This is unnecessary, but it's a reminder
-            # biases in the controller are not needed, because they are added to
-            # every token in a given expert, and expert chooses the token with max value
-
-            # batch, set1, set2(experts), expertsets  <--- this comes from linear
-            # batch, set1, set2(experts), expertsets <--- sample on 1st dimension (set1)
-            # In lieu of adding noise, we can prioritize earlier tokens. This breaks symmetry.
-
-            cont_logits += torch.reshape(
-                torch.linspace(
-                    start=0, end=1e-6, steps=self.sparsity, device=x.device
-                ),  # to break symmetry
-                (-1, 1),
-            )
-            # cont_permutation = cont_logits
-            cont_permutation = torch.eq(
-                cont_logits, torch.max(cont_logits, dim=-3, keepdim=True)[0]
-            )
-            cont_permutation = cont_permutation * 1.0  # convert to float tensor
-            self.last_permutation = cont_permutation.detach()
-
-            inner = misc.einsum(
-                f"{self.gp}, {self.f1p}, {self.cout} -> {self.inner}",
-                grouped,
-                self.f1,
-                cont_permutation,
-                use_opt_einsum=True,
-            )
+        # BATCH, embedding
+        ash.assert_shape("... B d", x, d=self.dm)
+        # batch, set, embedding <-- this is just reshape
+        grouped = einops.rearrange(x, f"... (b t) d -> {self.ogp}", t=self.sparsity)
+
+        ## CONTROLLER:
+        # batch, set1, embedding <-- this is starting point
+        cont_logits = misc.einsum(
+            f"{self.gp}, {self.cp} -> {self.cout}", grouped, self.controller
+        )
+        cont_logits += self.controller_bias  # This is unnecessary, but it's a reminder
+        # biases in the controller are not needed, because they are added to
+        # every token in a given expert, and expert chooses the token with max value
+
+        # batch, set1, set2(experts), expertsets  <--- this comes from linear
+        # batch, set1, set2(experts), expertsets <--- sample on 1st dimension (set1)
+        # In lieu of adding noise, we can prioritize earlier tokens. This breaks symmetry.
+
+        cont_logits += torch.reshape(
+            torch.linspace(
+                start=0, end=1e-6, steps=self.sparsity, device=x.device
+            ),  # to break symmetry
+            (-1, 1),
+        )
+        # cont_permutation = cont_logits
+        cont_permutation = torch.eq(
+            cont_logits, torch.max(cont_logits, dim=-3, keepdim=True)[0]
+        )
+        cont_permutation = cont_permutation * 1.0  # convert to float tensor
+        self.last_permutation = cont_permutation.detach()
+
+        inner = misc.einsum(
+            f"{self.gp}, {self.f1p}, {self.cout} -> {self.inner}",
+            grouped,
+            self.f1,
+            cont_permutation,
+            use_opt_einsum=True,
+        )
 
-            inner = inner + self.bias
+        inner = inner + self.bias
 
-            inner = torch.relu_(inner)
+        inner = torch.relu_(inner)
 
-            intermediate = misc.einsum(
-                f"{self.inner},{self.f2p} -> {self.inner2}", inner, self.f2
-            )
-            result_unpermuted = misc.einsum(
-                f"{self.inner2}, {self.cout} -> {self.gp}",
-                intermediate,
-                cont_permutation,
-            )
+        intermediate = misc.einsum(
+            f"{self.inner},{self.f2p} -> {self.inner2}", inner, self.f2
+        )
+        result_unpermuted = misc.einsum(
+            f"{self.inner2}, {self.cout} -> {self.gp}",
+            intermediate,
+            cont_permutation,
+        )
 
-            # final reshape
-            # BATCH, embedding
-            result_final = einops.rearrange(
-                result_unpermuted, f"{self.ogp} -> ... (b t) d"
-            )
+        # final reshape
+        # BATCH, embedding
+        result_final = einops.rearrange(result_unpermuted, f"{self.ogp} -> ... (b t) d")
 
-            return result_final
+        return result_final
 
 
 @ash.check("... dinp -> ... dout")
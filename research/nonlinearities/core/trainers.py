@@ -4,7 +4,9 @@ import torch
 import torch.nn.functional as F
 from attr import define
 
+from lizrd.core import bert
 from lizrd.datasets import wikibookdata
+from lizrd.support.loss import mask_loss_denominator
 from research.nonlinearities.core.misc_logging import (
     register_activation_hooks,
     log_tensor_distribution,
@@ -30,6 +32,7 @@ class NonlinearityTrainer:
     distribution_logging: bool = False
     hook_handles: Optional[list] = None
     saved_activations: Optional[Dict[str, torch.Tensor]] = None
+    masked_head_only: bool = False
 
     def __attrs_post_init__(self):
         self.scaler = torch.cuda.amp.GradScaler(enabled=self.mixed_precision)
@@ -70,25 +73,54 @@ class NonlinearityTrainer:
             self._train_step(step)
             if step % 500 == 0:
                 print(f"Step {step}")
+                wait_stats = self.train_dataloader.pop_wait_stats()
+                log_scalar(
+                    name="data/waited_fraction",
+                    value=wait_stats.waited_fraction,
+                    step=step,
+                    series="train",
+                )
+
+    def _get_model_output(self, x_set, y_mask_set):
+        if self.masked_head_only:
+            return bert.get_masked_predictions(self.model, x_set, y_mask_set.bool())
+        return self.model(x_set).reshape(-1, self.vocab_size)
 
     def calculate_loss(self, x_set, y_token_set, y_mask_set):
         if self.mixed_precision:
             with torch.autocast(
                 device_type="cuda", enabled=self.mixed_precision, dtype=torch.float16
             ):
-                model_output = self.model(x_set)
+                model_output = self._get_model_output(x_set, y_mask_set)
         else:
-            model_output = self.model(x_set)
+            model_output = self._get_model_output(x_set, y_mask_set)
+
+        if self.masked_head_only:
+            # same as the sum below, as the unmasked words would be zeroed out anyway
+            mask_loss = F.cross_entropy(
+                model_output,
+                y_token_set[y_mask_set.bool()].long(),
+                reduction="sum",
+            )
+            loss = mask_loss / self._mask_loss_denominator(y_mask_set)
+            return loss
 
         mask_loss = F.cross_entropy(
-            model_output.reshape(-1, self.vocab_size),
+            model_output,
             y_token_set.reshape(-1).long(),
             reduction="none",
         )
         mask_loss *= y_mask_set.reshape(-1)
-        loss = mask_loss.mean() / self.mask_percent
+        loss = mask_loss.sum() / self._mask_loss_denominator(y_mask_set)
         return loss
 
+    def _mask_loss_denominator(self, y_mask_set):
+        return mask_loss_denominator(
+            y_mask_set,
+            self.train_dataloader.processor.max_total_length,
+            self.mask_percent,
+        )
+
     def attach_logging_hooks(self, step):
         if step % self.logging_frequency == 0:
             self.saved_activations, self.hook_handles = register_activation_hooks(
@@ -2,6 +2,7 @@ import argparse
 import torch
 
 from lizrd.core import misc
+from lizrd.support import ash
 from lizrd.support.logging import get_logger
 from lizrd.train.train_utils import (
     get_model,
@@ -21,6 +22,16 @@ parser.add_argument("--use_clearml", type=bool, default=False)
 parser.add_argument("--use_neptune", type=bool, default=False)
 parser.add_argument("--batch_size", type=int, default=512)
 parser.add_argument("--num_workers", type=int, default=8)
+parser.add_argument("--tokenized_dataset_path", type=str, default=None)
+parser.add_argument("--chunk_index_path", type=str, default=None)
+parser.add_argument("--streaming_dataset_path", type=str, default=None)
+parser.add_argument("--batch_server_address", type=str, default=None)
+parser.add_argument("--masking", type=str, default="example")
+parser.add_argument("--prefetch", type=int, default=0)
+parser.add_argument("--packing", type=bool, default=False)
+parser.add_argument("--bucket_batches", type=int, default=0)
+parser.add_argument("--masked_head_only", type=bool, default=False)
+parser.add_argument("--fast_tokenizer", type=bool, default=False)
 parser.add_argument("--cutoff", type=int, default=128)
 parser.add_argument("--dmodel", type=int, default=256)
 parser.add_argument("--dff", type=int, default=1024)
@@ -56,15 +67,19 @@ parser.add_argument("--dbottle", type=int, default=-1)
 parser.add_argument("--n_bias_copies", type=int, default=-1)
 parser.add_argument("--attention_mode", type=str, default="vanilla")
 parser.add_argument("--attention_thinning_coeff", type=float, default=1.0)
+parser.add_argument("--attention_backend", type=str, default="einsum")
+parser.add_argument("--attention_chunk_size", type=int, default=128)
 parser.add_argument("--n_steps_eval", type=int, default=100)
 parser.add_argument("--class_loss_weight", type=float, default=1.0)
 parser.add_argument("--save_model_checkpoints", type=bool, default=False)
 parser.add_argument("--deterministic", type=bool, default=True)
 parser.add_argument("--x_flop", action="store_true")
 parser.add_argument("--x_logarithmic", action="store_true")
+parser.add_argument("--check_first_n", type=int, default=None)
 
 
 args = parser.parse_args()
+ash.set_check_mode(first_n=args.check_first_n)
 
 VOCAB_SIZE = 30522  # BertTokenizer uses this many words
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -77,6 +92,15 @@ train_dataloader = get_processed_dataset(
     num_workers=args.num_workers,
     batch_size=args.batch_size,
     seed=args.seed,
+    tokenized_dataset_path=args.tokenized_dataset_path,
+    chunk_index_path=args.chunk_index_path,
+    streaming_dataset_path=args.streaming_dataset_path,
+    batch_server_address=args.batch_server_address,
+    masking=args.masking,
+    use_fast_tokenizer=args.fast_tokenizer,
+    prefetch=args.prefetch,
+    packing=args.packing,
+    bucket_batches=args.bucket_batches,
 )
 
 ff_layer_fun = get_ff_layer(args)
@@ -103,6 +127,7 @@ trainer = NonlinearityTrainer(
     mixed_precision=args.mixed_precision,
     distribution_logging=args.log_distributions,
     logging_frequency=args.logging_frequency,
+    masked_head_only=args.masked_head_only,
 )
 
 logger = get_logger(args, model, VOCAB_SIZE)
@@ -35,10 +35,19 @@ def get_attention_layer(args):
             attention_layer_fun = lambda: None
         else:
             attention_layer_fun = lambda: bert.Attention(
-                args.dmodel, args.n_att_heads, att_dhead
+                args.dmodel,
+                args.n_att_heads,
+                att_dhead,
+                backend=args.attention_backend,
+                chunk_size=args.attention_chunk_size,
             )
     else:
-        attention_layer_fun = lambda: bert.Attention(args.dmodel, args.n_att_heads)
+        attention_layer_fun = lambda: bert.Attention(
+            args.dmodel,
+            args.n_att_heads,
+            backend=args.attention_backend,
+            chunk_size=args.attention_chunk_size,
+        )
     return attention_layer_fun
 
 
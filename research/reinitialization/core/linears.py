@@ -70,26 +70,60 @@ class UnstructPruneFF(nn.Module):
         return x
 
 
-@ash.check("... d -> ... d")
-class StructPruneFF(nn.Module):
+class CompactStructFF(nn.Module):
+    """
+    Feed-Forward layer with a mask over its dff neurons, which computes only the neurons left by the mask.
+    The indices of these neurons are found again whenever the mask changes (compact), and every forward
+    gathers their rows of lin1 and columns of lin2 into smaller dense matrices. Autograd scatters
+    the gradients back into the full weights, so the optimizer and state dict still see the full layers,
+    and the result is the same as masking the neurons.
+    """
+
     def __init__(self, dmodel: int, dff: int, pruner: Pruner):
         super().__init__()
         self.lin1 = nn.Linear(dmodel, dff)
         self.lin2 = nn.Linear(dff, dmodel)
         self.mask = create_mask(torch.Size([dff]))
         pruner.register(self)
+        self.alive_idx = None
+        self.compacted_mask_key = None
+
+    def _mask_key(self):
+        # changes when the mask is replaced, moved, loaded or modified in place
+        return id(self.mask), self.mask.data_ptr(), self.mask._version
+
+    def compact(self):
+        alive_idx = torch.nonzero(self.mask).squeeze(-1)
+        self.alive_idx = alive_idx if len(alive_idx) < len(self.mask) else None
+        self.compacted_mask_key = self._mask_key()
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        x = self.lin1(x)
-        x = misc.einsum("... i, i -> ... i", x, self.mask)
+        if self.compacted_mask_key != self._mask_key():
+            self.compact()
+        if self.alive_idx is None:
+            x = self.lin1(x)
+            x = F.relu(x)
+            x = self.lin2(x)
+            return x
+        x = F.linear(
+            x,
+            self.lin1.weight.index_select(0, self.alive_idx),
+            self.lin1.bias.index_select(0, self.alive_idx),
+        )
         x = F.relu(x)
-        x = self.lin2(x)
+        x = F.linear(
+            x, self.lin2.weight.index_select(1, self.alive_idx), self.lin2.bias
+        )
         return x
 
+
+@ash.check("... d -> ... d")
+class StructPruneFF(CompactStructFF):
     def prune(self, prob: float):
         self.mask.data = mask_by_score(
             self.mask, torch.rand_like(self.mask), round(self.mask.numel() * prob)
         )
+        self.compact()
 
 
 def prepare_tensor_for_logging(x, sample_size=2500):
@@ -518,21 +552,7 @@ class UnstructMagnitudePruneFF(nn.Module):
 
 
 @ash.check("... d -> ... d")
-class StructMagnitudePruneFF(nn.Module):
-    def __init__(self, dmodel: int, dff: int, pruner: Pruner):
-        super().__init__()
-        self.lin1 = nn.Linear(dmodel, dff)
-        self.lin2 = nn.Linear(dff, dmodel)
-        self.mask = create_mask(torch.Size([dff]))
-        pruner.register(self)
-
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
-        x = self.lin1(x)
-        x = misc.einsum("... i, i -> ... i", x, self.mask)
-        x = F.relu(x)
-        x = self.lin2(x)
-        return x
-
+class StructMagnitudePruneFF(CompactStructFF):
     def prune(self, prob: float):
         weights1 = misc.einsum("i o -> i", self.lin1.weight**2)
         weights2 = misc.einsum("o i -> i", self.lin2.weight**2)
@@ -540,6 +560,7 @@ class StructMagnitudePruneFF(nn.Module):
         self.mask.data = mask_by_score(
             self.mask, scores, round(self.mask.numel() * prob)
         )
+        self.compact()
 
 
 @ash.check("... d -> ... d")
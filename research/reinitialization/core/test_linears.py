@@ -1,3 +1,5 @@
+import copy
+
 import torch
 
 from research.reinitialization.core import linears
@@ -109,6 +111,41 @@ class TestStructPruneFF(PruneFFTest):
         t = torch.rand((20, 10))
         self._test_with_pruner(layer, pruner, t, P)
 
+    def test_compaction(self):
+        def masked_forward(layer, x):
+            x = layer.lin1(x) * layer.mask
+            return layer.lin2(torch.relu(x))
+
+        for layer_class in [linears.StructPruneFF, linears.StructMagnitudePruneFF]:
+            pruner = Pruner()
+            layer = layer_class(16, 64, pruner)
+            reference = copy.deepcopy(layer)
+            x = torch.rand((4, 5, 16))
+
+            pruner.prune(0.5)
+            reference.mask.data = layer.mask.data.clone()
+            self.assertEqual(len(layer.alive_idx), 32)
+
+            res = layer(x)
+            res.sum().backward()
+            expected = masked_forward(reference, x)
+            expected.sum().backward()
+            self.assertTensorAlmostEqual(res, expected)
+            for param, expected_param in zip(
+                layer.parameters(), reference.parameters()
+            ):
+                if param.requires_grad:
+                    self.assertTensorAlmostEqual(param.grad, expected_param.grad)
+
+            # a mask loaded from a checkpoint is compacted again
+            state_dict = copy.deepcopy(layer.state_dict())
+            state_dict["mask"][:48] = 0
+            state_dict["mask"][48:] = 1
+            layer.load_state_dict(state_dict)
+            reference.mask.data = state_dict["mask"].clone()
+            self.assertTensorAlmostEqual(layer(x), masked_forward(reference, x))
+            self.assertEqual(len(layer.alive_idx), 16)
+
     def _assert_perc_nonzero(self, ff_layer, perc_nonzero_exp):
         nonzero = torch.count_nonzero(ff_layer.mask)
         perc_nonzero = 100 * nonzero / torch.numel(ff_layer.mask)
@@ -4,6 +4,7 @@ import secrets
 import torch
 
 from lizrd.core import misc, bert
+from lizrd.support import ash
 from lizrd.scripts.grid_utils import get_machine_backend, MachineBackend
 from research.reinitialization.core import linears, linears_loss, linears_plusminus
 from research.reinitialization.core import linears_recycle
@@ -11,6 +12,7 @@ from research.reinitialization.core import linears_noise
 from research.reinitialization.core.pruner import Pruner
 from lizrd.train.train_utils import (
     get_model,
+    get_fixed_eval_dataset,
     get_processed_dataset,
     Trainer,
     RetrainTrainer,
@@ -48,6 +50,9 @@ parser.add_argument("--trainer_type", type=str, default="regular")
 parser.add_argument("--tags", nargs="*", type=str, default=None)
 parser.add_argument("--ds_seed", type=int, default=42)
 parser.add_argument("--eval_ds_seed", type=int, default=1984)
+parser.add_argument("--eval_set_batches", type=int, default=0)
+parser.add_argument("--eval_batch_size", type=int, default=None)
+parser.add_argument("--eval_set_cache_dir", type=str, default=None)
 parser.add_argument("--retrain_ds_seed", type=int, default=1998)
 
 parser.add_argument("--batch_size", type=str, default=64)
@@ -71,6 +76,20 @@ parser.add_argument("--n_steps_log", type=int, default=5_000)
 parser.add_argument("--immunity", type=int, default=10)
 parser.add_argument("--reinit_dist", type=str, default="init")
 parser.add_argument("--num_workers", type=int, default=8)
+parser.add_argument("--tokenized_dataset_path", type=str, default=None)
+parser.add_argument("--chunk_index_path", type=str, default=None)
+parser.add_argument("--streaming_dataset_path", type=str, default=None)
+parser.add_argument("--batch_server_address", type=str, default=None)
+parser.add_argument("--masking", type=str, default="example")
+parser.add_argument("--prefetch", type=int, default=0)
+parser.add_argument("--packing", action="store_true")
+parser.add_argument("--bucket_batches", type=int, default=0)
+parser.add_argument("--packed_attention_mask", action="store_true")
+parser.add_argument("--attention_backend", type=str, default="einsum")
+parser.add_argument("--attention_chunk_size", type=int, default=128)
+parser.add_argument("--masked_head_only", action="store_true")
+parser.add_argument("--profile_steps", type=int, nargs=2, default=None)
+parser.add_argument("--fast_tokenizer", action="store_true")
 parser.add_argument("--sep_dir_mag_magnitude_requires_grad", action="store_true")
 parser.add_argument("--sep_dir_mag_small_grad", action="store_true")
 parser.add_argument("--n_log_light_steps", type=int, default=100)
@@ -95,6 +114,7 @@ parser.add_argument("--mpl_only_smaller_neurons", action="store_true")
 parser.add_argument("--mpl_aggregation_type", type=str, default="regular")
 parser.add_argument("--weight_decay", type=float, default=0.0)
 parser.add_argument("--model_load_path", type=str, default=None)
+parser.add_argument("--data_state_load_path", type=str, default=None)
 
 parser.add_argument("--noise_ff_prune_ratio", type=float, required=False)
 parser.add_argument("--noise_ff_n_steps", type=int, required=False)
@@ -102,8 +122,10 @@ parser.add_argument("--noise_interpolation_delay", type=float, default=0.0)
 parser.add_argument("--noise_ff_weight_init", type=str, default="random")
 parser.add_argument("--lr_warmup_steps", type=int, default=10_000)
 parser.add_argument("--write_easy_masks", action="store_true")
+parser.add_argument("--check_first_n", type=int, default=None)
 
 args = parser.parse_args()
+ash.set_check_mode(first_n=args.check_first_n)
 
 if args.dff == "auto":
     args.dff = args.dmodel * 4
@@ -270,22 +292,54 @@ else:
     raise ValueError(f"ff_layer {args.ff_layer} not recognized")
 
 misc.print_available_gpus()
+if args.data_state_load_path:
+    print(f"Loading data stream state from {args.data_state_load_path}")
+    data_stream_state = torch.load(args.data_state_load_path)
+else:
+    data_stream_state = None
 pdataset = get_processed_dataset(
     batch_size=args.batch_size,
     max_total_length=args.cutoff,
     mask_percent=args.mask_percent,
     device=DEVICE,
     num_workers=args.num_workers,
+    tokenized_dataset_path=args.tokenized_dataset_path,
+    chunk_index_path=args.chunk_index_path,
+    streaming_dataset_path=args.streaming_dataset_path,
+    batch_server_address=args.batch_server_address,
+    masking=args.masking,
+    use_fast_tokenizer=args.fast_tokenizer,
+    prefetch=args.prefetch,
+    packing=args.packing,
+    bucket_batches=args.bucket_batches,
     seed=args.ds_seed,
+    stream_state=data_stream_state,
 )
-eval_pdataset = get_processed_dataset(
+# only the training streams prefetch, the other datasets are sampled from now and then
+eval_pdataset_kwargs = dict(
     batch_size=args.batch_size,
     max_total_length=args.cutoff,
     mask_percent=args.mask_percent,
     device=DEVICE,
     num_workers=1,
     seed=args.eval_ds_seed,
+    tokenized_dataset_path=args.tokenized_dataset_path,
+    chunk_index_path=args.chunk_index_path,
+    streaming_dataset_path=args.streaming_dataset_path,
+    masking=args.masking,
+    use_fast_tokenizer=args.fast_tokenizer,
+    packing=args.packing,
+    bucket_batches=args.bucket_batches,
 )
+if args.eval_set_batches > 0:
+    eval_pdataset = get_fixed_eval_dataset(
+        cache_dir=args.eval_set_cache_dir,
+        n_batches=args.eval_set_batches,
+        eval_batch_size=args.eval_batch_size or args.batch_size,
+        **eval_pdataset_kwargs,
+    )
+else:
+    eval_pdataset = get_processed_dataset(**eval_pdataset_kwargs)
 
 model = get_model(
     max_length=args.cutoff,
@@ -295,7 +349,11 @@ model = get_model(
     n_blocks=args.n_blocks,
     device=DEVICE,
     attention_layer_fun=lambda: bert.Attention(
-        args.dmodel, args.heads, dhead=args.dhead
+        args.dmodel,
+        args.heads,
+        dhead=args.dhead,
+        backend=args.attention_backend,
+        chunk_size=args.attention_chunk_size,
     ),
 )
 if args.model_load_path:
@@ -327,6 +385,13 @@ if args.log_neuron_diff:
         mask_percent=args.mask_percent,
         device=DEVICE,
         num_workers=args.num_workers,
+        tokenized_dataset_path=args.tokenized_dataset_path,
+        chunk_index_path=args.chunk_index_path,
+        streaming_dataset_path=args.streaming_dataset_path,
+        masking=args.masking,
+        use_fast_tokenizer=args.fast_tokenizer,
+        packing=args.packing,
+        bucket_batches=args.bucket_batches,
         seed=args.neuron_diff_ds_seed,
     )
 else:
@@ -338,6 +403,13 @@ dataset_token_eval_fn = lambda: get_processed_dataset(
     mask_percent=args.mask_percent,
     device=DEVICE,
     num_workers=args.num_workers,
+    tokenized_dataset_path=args.tokenized_dataset_path,
+    chunk_index_path=args.chunk_index_path,
+    streaming_dataset_path=args.streaming_dataset_path,
+    masking=args.masking,
+    use_fast_tokenizer=args.fast_tokenizer,
+    packing=args.packing,
+    bucket_batches=args.bucket_batches,
     seed=43,
 )
 
@@ -370,6 +442,9 @@ base_trainer_params = dict(
     lr_warmup_steps=args.lr_warmup_steps,
     dataset_token_eval_fn=dataset_token_eval_fn,
     write_easy_masks=args.write_easy_masks,
+    packed_attention_mask=args.packed_attention_mask,
+    masked_head_only=args.masked_head_only,
+    profile_steps=args.profile_steps,
 )
 
 if args.trainer_type == "retrain":
@@ -379,6 +454,14 @@ if args.trainer_type == "retrain":
         mask_percent=args.mask_percent,
         device=DEVICE,
         num_workers=args.num_workers,
+        tokenized_dataset_path=args.tokenized_dataset_path,
+        chunk_index_path=args.chunk_index_path,
+        streaming_dataset_path=args.streaming_dataset_path,
+        masking=args.masking,
+        use_fast_tokenizer=args.fast_tokenizer,
+        prefetch=args.prefetch,
+        packing=args.packing,
+        bucket_batches=args.bucket_batches,
         seed=args.retrain_ds_seed,
     )
     trainer = RetrainTrainer(
@@ -1,6 +1,7 @@
 import research.conditional.ffs
 from lizrd.core import misc
 from lizrd.core import bert
+from lizrd.core import nn
 import torch
 
 from lizrd.support import profile
@@ -37,10 +38,21 @@ def test_basic(self):
 
 CUDA = torch.device("cuda")
 
-USE_CUDA = True
+USE_CUDA = torch.cuda.is_available()
 DO_BACKWARD = True
 
 
+SPLIT_FFS = (
+    research.conditional.ffs.RewrittenSplitFF,
+    research.conditional.ffs.SimpleSplitFF,
+    research.conditional.ffs.BatchSplitFF,
+)
+
+
+def ff_forward_time(profilers):
+    return sum(profiler.stats["model"].forward_time for profiler in profilers)
+
+
 class NoopEnter(object):
     def __enter__(self):
         pass
@@ -59,14 +71,14 @@ def test_one_sparse(log_total_dff):
     print(logexpertsets, logexpertsize, lognexperts)
     print(expertsets, expertsize, nexperts)
     # try:
-    main_tests(
+    ff_profilers = main_tests(
         "simplesparse",
         disable_inner=False,
         expertsets=expertsets,
         expertsize=expertsize,
         nexperts=nexperts,
     )
-    print("IMPORTANT", round(sum(profile.GLOBAL_TIMERS["batchedFF"]), 3))
+    print("IMPORTANT", round(ff_forward_time(ff_profilers), 3))
     profile.print_times()
     # except:
     #     print("FAILED")
@@ -89,7 +101,7 @@ def test_all_sparse(log_total_dff):
             print(logexpertsets, logexpertsize, lognexperts)
             print(expertsets, expertsize, nexperts)
             try:
-                main_tests(
+                ff_profilers = main_tests(
                     "rewritten",
                     disable_inner=False,
                     expertsets=expertsets,
@@ -97,7 +109,10 @@ def test_all_sparse(log_total_dff):
                     nexperts=nexperts,
                 )
                 for key in keys:
-                    time = round(sum(profile.GLOBAL_TIMERS[key]), 3)
+                    if key == "rewrittenFF":
+                        time = round(ff_forward_time(ff_profilers), 3)
+                    else:
+                        time = round(profile.GLOBAL_TIMERS[key].total, 3)
                     tables[key][logexpertsize][logexpertsets] = time
                 profile.print_times()
             except:
@@ -316,13 +331,24 @@ def main_tests(version, disable_inner=False, expertsets=4, expertsize=64, nexper
                 # optimizer.step()
                 torch.sum(output).item()  # to make sure everything is computed
         profile.reset_times()
+        # the split FFs are timed with module hooks, only they are hooked so that attention keeps its fused path
+        ff_profilers = [
+            nn.ModuleProfiler(module, synchronize=profile.SYNCHRONIZE).enable()
+            for module in model.modules()
+            if isinstance(module, SPLIT_FFS)
+        ]
         with profile.Timer(f"{version}", disable_inner=disable_inner):
             for input in inputs[warmup:]:
                 output = model(input)
                 torch.sum(output).item()  # to make sure everything is computed
+        for profiler in ff_profilers:
+            profiler.disable()
+    return ff_profilers
 
 
 if __name__ == "__main__":
+    # the versions are compared by their times, so these have to include the CUDA kernels
+    profile.SYNCHRONIZE = True
     # main_tests('sparse+qkv', False)
     # profile.print_times()
     # main_tests('sparse+lowrank', False)
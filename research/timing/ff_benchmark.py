@@ -0,0 +1,309 @@
+"""
+Throughput benchmark of the feed-forward layer variants, runs on CPU (or CUDA with --device=cuda).
+For every variant and every combination of dmodel, dff, batch and seqlen it measures tokens/s,
+latency quantiles and peak memory of the forward pass (under no_grad) and of forward+backward,
+and writes them as JSON. Given a baseline JSON from an earlier run, it also reports
+the cases that got slower or use more memory than `tolerance` allows, and exits with 1 if there are any.
+
+Usage:
+python3 -m research.timing.ff_benchmark --output=ff_benchmark.json --dmodel 256 512 --dff 1024 2048
+python3 -m research.timing.ff_benchmark --output=new.json --baseline=ff_benchmark.json
+"""
+import argparse
+import itertools
+import json
+import platform
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+
+import torch
+from attr import asdict, define
+
+import research.conditional.ffs
+from lizrd.core import bert
+from lizrd.support import ash, profile
+from research.nonlinearities.core import research_bert
+from research.reinitialization.core import linears, linears_noise, linears_recycle
+from research.reinitialization.core.pruner import Pruner
+
+MODES = ("forward", "forward_backward")
+
+
+def _pruned(layer, prob: float):
+    layer.prune(prob)
+    return layer
+
+
+# each variant is built from (dmodel, dff), the ones with a fixed expansion ignore dff;
+# SimpleSplitFF is left out, as its forward raises on purpose,
+# and PruneLinear needs a bias;
+# the unpruned struct_prune variants time the mask bookkeeping, the _50 ones the compacted forward
+FF_VARIANTS: Dict[str, Callable[[int, int], torch.nn.Module]] = {
+    "feedforward": lambda dmodel, dff: bert.FeedForward(dmodel, dff),
+    "rewritten_split": lambda dmodel, dff: research.conditional.ffs.RewrittenSplitFF(
+        [], dmodel, dff, dff // 64, 8, 64
+    ),
+    "batch_split": lambda dmodel, dff: research.conditional.ffs.BatchSplitFF(
+        [], dmodel, dff, 4, 4, dff // 16
+    ),
+    "bottleneck": lambda dmodel, dff: research_bert.FeedForwardBottleneck(
+        dmodel, dff // dmodel
+    ),
+    "multineck": lambda dmodel, dff: research_bert.FeedForwardMultineck(
+        dmodel, dff // dmodel, 4
+    ),
+    "inception_neck": lambda dmodel, dff: research_bert.FeedForwardInceptionNeck(
+        dmodel, dff // dmodel, [0.5, 0.25, 0.25]
+    ),
+    "chopped_neck": lambda dmodel, dff: research_bert.FeedForwardChoppedNeck(dmodel, 4),
+    "unstruct_prune": lambda dmodel, dff: linears.UnstructPruneFF(
+        dmodel, dff, Pruner(), bias=True
+    ),
+    "struct_prune": lambda dmodel, dff: linears.StructPruneFF(dmodel, dff, Pruner()),
+    "struct_magnitude_prune": lambda dmodel, dff: linears.StructMagnitudePruneFF(
+        dmodel, dff, Pruner()
+    ),
+    "struct_prune_50": lambda dmodel, dff: _pruned(
+        linears.StructPruneFF(dmodel, dff, Pruner()), 0.5
+    ),
+    "struct_magnitude_prune_50": lambda dmodel, dff: _pruned(
+        linears.StructMagnitudePruneFF(dmodel, dff, Pruner()), 0.5
+    ),
+    "noise": lambda dmodel, dff: linears_noise.NoiseFF(
+        dmodel, dff, Pruner(), prune_ratio=0.1, n_steps_interpolate=100
+    ),
+    "retrain_recycle": lambda dmodel, dff: linears_recycle.RetrainRecycleFF(
+        dmodel, dff, Pruner()
+    ),
+}
+
+
+@define
+class BenchmarkResult:
+    variant: str
+    mode: str
+    dmodel: int
+    dff: int
+    batch: int
+    seqlen: int
+    n_params: int
+    tokens_per_s: float
+    latency_mean_ms: float
+    latency_p50_ms: float
+    latency_p90_ms: float
+    latency_p99_ms: float
+    peak_memory_bytes: int
+
+    @property
+    def key(self):
+        return (self.variant, self.mode, self.dmodel, self.dff, self.batch, self.seqlen)
+
+
+def _run(layer, x, mode):
+    if mode == "forward":
+        with torch.no_grad():
+            layer(x)
+    else:
+        for param in layer.parameters():
+            param.grad = None
+        layer(x).sum().backward()
+
+
+def peak_memory(layer, x, mode, device) -> int:
+    """Peak bytes allocated while running `mode` once, on CPU estimated from the profiler's memory events."""
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats(device)
+        start = torch.cuda.memory_allocated(device)
+        _run(layer, x, mode)
+        torch.cuda.synchronize()
+        return torch.cuda.max_memory_allocated(device) - start
+    with torch.profiler.profile(
+        activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True
+    ) as profiler:
+        _run(layer, x, mode)
+    allocated = peak = 0
+    for event in sorted(profiler.events(), key=lambda event: event.time_range.start):
+        allocated += event.self_cpu_memory_usage
+        peak = max(peak, allocated)
+    return peak
+
+
+def benchmark_layer(
+    variant: str,
+    dmodel: int,
+    dff: int,
+    batch: int,
+    seqlen: int,
+    mode: str,
+    device: torch.device,
+    n_iters: int = 20,
+    n_warmup: int = 3,
+) -> BenchmarkResult:
+    torch.manual_seed(0)
+    layer = FF_VARIANTS[variant](dmodel, dff).to(device)
+    layer.train(mode == "forward_backward")
+    # in a model the input of an FF requires grad, which changes what the backward computes
+    x = torch.randn(
+        batch, seqlen, dmodel, device=device, requires_grad=mode == "forward_backward"
+    )
+
+    for _ in range(n_warmup):
+        _run(layer, x, mode)
+    stats = profile.TimerStats(reservoir_size=n_iters)
+    for _ in range(n_iters):
+        profile.cuda_synchronize()
+        start = time.perf_counter()
+        _run(layer, x, mode)
+        profile.cuda_synchronize()
+        stats.add(time.perf_counter() - start)
+
+    return BenchmarkResult(
+        variant=variant,
+        mode=mode,
+        dmodel=dmodel,
+        dff=dff,
+        batch=batch,
+        seqlen=seqlen,
+        n_params=sum(param.numel() for param in layer.parameters()),
+        tokens_per_s=batch * seqlen / stats.mean,
+        latency_mean_ms=stats.mean * 1000,
+        latency_p50_ms=stats.quantile(0.5) * 1000,
+        latency_p90_ms=stats.quantile(0.9) * 1000,
+        latency_p99_ms=stats.quantile(0.99) * 1000,
+        peak_memory_bytes=peak_memory(layer, x, mode, device),
+    )
+
+
+def run_benchmarks(
+    variants: List[str],
+    dmodels: List[int],
+    dffs: List[int],
+    batches: List[int],
+    seqlens: List[int],
+    device: torch.device,
+    modes=MODES,
+    n_iters: int = 20,
+    n_warmup: int = 3,
+    verbose: bool = False,
+) -> List[BenchmarkResult]:
+    results = []
+    for variant, dmodel, dff, batch, seqlen, mode in itertools.product(
+        variants, dmodels, dffs, batches, seqlens, modes
+    ):
+        result = benchmark_layer(
+            variant, dmodel, dff, batch, seqlen, mode, device, n_iters, n_warmup
+        )
+        if verbose:
+            print(
+                f"{variant:26} {mode:16} dmodel={dmodel} dff={dff} batch={batch} seqlen={seqlen}: "
+                f"{result.tokens_per_s:.0f} tokens/s, p50={result.latency_p50_ms:.2f}ms, "
+                f"p90={result.latency_p90_ms:.2f}ms, peak={result.peak_memory_bytes / 2**20:.1f}MiB",
+                flush=True,
+            )
+        results.append(result)
+    return results
+
+
+def compare_to_baseline(
+    results: List[BenchmarkResult],
+    baseline: List[BenchmarkResult],
+    tolerance: float = 0.1,
+) -> List[str]:
+    """
+    Returns a description of every case that is slower than its baseline by more than `tolerance`
+    (as a fraction of baseline tokens/s) or has that much higher peak memory.
+    Cases missing from either side are not compared.
+    """
+    baseline_by_key = {result.key: result for result in baseline}
+    regressions = []
+    for result in results:
+        old = baseline_by_key.get(result.key)
+        if old is None:
+            continue
+        name = " ".join(map(str, result.key))
+        if result.tokens_per_s < old.tokens_per_s * (1 - tolerance):
+            regressions.append(
+                f"{name}: {result.tokens_per_s:.0f} tokens/s, was {old.tokens_per_s:.0f}"
+            )
+        if result.peak_memory_bytes > old.peak_memory_bytes * (1 + tolerance):
+            regressions.append(
+                f"{name}: peak memory {result.peak_memory_bytes} bytes, was {old.peak_memory_bytes}"
+            )
+    return regressions
+
+
+def save_results(results: List[BenchmarkResult], path: str, device: torch.device):
+    meta = {
+        "torch": torch.__version__,
+        "device": str(device),
+        "threads": torch.get_num_threads(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    with open(path, "w") as f:
+        json.dump(
+            {"meta": meta, "results": [asdict(result) for result in results]},
+            f,
+            indent=2,
+        )
+
+
+def load_results(path: str) -> List[BenchmarkResult]:
+    with open(path) as f:
+        return [BenchmarkResult(**result) for result in json.load(f)["results"]]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--baseline", type=str, default=None)
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    parser.add_argument("--variants", nargs="*", type=str, default=list(FF_VARIANTS))
+    parser.add_argument("--modes", nargs="*", type=str, default=list(MODES))
+    parser.add_argument("--dmodel", nargs="*", type=int, default=[256, 512])
+    parser.add_argument("--dff", nargs="*", type=int, default=[1024, 2048])
+    parser.add_argument("--batch", nargs="*", type=int, default=[16])
+    parser.add_argument("--seqlen", nargs="*", type=int, default=[128])
+    parser.add_argument("--n_iters", type=int, default=20)
+    parser.add_argument("--n_warmup", type=int, default=3)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    # shapes are checked once per layer, so that the checks do not count towards the timings
+    ash.set_check_mode(first_n=1)
+    device = torch.device(args.device)
+
+    results = run_benchmarks(
+        variants=args.variants,
+        dmodels=args.dmodel,
+        dffs=args.dff,
+        batches=args.batch,
+        seqlens=args.seqlen,
+        device=device,
+        modes=args.modes,
+        n_iters=args.n_iters,
+        n_warmup=args.n_warmup,
+        verbose=True,
+    )
+    save_results(results, args.output, device)
+    print(f"Results written to {args.output}")
+
+    if args.baseline is not None:
+        regressions = compare_to_baseline(
+            results, load_results(args.baseline), args.tolerance
+        )
+        for regression in regressions:
+            print("REGRESSION", regression)
+        print(f"{len(regressions)} regressions against {args.baseline}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,62 @@
+import contextlib
+import io
+import os
+import tempfile
+
+import attr
+import torch
+
+from lizrd.support.test_utils import GeneralTestCase
+from research.timing import ff_benchmark
+
+
+class TestFFBenchmark(GeneralTestCase):
+    def test_all_variants(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            results = ff_benchmark.run_benchmarks(
+                variants=list(ff_benchmark.FF_VARIANTS),
+                dmodels=[32],
+                dffs=[256],
+                batches=[4],
+                seqlens=[32],
+                device=torch.device("cpu"),
+                n_iters=2,
+                n_warmup=1,
+            )
+        self.assertEqual(output.getvalue(), "")
+        self.assertEqual(len(results), 2 * len(ff_benchmark.FF_VARIANTS))
+        for result in results:
+            self.assertGreater(result.tokens_per_s, 0)
+            self.assertGreater(result.peak_memory_bytes, 0)
+            self.assertLessEqual(result.latency_p50_ms, result.latency_p99_ms)
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            path = os.path.join(output_dir, "results.json")
+            ff_benchmark.save_results(results, path, torch.device("cpu"))
+            self.assertEqual(ff_benchmark.load_results(path), results)
+
+    def test_pruned_variants(self):
+        for variant in ["struct_prune_50", "struct_magnitude_prune_50"]:
+            layer = ff_benchmark.FF_VARIANTS[variant](32, 256)
+            self.assertEqual(len(layer.alive_idx), 128)
+
+    def test_compare_to_baseline(self):
+        results = ff_benchmark.run_benchmarks(
+            variants=["feedforward"],
+            dmodels=[32],
+            dffs=[256],
+            batches=[4],
+            seqlens=[32],
+            device=torch.device("cpu"),
+            modes=["forward"],
+            n_iters=2,
+            n_warmup=1,
+        )
+        self.assertEqual(ff_benchmark.compare_to_baseline(results, results), [])
+
+        (result,) = results
+        baseline = attr.evolve(result, tokens_per_s=result.tokens_per_s * 2)
+        regressions = ff_benchmark.compare_to_baseline(results, [baseline])
+        self.assertEqual(len(regressions), 1)
+        self.assertIn("tokens/s", regressions[0])